@@ -5,7 +5,17 @@ from io import StringIO
 import csv
 from database import get_db_connection_fastapi, create_database_and_table_fastapi
 from models import Customer, ServerIP, CustServer
-from utils import is_valid_email, is_valid_numeric, generate_customer_number_fastapi
+from utils import is_valid_email, is_valid_numeric
+
+# Generate next CustomerNumber
+def generate_customer_number_fastapi():
+    conn = get_db_connection_fastapi()
+    cursor = conn.cursor()
+    cursor.execute("SELECT MAX(CAST(SUBSTRING(CustomerNumber, 5, LEN(CustomerNumber)-4) AS INT)) FROM Customers WHERE CustomerNumber LIKE 'CUST%'")
+    max_num = cursor.fetchone()[0]
+    next_num = (max_num or 0) + 1
+    conn.close()
+    return f'CUST{next_num:04d}'
 
 async def lifespan(app: FastAPI):
     create_database_and_table_fastapi()
@@ -0,0 +1,144 @@
+import asyncio
+import heapq
+import itertools
+import json
+from urllib.parse import parse_qs
+from config import (
+    ADMISSION_ENABLED, ADMISSION_TOTAL_CONCURRENCY, ADMISSION_MAX_WAIT_SECONDS,
+    ADMISSION_RETRY_AFTER_SECONDS, ADMISSION_CLASSES, ADMISSION_PAGE_PATHS, ADMISSION_EXEMPT_PREFIXES,
+)
+from tracing import span
+
+class Rejected(Exception):
+    pass
+
+# Decide which admission class a request belongs to (None = not throttled)
+def classify(method, path, query_string=b""):
+    if path.startswith(ADMISSION_EXEMPT_PREFIXES):
+        return None
+    if method not in ("GET", "HEAD"):
+        return "write"
+    if path in ADMISSION_PAGE_PATHS:
+        return "page"
+    if parse_qs(query_string.decode("latin-1")).get("search", [""])[0]:
+        return "search"
+    return "read"
+
+# Per-class concurrency limits under one global budget; waiters are served by priority, then FIFO
+class AdmissionController:
+    def __init__(self, total=ADMISSION_TOTAL_CONCURRENCY, classes=ADMISSION_CLASSES, max_wait=ADMISSION_MAX_WAIT_SECONDS):
+        self.total = total
+        self.classes = classes
+        self.max_wait = max_wait
+        self.in_flight = {name: 0 for name in classes}
+        self.queued = {name: 0 for name in classes}
+        self.rejected = {name: 0 for name in classes}
+        self._waiters = []
+        self._seq = itertools.count()
+
+    def _running(self):
+        return sum(self.in_flight.values())
+
+    def _fits(self, name):
+        return self.in_flight[name] < self.classes[name][0] and self._running() < self.total
+
+    def _grant(self, name):
+        self.in_flight[name] += 1
+
+    async def acquire(self, name):
+        _, max_queue, priority = self.classes[name]
+        # Only jump ahead when no runnable waiter of equal or higher priority is held back by the global budget
+        if self._fits(name) and not any(
+            w[0] <= priority and not w[3].done() and self.in_flight[w[2]] < self.classes[w[2]][0]
+            for w in self._waiters
+        ):
+            self._grant(name)
+            return
+        if self.queued[name] >= max_queue:
+            self.rejected[name] += 1
+            raise Rejected(name)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), name, future))
+        self.queued[name] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), self.max_wait)
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # Granted just as the timer fired: hand the slot back
+                self.release(name)
+            future.cancel()
+            self.rejected[name] += 1
+            raise Rejected(name)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(name)
+            future.cancel()
+            raise
+        finally:
+            self.queued[name] -= 1
+
+    def release(self, name):
+        self.in_flight[name] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        skipped = []
+        while self._waiters and self._running() < self.total:
+            waiter = heapq.heappop(self._waiters)
+            priority, _, name, future = waiter
+            if future.done():
+                continue
+            if self.in_flight[name] >= self.classes[name][0]:
+                skipped.append(waiter)
+                continue
+            self._grant(name)
+            future.set_result(True)
+        for waiter in skipped:
+            heapq.heappush(self._waiters, waiter)
+
+    def snapshot(self):
+        return {
+            name: {"in_flight": self.in_flight[name], "queued": self.queued[name], "rejected": self.rejected[name],
+                   "limit": self.classes[name][0], "queue_limit": self.classes[name][1]}
+            for name in self.classes
+        }
+
+class AdmissionMiddleware:
+    def __init__(self, app, controller=None, enabled=ADMISSION_ENABLED):
+        self.app = app
+        self.controller = controller or AdmissionController()
+        self.enabled = enabled
+
+    async def __call__(self, scope, receive, send):
+        if not self.enabled or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        name = classify(scope["method"], scope["path"], scope.get("query_string", b""))
+        if name is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            with span("queue"):
+                await self.controller.acquire(name)
+        except Rejected:
+            await self._reject(send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(name)
+
+    async def _reject(self, send):
+        body = json.dumps({"detail": "الخادم مشغول، حاول مرة أخرى لاحقًا"}, ensure_ascii=False).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": 503,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+                (b"retry-after", str(ADMISSION_RETRY_AFTER_SECONDS).encode()),
+            ],
+        })
+        await send({"type": "http.response.body", "body": body})
+
+admission_controller = AdmissionController()
@@ -0,0 +1,172 @@
+import json
+import queue
+import logging
+import threading
+from datetime import datetime
+from config import (
+    AUDIT_ENABLED, AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_FLUSH_MS, AUDIT_ENQUEUE_TIMEOUT_SECONDS,
+)
+from database import get_db_connection_fastapi
+
+logger = logging.getLogger("audit")
+
+AUDIT_INSERT = "INSERT INTO AuditLog (At, Username, Action, Entity, EntityKey, Details) VALUES (?, ?, ?, ?, ?, ?)"
+
+# Never written to the log
+SECRET_FIELDS = {"Password", "PASS", "EMAIL_PASS"}
+MAX_DETAILS_LENGTH = 4000
+
+# Changed values as compact JSON, without secrets or empty fields
+def compact_details(values):
+    if not values:
+        return None
+    details = json.dumps({k: v for k, v in dict(values).items() if k not in SECRET_FIELDS and v is not None},
+                         ensure_ascii=False, separators=(",", ":"), default=str)
+    return details[:MAX_DETAILS_LENGTH]
+
+# Write-behind audit log: handlers only enqueue a tuple; a background thread batch-inserts
+# them with executemany every AUDIT_FLUSH_MS or AUDIT_BATCH_SIZE events, whichever comes first.
+class AuditLog:
+    def __init__(self, enabled=AUDIT_ENABLED, queue_size=AUDIT_QUEUE_SIZE, batch_size=AUDIT_BATCH_SIZE,
+                 flush_ms=AUDIT_FLUSH_MS, enqueue_timeout=AUDIT_ENQUEUE_TIMEOUT_SECONDS):
+        self.enabled = enabled
+        self.batch_size = batch_size
+        self.flush_ms = flush_ms
+        self.enqueue_timeout = enqueue_timeout
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._conn = None
+        # A batch that failed to insert is retried first on the next flush
+        self._pending = []
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed_batches = 0
+        self.last_flush = None
+        self.last_error = None
+
+    # With a UnitOfWork the event is only queued once the change is committed
+    def record(self, username, action, entity, key=None, details=None, db=None):
+        if not self.enabled:
+            return
+        event = (datetime.now(), username, action, entity, None if key is None else str(key), compact_details(details))
+        if db is None:
+            self._enqueue(event)
+        else:
+            db.on_commit(lambda: self._enqueue(event))
+
+    def _enqueue(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            # Backpressure: flush now and give the writer a moment to make room
+            self._wake.set()
+            try:
+                self._queue.put(event, timeout=self.enqueue_timeout)
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+                logger.warning("audit queue full, dropped %s %s %s", event[2], event[3], event[4])
+                return
+        with self._lock:
+            self.enqueued += 1
+        if self._queue.qsize() >= self.batch_size:
+            self._wake.set()
+
+    def _take(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        if self._conn is None:
+            self._conn = get_db_connection_fastapi(autocommit=False)
+        cursor = self._conn.cursor()
+        cursor.fast_executemany = True
+        try:
+            cursor.executemany(AUDIT_INSERT, batch)
+            self._conn.commit()
+        except Exception:
+            self._reset_connection()
+            raise
+
+    def _reset_connection(self):
+        if self._conn is not None:
+            try:
+                self._conn.rollback()
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+    # Write everything currently queued; stops at the first failure and keeps that batch
+    def flush(self):
+        written = 0
+        while True:
+            batch, self._pending = self._pending or self._take(), []
+            if not batch:
+                break
+            try:
+                self._write(batch)
+            except Exception as e:
+                self._pending = batch
+                with self._lock:
+                    self.failed_batches += 1
+                    self.last_error = str(e)
+                logger.warning("audit flush of %d events failed: %s", len(batch), e)
+                break
+            written += len(batch)
+            with self._lock:
+                self.written += len(batch)
+                self.last_flush = datetime.now().isoformat(timespec="seconds")
+        return written
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_ms / 1000)
+            self._wake.clear()
+            self.flush()
+        # Shutdown: drain what is left
+        self.flush()
+        if self._pending or not self._queue.empty():
+            logger.error("audit log shut down with %d unwritten events", len(self._pending) + self._queue.qsize())
+        self._reset_connection()
+
+    def start(self):
+        if self._thread is not None or not self.enabled:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="audit-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout=timeout)
+        self._thread = None
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "queued": self._queue.qsize(),
+                "capacity": self._queue.maxsize,
+                "pending_retry": len(self._pending),
+                "enqueued": self.enqueued,
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed_batches": self.failed_batches,
+                "last_flush": self.last_flush,
+                "last_error": self.last_error,
+            }
+
+audit_log = AuditLog()
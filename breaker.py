@@ -0,0 +1,127 @@
+import time
+import random
+import logging
+import threading
+from fastapi import HTTPException
+from config import (
+    CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_OPEN_SECONDS, CIRCUIT_HALF_OPEN_CALLS,
+    DB_RETRY_BASE_MS, DB_RETRY_MAX_MS,
+)
+
+logger = logging.getLogger("breaker")
+
+# SQLSTATEs worth retrying on an idempotent read: deadlock victim, connection reset/failure
+TRANSIENT_SQLSTATES = {"40001", "08S01", "08001"}
+
+def sqlstate(error):
+    return error.args[0] if error.args and isinstance(error.args[0], str) else None
+
+def is_transient(error):
+    return sqlstate(error) in TRANSIENT_SQLSTATES
+
+# Only "the server is unreachable/unresponsive" errors trip the breaker, never bad SQL or constraint violations
+def is_outage(error):
+    state = sqlstate(error) or ""
+    return state.startswith("08") or state in ("HYT00", "HYT01")
+
+# Full jitter: spread retries of concurrent requests instead of hammering the server in lockstep
+def backoff_seconds(attempt, base_ms=DB_RETRY_BASE_MS, max_ms=DB_RETRY_MAX_MS):
+    return random.uniform(0, min(max_ms, base_ms * (2 ** attempt))) / 1000
+
+class CircuitOpen(HTTPException):
+    def __init__(self, retry_after):
+        super().__init__(status_code=503, detail="قاعدة البيانات غير متاحة مؤقتًا، حاول لاحقًا",
+                         headers={"Retry-After": str(max(1, int(retry_after + 0.999)))})
+
+# closed -> (N consecutive outage errors) -> open -> (after CIRCUIT_OPEN_SECONDS) -> half_open
+# half_open lets a few trial calls through: one success closes the circuit, one failure re-opens it.
+class CircuitBreaker:
+    def __init__(self, failure_threshold=CIRCUIT_FAILURE_THRESHOLD, open_seconds=CIRCUIT_OPEN_SECONDS,
+                 half_open_calls=CIRCUIT_HALF_OPEN_CALLS):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trials = 0
+        self._half_open_since = None
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self.retries = 0
+        self.opened = 0
+
+    def _open(self, now):
+        if self.state != "open":
+            self.opened += 1
+            logger.warning("database circuit opened after %d consecutive failures", self.consecutive_failures)
+        self.state = "open"
+        self.opened_at = now
+        self._trials = 0
+
+    # Raise CircuitOpen instead of waiting on a server that is known to be down
+    def before_call(self):
+        now = time.monotonic()
+        with self._lock:
+            if self.state == "open":
+                remaining = self.opened_at + self.open_seconds - now
+                if remaining > 0:
+                    self.rejected += 1
+                    raise CircuitOpen(remaining)
+                self.state = "half_open"
+                self._trials = 0
+                self._half_open_since = now
+            if self.state == "half_open":
+                if self._trials >= self.half_open_calls:
+                    # A trial that never reported back must not keep the circuit half open forever
+                    if now - self._half_open_since < self.open_seconds:
+                        self.rejected += 1
+                        raise CircuitOpen(1)
+                    self._trials = 0
+                    self._half_open_since = now
+                self._trials += 1
+            self.calls += 1
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info("database circuit closed")
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self._trials = 0
+
+    def record_failure(self, error):
+        if not is_outage(error):
+            # The server answered: it is up, whatever the error was
+            self.record_success()
+            return
+        with self._lock:
+            self.failures += 1
+            self.consecutive_failures += 1
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                self._open(time.monotonic())
+
+    def record_retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def snapshot(self):
+        with self._lock:
+            open_for = None
+            if self.state == "open":
+                open_for = max(0.0, round(self.opened_at + self.open_seconds - time.monotonic(), 3))
+            return {
+                "state": self.state,
+                "consecutive_failures": self.consecutive_failures,
+                "failure_threshold": self.failure_threshold,
+                "open_seconds_remaining": open_for,
+                "calls": self.calls,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "retries": self.retries,
+                "opened": self.opened,
+            }
+
+db_breaker = CircuitBreaker()
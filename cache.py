@@ -0,0 +1,155 @@
+import time
+import logging
+import threading
+import pyodbc
+from config import CACHE_BUS_POLL_SECONDS
+from database import get_db_connection_fastapi
+
+logger = logging.getLogger("cache")
+
+# Small thread-safe TTL cache (one per concern: auth, pages, lists)
+class TTLCache:
+    def __init__(self, ttl_seconds, max_entries=1024):
+        self.ttl = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if len(self._data) >= self.max_entries:
+                self._data.clear()
+            self._data[key] = (value, time.monotonic() + self.ttl)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+# Cross-worker invalidation through a version table in SQL Server: publish() bumps the
+# version of a cache name, every worker polls the table and clears caches whose version moved.
+class InvalidationBus:
+    def __init__(self, poll_seconds=CACHE_BUS_POLL_SECONDS):
+        self.poll_seconds = poll_seconds
+        self._listeners = {}
+        self._remote_listeners = {}
+        self._versions = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # remote_only: for caches the writing worker already updated itself (write-through),
+    # called only when another worker published the change
+    def register(self, name, callback, remote_only=False):
+        (self._remote_listeners if remote_only else self._listeners).setdefault(name, []).append(callback)
+
+    def _invalidate_local(self, name, remote=False):
+        callbacks = self._listeners.get(name, []) + (self._remote_listeners.get(name, []) if remote else [])
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning("cache listener for %s failed: %s", name, e)
+
+    # Our own bump must not look like another worker's change on the next poll
+    def _seen_own(self, name, version):
+        if version is None:
+            return
+        with self._lock:
+            if self._versions.get(name) == version - 1:
+                self._versions[name] = version
+
+    # With a UnitOfWork the version bump joins its transaction and local caches clear after commit
+    def publish(self, name, db=None):
+        if db is None:
+            conn = get_db_connection_fastapi()
+            try:
+                version = self._bump(conn.cursor(), name)
+            finally:
+                conn.close()
+            self._seen_own(name, version)
+            self._invalidate_local(name)
+        else:
+            version = self._bump(db.cursor(), name)
+            db.on_commit(lambda: (self._seen_own(name, version), self._invalidate_local(name)))
+
+    # MERGE under HOLDLOCK is one atomic upsert: two workers publishing a new name at the same
+    # moment cannot both insert it. The bootstrap seeds the known names anyway (CACHE_BUS_NAMES).
+    def _bump(self, cursor, name, retries=1):
+        try:
+            cursor.execute("""
+                MERGE CacheVersions WITH (HOLDLOCK) AS t
+                USING (SELECT ? AS Name) AS s ON t.Name = s.Name
+                WHEN MATCHED THEN UPDATE SET Version = t.Version + 1
+                WHEN NOT MATCHED THEN INSERT (Name, Version) VALUES (s.Name, 1)
+                OUTPUT INSERTED.Version;
+            """, (name,))
+        except pyodbc.IntegrityError:
+            # A key conflict only means another worker created the row first: bump it again
+            if retries <= 0:
+                raise
+            return self._bump(cursor, name, retries - 1)
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def poll_once(self):
+        conn = get_db_connection_fastapi()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT Name, Version FROM CacheVersions")
+            changed = []
+            with self._lock:
+                for name, version in cursor.fetchall():
+                    seen = self._versions.get(name)
+                    self._versions[name] = version
+                    # First sight only records the baseline
+                    if seen is not None and seen != version:
+                        changed.append(name)
+            for name in changed:
+                self._invalidate_local(name, remote=True)
+        finally:
+            conn.close()
+
+    def _run(self):
+        while not self._stop.wait(self.poll_seconds):
+            try:
+                self.poll_once()
+            except Exception as e:
+                logger.warning("cache bus poll failed: %s", e)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        try:
+            self.poll_once()
+        except Exception as e:
+            logger.warning("cache bus initial poll failed: %s", e)
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="cache-bus", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.poll_seconds + 1)
+            self._thread = None
+
+auth_cache = TTLCache(ttl_seconds=60)
+page_cache = TTLCache(ttl_seconds=300, max_entries=64)
+list_cache = TTLCache(ttl_seconds=300, max_entries=64)
+
+bus = InvalidationBus()
+bus.register("auth", auth_cache.clear)
+# The login page embeds the user list
+bus.register("auth", page_cache.clear)
+bus.register("lists", list_cache.clear)
@@ -0,0 +1,142 @@
+import gzip
+import zlib
+from config import COMPRESSION_MIN_SIZE, COMPRESSION_GZIP_LEVEL, COMPRESSION_BROTLI_QUALITY, COMPRESSIBLE_TYPES
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; fall back to gzip only
+    brotli = None
+
+# Pick the best encoding the client accepts ("br" > "gzip"), honouring q=0
+def choose_encoding(accept_encoding, available=None):
+    if available is None:
+        available = ("br", "gzip") if brotli is not None else ("gzip",)
+    accepted = {}
+    for part in accept_encoding.split(","):
+        token, _, params = part.strip().partition(";")
+        token = token.strip().lower()
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if token:
+            accepted[token] = quality
+    for encoding in available:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+def is_compressible(content_type):
+    return content_type.split(";")[0].strip().lower().startswith(COMPRESSIBLE_TYPES)
+
+class _GzipStream:
+    def __init__(self, level=COMPRESSION_GZIP_LEVEL):
+        # wbits=31 -> gzip container
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def process(self, data):
+        return self._compressor.compress(data)
+
+    def finish(self):
+        return self._compressor.flush()
+
+class _BrotliStream:
+    def __init__(self, quality=COMPRESSION_BROTLI_QUALITY):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def process(self, data):
+        return self._compressor.process(data)
+
+    def finish(self):
+        return self._compressor.finish()
+
+def compress_bytes(data, encoding, gzip_level=9, brotli_quality=11):
+    if encoding == "br":
+        return brotli.compress(data, quality=brotli_quality)
+    return gzip.compress(data, compresslevel=gzip_level, mtime=0)
+
+# Compresses JSON/CSV/HTML responses above COMPRESSION_MIN_SIZE with br or gzip.
+# Bodies are buffered only until the threshold is reached, then compressed as a stream.
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size=COMPRESSION_MIN_SIZE, exclude_prefixes=("/static",)):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.exclude_prefixes = exclude_prefixes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.exclude_prefixes):
+            await self.app(scope, receive, send)
+            return
+        accept = ""
+        ranged = False
+        for key, value in scope.get("headers", []):
+            if key == b"accept-encoding":
+                accept = value.decode("latin-1")
+            elif key == b"range":
+                ranged = True
+        encoding = choose_encoding(accept)
+        # Range offsets refer to the identity body (resumable downloads): never compress those
+        if encoding is None or ranged:
+            await self.app(scope, receive, send)
+            return
+
+        state = {"start": None, "buffer": b"", "stream": None, "passthrough": False}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = {k.lower(): v for k, v in message.get("headers", [])}
+                content_type = headers.get(b"content-type", b"").decode("latin-1")
+                if (b"content-encoding" in headers or b"content-range" in headers or message["status"] in (204, 206, 304)
+                        or message["status"] < 200 or not is_compressible(content_type)):
+                    state["passthrough"] = True
+                    await send(message)
+                else:
+                    state["start"] = message
+                return
+            if message["type"] != "http.response.body" or state["passthrough"]:
+                await send(message)
+                return
+
+            more_body = message.get("more_body", False)
+            if state["stream"] is None:
+                state["buffer"] += message.get("body", b"")
+                if len(state["buffer"]) < self.minimum_size:
+                    if more_body:
+                        return
+                    # Too small to be worth it: send as-is
+                    await send(state["start"])
+                    await send({"type": "http.response.body", "body": state["buffer"]})
+                    return
+                state["stream"] = _BrotliStream() if encoding == "br" else _GzipStream()
+                start = state["start"]
+                headers = []
+                for k, v in start.get("headers", []):
+                    if k.lower() == b"content-length":
+                        continue
+                    # The encoded body is not byte-identical to the original: a strong ETag would lie
+                    if k.lower() == b"etag" and not v.startswith(b"W/"):
+                        v = b"W/" + v
+                    headers.append((k, v))
+                headers.append((b"content-encoding", encoding.encode()))
+                headers.append((b"vary", b"Accept-Encoding"))
+                if not more_body:
+                    body = state["stream"].process(state["buffer"]) + state["stream"].finish()
+                    headers.append((b"content-length", str(len(body)).encode()))
+                    await send(dict(start, headers=headers))
+                    await send({"type": "http.response.body", "body": body})
+                    return
+                await send(dict(start, headers=headers))
+                chunk = state["stream"].process(state["buffer"])
+                state["buffer"] = b""
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                return
+
+            chunk = state["stream"].process(message.get("body", b""))
+            if not more_body:
+                chunk += state["stream"].finish()
+            await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
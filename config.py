@@ -0,0 +1,143 @@
+import os
+
+# ==== إعدادات التطبيق (تقرأ من متغيرات البيئة) ====
+def env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value not in (None, "") else default
+
+def env_float(name, default):
+    value = os.environ.get(name)
+    return float(value) if value not in (None, "") else default
+
+def env_bool(name, default=False):
+    value = os.environ.get(name)
+    if value in (None, ""):
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+# Query statistics / slow-query log
+SLOW_QUERY_MS = env_float("SLOW_QUERY_MS", 250.0)
+QUERY_STATS_MAX_FINGERPRINTS = env_int("QUERY_STATS_MAX_FINGERPRINTS", 500)
+
+# Number of uvicorn worker processes (each has its own connections, caches and admission limits)
+WEB_CONCURRENCY = env_int("WEB_CONCURRENCY", 1)
+
+# The ADMISSION_* limits are for the whole app; each worker enforces its share
+def per_worker(limit):
+    return max(1, -(-limit // WEB_CONCURRENCY))
+
+# Admission control: (max concurrent, max queued, priority - lower runs first)
+ADMISSION_ENABLED = env_bool("ADMISSION_ENABLED", True)
+ADMISSION_TOTAL_CONCURRENCY = per_worker(env_int("ADMISSION_TOTAL_CONCURRENCY", 16))
+ADMISSION_MAX_WAIT_SECONDS = env_float("ADMISSION_MAX_WAIT_SECONDS", 5.0)
+ADMISSION_RETRY_AFTER_SECONDS = env_int("ADMISSION_RETRY_AFTER_SECONDS", 2)
+ADMISSION_CLASSES = {
+    "write": (per_worker(env_int("ADMISSION_WRITE_CONCURRENCY", 8)), per_worker(env_int("ADMISSION_WRITE_QUEUE", 64)), 0),
+    "page": (per_worker(env_int("ADMISSION_PAGE_CONCURRENCY", 8)), per_worker(env_int("ADMISSION_PAGE_QUEUE", 64)), 1),
+    "read": (per_worker(env_int("ADMISSION_READ_CONCURRENCY", 6)), per_worker(env_int("ADMISSION_READ_QUEUE", 32)), 2),
+    "search": (per_worker(env_int("ADMISSION_SEARCH_CONCURRENCY", 4)), per_worker(env_int("ADMISSION_SEARCH_QUEUE", 8)), 3),
+}
+# HTML pages served by the app; everything else under GET is a data read
+ADMISSION_PAGE_PATHS = ("/", "/login", "/users", "/manage", "/serverip", "/custserver")
+# Never throttled (static assets and health checks do not touch SQL Server)
+ADMISSION_EXEMPT_PREFIXES = ("/static", "/health")
+
+# Response compression (dynamic responses) and precompressed static assets
+COMPRESSION_MIN_SIZE = env_int("COMPRESSION_MIN_SIZE", 1024)
+COMPRESSION_GZIP_LEVEL = env_int("COMPRESSION_GZIP_LEVEL", 6)
+COMPRESSION_BROTLI_QUALITY = env_int("COMPRESSION_BROTLI_QUALITY", 5)
+COMPRESSIBLE_TYPES = ("text/", "application/json", "application/javascript", "image/svg+xml")
+STATIC_SOURCE_DIR = os.environ.get("STATIC_SOURCE_DIR", "static")
+STATIC_BUILD_DIR = os.environ.get("STATIC_BUILD_DIR", "static_build")
+
+# Multi-worker mode: cache invalidation bus polling interval
+CACHE_BUS_POLL_SECONDS = env_float("CACHE_BUS_POLL_SECONDS", 1.0)
+
+# SERVERIP reachability prober
+PROBE_ENABLED = env_bool("PROBE_ENABLED", True)
+PROBE_PORTS = tuple(int(p) for p in os.environ.get("PROBE_PORTS", "1433,3389").split(",") if p.strip())
+PROBE_TIMEOUT_SECONDS = env_float("PROBE_TIMEOUT_SECONDS", 1.5)
+PROBE_CONCURRENCY = env_int("PROBE_CONCURRENCY", 100)
+PROBE_INTERVAL_SECONDS = env_float("PROBE_INTERVAL_SECONDS", 60.0)
+PROBE_HISTORY = env_int("PROBE_HISTORY", 20)
+# One worker holds the prober lease and sweeps; the others read its results from ServerStatus
+PROBE_LEASE_SECONDS = env_float("PROBE_LEASE_SECONDS", PROBE_INTERVAL_SECONDS * 3)
+
+# Background jobs (exports/imports)
+JOB_WORKERS = env_int("JOB_WORKERS", 2)
+JOB_MAX_PENDING = env_int("JOB_MAX_PENDING", 20)
+JOB_SPOOL_DIR = os.environ.get("JOB_SPOOL_DIR", "spool")
+JOB_RESULT_TTL_SECONDS = env_int("JOB_RESULT_TTL_SECONDS", 3600)
+JOB_CLEANUP_INTERVAL_SECONDS = env_int("JOB_CLEANUP_INTERVAL_SECONDS", 300)
+JOB_BATCH_SIZE = env_int("JOB_BATCH_SIZE", 5000)
+
+# Paged list endpoints (virtualized tables): largest page a client may ask for
+LIST_PAGE_MAX = env_int("LIST_PAGE_MAX", 1000)
+
+# Write-behind audit log: bounded queue, flushed in batches every N ms or N events
+AUDIT_ENABLED = env_bool("AUDIT_ENABLED", True)
+AUDIT_QUEUE_SIZE = env_int("AUDIT_QUEUE_SIZE", 10000)
+AUDIT_BATCH_SIZE = env_int("AUDIT_BATCH_SIZE", 200)
+AUDIT_FLUSH_MS = env_int("AUDIT_FLUSH_MS", 500)
+# How long a request may wait for room in a full queue before the event is dropped
+AUDIT_ENQUEUE_TIMEOUT_SECONDS = env_float("AUDIT_ENQUEUE_TIMEOUT_SECONDS", 0.2)
+
+# Duplicate-customer detection (blocking-key index over normalized names/phone/tax number)
+DEDUPE_ENABLED = env_bool("DEDUPE_ENABLED", True)
+DEDUPE_THRESHOLD = env_float("DEDUPE_THRESHOLD", 0.85)
+DEDUPE_MAX_RESULTS = env_int("DEDUPE_MAX_RESULTS", 5)
+# Blocks bigger than this (e.g. a very common first name) are not used to pick candidates
+DEDUPE_MAX_BLOCK = env_int("DEDUPE_MAX_BLOCK", 500)
+
+# Database circuit breaker and bounded retries for transient errors on reads
+DB_LOGIN_TIMEOUT_SECONDS = env_int("DB_LOGIN_TIMEOUT_SECONDS", 5)
+CIRCUIT_FAILURE_THRESHOLD = env_int("CIRCUIT_FAILURE_THRESHOLD", 5)
+CIRCUIT_OPEN_SECONDS = env_float("CIRCUIT_OPEN_SECONDS", 10.0)
+CIRCUIT_HALF_OPEN_CALLS = env_int("CIRCUIT_HALF_OPEN_CALLS", 1)
+DB_RETRY_ATTEMPTS = env_int("DB_RETRY_ATTEMPTS", 2)
+DB_RETRY_BASE_MS = env_int("DB_RETRY_BASE_MS", 50)
+DB_RETRY_MAX_MS = env_int("DB_RETRY_MAX_MS", 500)
+
+# Per-request phase timing: Server-Timing header, plus sampled JSON trace records
+SERVER_TIMING_ENABLED = env_bool("SERVER_TIMING_ENABLED", True)
+TRACE_FILE = os.environ.get("TRACE_FILE", "traces.jsonl")
+# Fraction of requests written to TRACE_FILE (0 = none); requests slower than TRACE_SLOW_MS are always written (0 = off)
+TRACE_SAMPLE_RATE = env_float("TRACE_SAMPLE_RATE", 0.0)
+TRACE_SLOW_MS = env_float("TRACE_SLOW_MS", 0.0)
+TRACE_MAX_EVENTS = env_int("TRACE_MAX_EVENTS", 200)
+# Trace records waiting for the writer thread; more than this are dropped
+TRACE_MAX_QUEUED = env_int("TRACE_MAX_QUEUED", 10000)
+
+# In-memory read model of SERVERIP and CUSTSERVER (small, read-mostly): loaded at startup,
+# updated write-through by the CRUD handlers and fully reloaded every N seconds to catch drift
+READ_MODEL_ENABLED = env_bool("READ_MODEL_ENABLED", True)
+READ_MODEL_RECONCILE_SECONDS = env_float("READ_MODEL_RECONCILE_SECONDS", 60.0)
+# Filtered/sorted/searched lists scan every row: above READ_MODEL_SCAN_MAX_ROWS they go to SQL
+# (indexed), above READ_MODEL_INLINE_ROWS the scan runs in the threadpool instead of on the event loop
+READ_MODEL_SCAN_MAX_ROWS = env_int("READ_MODEL_SCAN_MAX_ROWS", 20000)
+READ_MODEL_INLINE_ROWS = env_int("READ_MODEL_INLINE_ROWS", 2000)
+
+# Request deadlines: each statement gets at most the time the request has left (pyodbc query
+# timeout), so slow queries end as 504s instead of holding a connection
+REQUEST_TIMEOUT_SECONDS = env_float("REQUEST_TIMEOUT_SECONDS", 30.0)
+# Tighter (or looser) budgets per path prefix; the longest matching prefix wins
+ROUTE_TIMEOUTS = {
+    "/customers": env_float("CUSTOMERS_TIMEOUT_SECONDS", 10.0),
+    "/custserver/stats": env_float("CUSTSERVER_STATS_TIMEOUT_SECONDS", 10.0),
+    "/audit": env_float("AUDIT_TIMEOUT_SECONDS", 15.0),
+    "/health": env_float("HEALTH_TIMEOUT_SECONDS", 5.0),
+    "/export": env_float("EXPORT_TIMEOUT_SECONDS", 120.0),
+    "/debug": env_float("DEBUG_TIMEOUT_SECONDS", 60.0),
+}
+# How often a running read checks whether the client went away (then the statement is cancelled)
+DISCONNECT_POLL_SECONDS = env_float("DISCONNECT_POLL_SECONDS", 0.25)
+
+# On-demand sampling profiler (/debug/profile): hard caps so it is safe under live load
+PROFILER_DEFAULT_INTERVAL_MS = env_int("PROFILER_DEFAULT_INTERVAL_MS", 10)
+PROFILER_MIN_INTERVAL_MS = env_int("PROFILER_MIN_INTERVAL_MS", 5)
+PROFILER_MAX_SECONDS = env_float("PROFILER_MAX_SECONDS", 60.0)
+PROFILER_MAX_REQUESTS = env_int("PROFILER_MAX_REQUESTS", 500)
+# Share of wall time the sampler may spend walking stacks; it backs off to stay under it
+PROFILER_MAX_OVERHEAD = env_float("PROFILER_MAX_OVERHEAD", 0.02)
+PROFILER_MAX_STACKS = env_int("PROFILER_MAX_STACKS", 10000)
+PROFILER_MAX_DEPTH = env_int("PROFILER_MAX_DEPTH", 100)
@@ -1,8 +1,15 @@
 
+import re
+import asyncio
 import pyodbc
 import hashlib
 from fastapi import HTTPException
 from cryptography.fernet import Fernet
+from querylog import TrackedConnection
+from breaker import db_breaker, is_outage, is_transient, backoff_seconds
+from tracing import span
+from deadline import statement_timeout, fetch_all
+from config import DB_LOGIN_TIMEOUT_SECONDS, DB_RETRY_ATTEMPTS
 
 # ==== قراءة المفتاح من الملف ====
 def load_key():
@@ -20,18 +27,102 @@ DATABASE = 'gAAAAABonaJxLZBL6H01ESHGQSI8XD4GZ3PGyjXY0ZluYstTvUvYrJTyoyuB8cEFLyVG
 USERNAME = 'gAAAAABonaJxup28dxySUcFWGptC9lQBGXzA6nP2kWUr07Sb9KpmeKzovxizL2ZRtTnRGOv-VfIPUm_zrj6jAuA920JrOxPVHw=='
 PASSWORD = 'gAAAAABonaJxhDZfv1WEqMYKV69GtnxsXJ6Evd7UxyD0L40fwmTMKCes2M9at-iCUOWjpjWIrRpYpPAfVX2HfKJ52qMLAFrgfDrvyZIoygP9JPPPdpMK0ZM='
 # ==== الاتصال بقاعدة البيانات ====
-def get_db_connection_fastapi(create_db=False):
+def get_db_connection_fastapi(create_db=False, autocommit=True):
     conn_str = f'DRIVER={{ODBC Driver 17 for SQL Server}};' \
                f'SERVER={decrypt_data(SERVER_FASTAPI)};' \
                f'UID={decrypt_data(USERNAME)};' \
                f'PWD={decrypt_data(PASSWORD)};'
     if not create_db:
         conn_str += f'DATABASE={decrypt_data(DATABASE)};'
+    # Fail fast while the circuit is open instead of waiting for the login timeout on every request
+    db_breaker.before_call()
     try:
-        conn = pyodbc.connect(conn_str, autocommit=True)
-        return conn
+        with span("connect"):
+            conn = pyodbc.connect(conn_str, autocommit=autocommit, timeout=DB_LOGIN_TIMEOUT_SECONDS)
     except pyodbc.Error as e:
-        raise HTTPException(status_code=500, detail=f"Database connection failed: {str(e)}")
+        db_breaker.record_failure(e)
+        raise HTTPException(status_code=503 if is_outage(e) else 500, detail=f"Database connection failed: {str(e)}")
+    db_breaker.record_success()
+    return TrackedConnection(conn)
+
+# ==== اتصال واحد ومعاملة واحدة لكل طلب ====
+# Opened lazily on first cursor(), so requests answered from caches never connect.
+class UnitOfWork:
+    def __init__(self):
+        self._conn = None
+        self._on_commit = []
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = get_db_connection_fastapi(autocommit=False)
+        return self._conn
+
+    # pyodbc applies the connection's timeout to cursors created after it is set, so each
+    # cursor gets the time the request has left
+    def cursor(self):
+        conn = self.conn
+        conn.timeout = statement_timeout()
+        return conn.cursor()
+
+    # Idempotent reads only: a deadlock victim or dropped connection is retried on a fresh
+    # connection after a jittered backoff. Never use it after a write in the same request.
+    # Runs off the event loop and is cancelled if the client disconnects.
+    async def read(self, sql, params=(), retries=DB_RETRY_ATTEMPTS):
+        attempt = 0
+        while True:
+            try:
+                cursor = self.cursor()
+                return await fetch_all(cursor, sql, params)
+            except pyodbc.Error as e:
+                if attempt >= retries or not is_transient(e):
+                    raise
+                db_breaker.record_retry()
+                self._discard()
+                await asyncio.sleep(backoff_seconds(attempt))
+                attempt += 1
+
+    def _discard(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except pyodbc.Error:
+                pass
+            self._conn = None
+
+    # Run callback only once the transaction is committed (e.g. cache invalidation)
+    def on_commit(self, callback):
+        self._on_commit.append(callback)
+
+    def commit(self):
+        if self._conn is not None:
+            with span("commit"):
+                self._conn.commit()
+        callbacks, self._on_commit = self._on_commit, []
+        for callback in callbacks:
+            callback()
+
+    def rollback(self):
+        self._on_commit = []
+        if self._conn is not None:
+            self._conn.rollback()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+# FastAPI dependency: commit once when the handler succeeds, roll back on any exception (incl. HTTPException)
+def get_db():
+    db = UnitOfWork()
+    try:
+        yield db
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
 
 # ==== إنشاء قاعدة البيانات والجداول ====
 def create_database_and_table_fastapi():
@@ -109,9 +200,236 @@ def create_database_and_table_fastapi():
         )
     """)
 
+    # عمود محسوب للجزء الرقمي من رقم العميل + الفهارس
+    create_indexes_fastapi(cursor)
+
+    # إحصائيات CUSTSERVER لكل سيرفر (indexed view)
+    create_custserver_stats_view(cursor)
+
+    # ربط صفوف CUSTSERVER الجديدة بالعملاء بالاسم
+    link_custserver_customers(cursor)
+
+    # جدول إصدارات الكاش (لإبطال الكاش بين العمليات/الـ workers)
+    cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'CacheVersions')
+        CREATE TABLE CacheVersions (
+            Name VARCHAR(50) PRIMARY KEY,
+            Version BIGINT NOT NULL
+        )
+    """)
+    for name in CACHE_BUS_NAMES:
+        cursor.execute("""
+            IF NOT EXISTS (SELECT * FROM CacheVersions WHERE Name = ?)
+            INSERT INTO CacheVersions (Name, Version) VALUES (?, 0)
+        """, (name, name))
+
+    # حالة الوصول للسيرفرات (يكتبها worker واحد ويقرأها الباقون)
+    cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'ServerStatus')
+        CREATE TABLE ServerStatus (
+            IP VARCHAR(50) PRIMARY KEY,
+            Reachable BIT NOT NULL,
+            OpenPorts NVARCHAR(400) NULL,
+            LatencyMs FLOAT NULL,
+            Error NVARCHAR(1000) NULL,
+            CheckedAt FLOAT NOT NULL,
+            History NVARCHAR(MAX) NULL
+        )
+    """)
+
+    # عقود الإيجار (اختيار worker واحد لمهمة دورية)
+    cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'Leases')
+        CREATE TABLE Leases (
+            Name VARCHAR(50) PRIMARY KEY,
+            Holder VARCHAR(100) NOT NULL,
+            ExpiresAt DATETIME2(3) NOT NULL,
+            Info NVARCHAR(MAX) NULL
+        )
+    """)
+
+    # سجل التدقيق (من غيّر ماذا ومتى)
+    cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.tables WHERE name = 'AuditLog')
+        BEGIN
+            CREATE TABLE AuditLog (
+                ID BIGINT PRIMARY KEY IDENTITY(1,1),
+                At DATETIME2(3) NOT NULL,
+                Username NVARCHAR(50) NOT NULL,
+                Action VARCHAR(10) NOT NULL,
+                Entity VARCHAR(20) NOT NULL,
+                EntityKey NVARCHAR(100) NULL,
+                Details NVARCHAR(4000) NULL
+            )
+            CREATE INDEX IX_AuditLog_Entity ON AuditLog (Entity, EntityKey) INCLUDE (At)
+            CREATE INDEX IX_AuditLog_Username ON AuditLog (Username) INCLUDE (At)
+        END
+    """)
+
     conn.commit()
     conn.close()
 
+# Every name published on the cache bus; seeded in CacheVersions so publishing never has to create a row
+CACHE_BUS_NAMES = ("auth", "lists", "customers", "custserver")
+
+# ==== عقود الإيجار ====
+# Take or renew a named lease; True while this holder owns it. A holder that stops renewing
+# (crashed/stopped worker) loses it once ExpiresAt passes, and another worker takes over.
+def acquire_lease(name, holder, seconds):
+    conn = get_db_connection_fastapi()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            MERGE Leases WITH (HOLDLOCK) AS t
+            USING (SELECT ? AS Name) AS s ON t.Name = s.Name
+            WHEN MATCHED AND (t.Holder = ? OR t.ExpiresAt < SYSUTCDATETIME()) THEN
+                UPDATE SET Holder = ?, ExpiresAt = DATEADD(millisecond, ?, SYSUTCDATETIME())
+            WHEN NOT MATCHED THEN
+                INSERT (Name, Holder, ExpiresAt) VALUES (s.Name, ?, DATEADD(millisecond, ?, SYSUTCDATETIME()))
+            OUTPUT INSERTED.Holder;
+        """, (name, holder, holder, int(seconds * 1000), holder, int(seconds * 1000)))
+        row = cursor.fetchone()
+        return row is not None and row[0] == holder
+    finally:
+        conn.close()
+
+# ==== الفهارس المدارة ====
+# Numeric part of CUSTnnnn, persisted so MAX() for the next number is an index seek
+CUSTOMER_SEQ_COLUMN = """
+    IF NOT EXISTS (SELECT * FROM sys.columns WHERE Name = N'CustomerSeq' AND Object_ID = Object_ID(N'Customers'))
+    ALTER TABLE Customers ADD CustomerSeq AS
+        (CASE WHEN CustomerNumber LIKE 'CUST%' THEN TRY_CAST(SUBSTRING(CustomerNumber, 5, 20) AS INT) END) PERSISTED
+"""
+
+# Bumped by SQL Server on every insert/update, so other workers can pick up just the changed rows
+# (duplicate index for Customers, read model for SERVERIP/CUSTSERVER)
+ROWVERSION_TABLES = ("Customers", "SERVERIP", "CUSTSERVER")
+ROWVERSION_COLUMN = """
+    IF NOT EXISTS (SELECT * FROM sys.columns WHERE Name = N'RowVer' AND Object_ID = Object_ID(N'{table}'))
+    ALTER TABLE {table} ADD RowVer ROWVERSION
+"""
+
+# CUSTSERVER -> Customers link (CustomerName stays as free text); deleting a customer unlinks its rows
+CUSTSERVER_CUSTOMER_COLUMN = """
+    IF NOT EXISTS (SELECT * FROM sys.columns WHERE Name = N'CustomerID' AND Object_ID = Object_ID(N'CUSTSERVER'))
+    ALTER TABLE CUSTSERVER ADD CustomerID INT NULL
+"""
+CUSTSERVER_CUSTOMER_FK = """
+    IF NOT EXISTS (SELECT * FROM sys.foreign_keys WHERE name = 'FK_CUSTSERVER_Customers')
+    ALTER TABLE CUSTSERVER ADD CONSTRAINT FK_CUSTSERVER_Customers
+        FOREIGN KEY (CustomerID) REFERENCES Customers(ID) ON DELETE SET NULL
+"""
+
+# (index name, table, definition) - created only when missing
+MANAGED_INDEXES = [
+    ("IX_Customers_CustomerSeq", "Customers", "(CustomerSeq)"),
+    ("IX_Customers_Name", "Customers", "(Name) INCLUDE (CustomerNumber)"),
+    # Duplicate index / read model catch-up: rows changed since the last sync
+    ("IX_Customers_RowVer", "Customers", "(RowVer)"),
+    ("IX_SERVERIP_RowVer", "SERVERIP", "(RowVer)"),
+    ("IX_CUSTSERVER_RowVer", "CUSTSERVER", "(RowVer)"),
+    ("IX_SERVERIP_USER", "SERVERIP", "([USER])"),
+    ("IX_CUSTSERVER_GlobalServerIP", "CUSTSERVER", "(GlobalServerIP) INCLUDE ([Number])"),
+    ("IX_CUSTSERVER_CustomerName", "CUSTSERVER", "(CustomerName) INCLUDE (ServerName)"),
+    ("IX_CUSTSERVER_ServerName", "CUSTSERVER", "(ServerName) INCLUDE (CustomerName)"),
+    # Filter DSL: ConnectionType/LinkOrNot equality filters and ConnectedDevices ranges
+    ("IX_CUSTSERVER_ConnectionType", "CUSTSERVER", "(ConnectionType, LinkOrNot) INCLUDE (ConnectedDevices)"),
+    ("IX_CUSTSERVER_ConnectedDevices", "CUSTSERVER", "(ConnectedDevices)"),
+    # Customer overview: all of a customer's CUSTSERVER rows from one seek
+    ("IX_CUSTSERVER_CustomerID", "CUSTSERVER", "(CustomerID) INCLUDE (LinkOrNot, [Number], GlobalServerIP, ServerName, DatabaseName, ConnectionType, ConnectedDevices, Notes)"),
+]
+
+def create_indexes_fastapi(cursor):
+    cursor.execute(CUSTOMER_SEQ_COLUMN)
+    for table in ROWVERSION_TABLES:
+        cursor.execute(ROWVERSION_COLUMN.format(table=table))
+    cursor.execute(CUSTSERVER_CUSTOMER_COLUMN)
+    cursor.execute(CUSTSERVER_CUSTOMER_FK)
+    for name, table, definition in MANAGED_INDEXES:
+        cursor.execute(f"""
+            IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = '{name}' AND object_id = OBJECT_ID(N'{table}'))
+            CREATE NONCLUSTERED INDEX {name} ON {table} {definition}
+        """)
+
+# ==== ربط CUSTSERVER بالعملاء ====
+# Set-based pass: unlinked rows whose CustomerName is exactly one customer's name.
+# Spelling variants are left to the "link_customers" job, which matches normalized names.
+def link_custserver_customers(cursor):
+    cursor.execute("""
+        UPDATE cs SET CustomerID = c.ID
+        FROM CUSTSERVER cs
+        JOIN (SELECT Name, MIN(ID) AS ID FROM Customers GROUP BY Name HAVING COUNT(*) = 1) c
+            ON c.Name = LTRIM(RTRIM(cs.CustomerName))
+        WHERE cs.CustomerID IS NULL
+    """)
+    return cursor.rowcount
+
+# ==== إحصائيات CUSTSERVER المجمعة ====
+# Indexed view: SQL Server maintains the aggregates inside the same transaction as every
+# INSERT/UPDATE/DELETE on CUSTSERVER, so reading them is O(servers x connection types).
+CUSTSERVER_STATS_VIEW = """
+    CREATE VIEW dbo.CUSTSERVER_STATS WITH SCHEMABINDING AS
+    SELECT GlobalServerIP, ConnectionType,
+           COUNT_BIG(*) AS RowCnt,
+           SUM(ISNULL(CAST(LinkOrNot AS INT), 0)) AS LinkedCount,
+           SUM(ISNULL(CAST(ConnectedDevices AS BIGINT), 0)) AS DevicesSum
+    FROM dbo.CUSTSERVER
+    GROUP BY GlobalServerIP, ConnectionType
+"""
+
+def create_custserver_stats_view(cursor):
+    cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.views WHERE name = 'CUSTSERVER_STATS')
+        EXEC(?)
+    """, (CUSTSERVER_STATS_VIEW,))
+    cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_CUSTSERVER_STATS' AND object_id = OBJECT_ID(N'CUSTSERVER_STATS'))
+        CREATE UNIQUE CLUSTERED INDEX IX_CUSTSERVER_STATS ON dbo.CUSTSERVER_STATS (GlobalServerIP, ConnectionType)
+    """)
+
+# ==== تقرير تكلفة الاستعلامات قبل/بعد الفهارس ====
+# {hint} is replaced by WITH (INDEX(0)) to estimate the cost without the managed indexes
+INDEX_REPORT_QUERIES = {
+    "next_customer_number": "SELECT MAX(CustomerSeq) FROM Customers {hint}",
+    "customers_search": """
+        SELECT ID, CustomerNumber, Name, Phone, Email, Address, TaxNumber, NationalAddress
+        FROM Customers {hint} WHERE Name LIKE N'%a%' OR CustomerNumber LIKE '%a%'
+    """,
+    "serverip_search": "SELECT IP, [USER], [PASS], SERVER_EMAIL, EMAIL_PASS FROM SERVERIP {hint} WHERE IP LIKE '%a%' OR [USER] LIKE '%a%'",
+    "custserver_count_per_ip": "SELECT COUNT(*) FROM CUSTSERVER {hint} WHERE GlobalServerIP = '0.0.0.0'",
+    "custserver_search": """
+        SELECT ID, CustomerName, LinkOrNot, [Number], GlobalServerIP, ServerName, DatabaseName, ConnectionType, ConnectedDevices, Notes
+        FROM CUSTSERVER {hint} WHERE CustomerName LIKE N'%a%' OR ServerName LIKE N'%a%'
+    """,
+}
+
+_SUBTREE_COST = re.compile(r'StatementSubTreeCost="([0-9.Ee+-]+)"')
+
+def _estimated_cost(cursor, sql):
+    cursor.execute(sql)
+    plan = cursor.fetchone()[0]
+    return sum(float(cost) for cost in _SUBTREE_COST.findall(plan))
+
+def index_cost_report():
+    conn = get_db_connection_fastapi()
+    cursor = conn.cursor()
+    report = []
+    try:
+        cursor.execute("SET SHOWPLAN_XML ON")
+        for name, sql in INDEX_REPORT_QUERIES.items():
+            before = _estimated_cost(cursor, sql.format(hint="WITH (INDEX(0))"))
+            after = _estimated_cost(cursor, sql.format(hint=""))
+            report.append({
+                "query": name,
+                "cost_before": round(before, 6),
+                "cost_after": round(after, 6),
+                "improvement": round(before / after, 2) if after else None,
+            })
+    finally:
+        cursor.execute("SET SHOWPLAN_XML OFF")
+        conn.close()
+    return report
+
 # إنشاء مستخدمين افتراضيين
 def create_default_users():
     conn = get_db_connection_fastapi()
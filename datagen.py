@@ -0,0 +1,245 @@
+import argparse
+import random
+import sqlite3
+import time
+from itertools import islice
+
+# ==== مولد بيانات اصطناعية لاختبار الأداء ====
+# Deterministic from --seed: the same arguments always produce the same rows.
+#   python datagen.py --backend sqlite --sqlite-path scale.db --customers 1000000 --servers 500 --custservers 2000000
+#   python datagen.py --backend sqlserver --customers 200000
+
+FIRST_NAMES = [
+    "محمد", "أحمد", "عبدالله", "عبدالرحمن", "خالد", "فهد", "سعود", "فيصل", "سلطان", "ناصر",
+    "إبراهيم", "يوسف", "عمر", "علي", "حسن", "ماجد", "تركي", "بندر", "سلمان", "مشاري",
+    "نورة", "سارة", "فاطمة", "مريم", "هند", "ريم", "لطيفة", "أمل", "منى", "عائشة",
+]
+FAMILY_NAMES = [
+    "العتيبي", "القحطاني", "الغامدي", "الزهراني", "الشهري", "الدوسري", "المطيري", "الحربي", "العنزي", "الشمري",
+    "السبيعي", "الرشيدي", "البقمي", "الأحمدي", "السلمي", "الجهني", "المالكي", "العمري", "الهاجري", "اليامي",
+]
+BUSINESS_PREFIXES = ["مؤسسة", "شركة", "مكتب", "مجموعة", "مصنع"]
+BUSINESS_WORDS = ["النور", "الأمل", "الريادة", "التقنية", "الإتقان", "الفجر", "الوفاء", "الصفوة", "الإبداع", "الرواد"]
+CITIES = ["الرياض", "جدة", "مكة المكرمة", "المدينة المنورة", "الدمام", "الخبر", "أبها", "تبوك", "بريدة", "حائل"]
+DISTRICTS = ["حي النخيل", "حي الملقا", "حي العليا", "حي الروضة", "حي السلامة", "حي الشاطئ", "حي الفيصلية"]
+EMAIL_DOMAINS = ["gmail.com", "hotmail.com", "outlook.com", "yahoo.com", "skysft.com"]
+CONNECTION_TYPES = [("VPN", 45), ("Internet", 30), ("LAN", 15), ("AnyDesk", 10)]
+# Spelling variants operators actually type (hamza forms, taa marbuta, extra spaces)
+VARIANTS = [("أ", "ا"), ("إ", "ا"), ("ة", "ه"), ("ى", "ي"), ("عبد", "عبد "), (" ", "  ")]
+
+# Weighted pick with precomputed cumulative weights
+def _weighted(rng, cumulative, values):
+    return values[_bisect(cumulative, rng.random() * cumulative[-1])]
+
+def _bisect(cumulative, x):
+    lo, hi = 0, len(cumulative)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if cumulative[mid] <= x:
+            lo = mid + 1
+        else:
+            hi = mid
+    return min(lo, len(cumulative) - 1)
+
+def _cumulative(weights):
+    total, out = 0.0, []
+    for w in weights:
+        total += w
+        out.append(total)
+    return out
+
+def customer_name(rng, business_ratio=0.25, variant_ratio=0.08):
+    if rng.random() < business_ratio:
+        name = f"{rng.choice(BUSINESS_PREFIXES)} {rng.choice(BUSINESS_WORDS)} {rng.choice(['للتجارة', 'للمقاولات', 'للتقنية', 'التجارية'])}"
+    else:
+        name = f"{rng.choice(FIRST_NAMES)} {rng.choice(FIRST_NAMES)} {rng.choice(FAMILY_NAMES)}"
+    if rng.random() < variant_ratio:
+        old, new = rng.choice(VARIANTS)
+        name = name.replace(old, new, 1)
+    return name
+
+# Rows for Customers: (CustomerNumber, Name, Phone, Email, Address, TaxNumber, NationalAddress)
+def generate_customers(seed, count, start=1):
+    rng = random.Random(f"customers:{seed}")
+    for seq in range(start, start + count):
+        name = customer_name(rng)
+        phone = f"05{rng.randrange(10 ** 8):08d}" if rng.random() < 0.9 else None
+        email = f"cust{seq}@{rng.choice(EMAIL_DOMAINS)}" if rng.random() < 0.7 else None
+        tax = f"3{rng.randrange(10 ** 13):013d}3" if rng.random() < 0.4 else None
+        city = rng.choice(CITIES)
+        address = f"{city} - {rng.choice(DISTRICTS)}"
+        national = f"{rng.choice('RJMDKH')}{rng.choice('ABCDEFGH')}{rng.choice('ABCDEFGH')}{rng.choice('ABCDEFGH')}{rng.randrange(1000, 9999)}" if rng.random() < 0.5 else None
+        yield (f"CUST{seq:04d}", name, phone, email, address, tax, national)
+
+def server_address(n):
+    return f"10.{(n >> 16) & 255}.{(n >> 8) & 255}.{n & 255}" if n < 1 << 24 else f"srv{n}.local"
+
+# Inverse of server_address (None for addresses it never produces)
+def server_number(ip):
+    if ip.startswith("srv") and ip.endswith(".local") and ip[3:-6].isdigit():
+        return int(ip[3:-6])
+    parts = ip.split(".")
+    if len(parts) == 4 and parts[0] == "10" and all(p.isdigit() and int(p) < 256 for p in parts[1:]):
+        return (int(parts[1]) << 16) | (int(parts[2]) << 8) | int(parts[3])
+    return None
+
+# Rows for SERVERIP: (IP, USER, PASS, SERVER_EMAIL, EMAIL_PASS); start continues after earlier runs
+def generate_servers(seed, count, start=1):
+    rng = random.Random(f"servers:{seed}")
+    for i in range(start - 1, start - 1 + count):
+        ip = server_address(i + 1)
+        user = f"sa{rng.randrange(1, 50)}" if rng.random() < 0.8 else None
+        password = "".join(rng.choice("abcdefghjkmnpqrstuvwxyz23456789") for _ in range(12))
+        email = f"server{i}@skysft.com" if rng.random() < 0.6 else None
+        yield (ip, user, password, email, "".join(rng.choice("abcdefghjkmnpqrstuvwxyz23456789") for _ in range(10)) if email else None)
+
+def server_ips(seed, count, start=1):
+    return [row[0] for row in generate_servers(seed, count, start)]
+
+# Rows for CUSTSERVER: (CustomerName, LinkOrNot, Number, GlobalServerIP, ServerName, DatabaseName,
+# ConnectionType, ConnectedDevices, Notes). GlobalServerIP follows a Zipf-like skew (a few busy servers).
+# numbers: highest existing Number per IP, so new rows continue after rows already in the table.
+def generate_custservers(seed, count, ips, skew=1.1, numbers=None):
+    rng = random.Random(f"custservers:{seed}")
+    ranked = list(ips)
+    random.Random(f"rank:{seed}").shuffle(ranked)
+    ip_cumulative = _cumulative([1.0 / (rank ** skew) for rank in range(1, len(ranked) + 1)])
+    type_values = [t for t, _ in CONNECTION_TYPES]
+    type_cumulative = _cumulative([w for _, w in CONNECTION_TYPES])
+    numbers = dict(numbers or {})
+    for i in range(count):
+        ip = _weighted(rng, ip_cumulative, ranked)
+        numbers[ip] = numbers.get(ip, 0) + 1
+        devices = min(int(rng.lognormvariate(1.2, 0.9)), 500)
+        yield (
+            customer_name(rng),
+            rng.random() < 0.7,
+            numbers[ip],
+            ip,
+            f"SRV-{rng.randrange(1, 9999):04d}",
+            f"DB_{rng.randrange(1, 999)}",
+            _weighted(rng, type_cumulative, type_values),
+            devices,
+            "تم التركيب" if rng.random() < 0.1 else None,
+        )
+
+def _batched(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+# ==== الكتابة إلى قاعدة البيانات ====
+SQLITE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS Customers (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT, CustomerNumber TEXT UNIQUE NOT NULL, Name TEXT NOT NULL,
+        Phone TEXT, Email TEXT, Address TEXT, TaxNumber TEXT, NationalAddress TEXT
+    );
+    CREATE TABLE IF NOT EXISTS SERVERIP (
+        IP TEXT PRIMARY KEY, "USER" TEXT, "PASS" TEXT, SERVER_EMAIL TEXT, EMAIL_PASS TEXT
+    );
+    CREATE TABLE IF NOT EXISTS CUSTSERVER (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT, CustomerName TEXT, LinkOrNot INTEGER, "Number" INTEGER,
+        GlobalServerIP TEXT REFERENCES SERVERIP(IP), ServerName TEXT, DatabaseName TEXT, ConnectionType TEXT,
+        ConnectedDevices INTEGER, Notes TEXT
+    );
+    CREATE INDEX IF NOT EXISTS IX_CUSTSERVER_GlobalServerIP ON CUSTSERVER (GlobalServerIP, "Number");
+"""
+
+INSERTS = {
+    "Customers": "INSERT INTO Customers (CustomerNumber, Name, Phone, Email, Address, TaxNumber, NationalAddress) VALUES (?, ?, ?, ?, ?, ?, ?)",
+    "SERVERIP": "INSERT INTO SERVERIP (IP, [USER], [PASS], SERVER_EMAIL, EMAIL_PASS) VALUES (?, ?, ?, ?, ?)",
+    "CUSTSERVER": "INSERT INTO CUSTSERVER (CustomerName, LinkOrNot, [Number], GlobalServerIP, ServerName, DatabaseName, ConnectionType, ConnectedDevices, Notes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+}
+
+def open_sqlite(path):
+    conn = sqlite3.connect(path)
+    conn.executescript(SQLITE_SCHEMA)
+    return conn
+
+def open_sqlserver():
+    from database import get_db_connection_fastapi
+    return get_db_connection_fastapi(autocommit=False)
+
+def bulk_insert(conn, table, rows, batch_size=5000, progress=None):
+    cursor = conn.cursor()
+    if hasattr(cursor, "fast_executemany"):
+        # pyodbc: send each batch as one parameter array instead of a round trip per row
+        cursor.fast_executemany = True
+    sql = INSERTS[table]
+    if isinstance(conn, sqlite3.Connection):
+        sql = sql.replace("[", '"').replace("]", '"')
+    total = 0
+    for batch in _batched(rows, batch_size):
+        cursor.executemany(sql, batch)
+        conn.commit()
+        total += len(batch)
+        if progress:
+            progress(table, total)
+    return total
+
+def next_customer_seq(conn):
+    cursor = conn.cursor()
+    if isinstance(conn, sqlite3.Connection):
+        cursor.execute("SELECT MAX(CAST(SUBSTR(CustomerNumber, 5) AS INTEGER)) FROM Customers WHERE CustomerNumber LIKE 'CUST%'")
+    else:
+        cursor.execute("SELECT MAX(CustomerSeq) FROM Customers")
+    return (cursor.fetchone()[0] or 0) + 1
+
+# Highest server_address() number already in SERVERIP, plus one
+def next_server_number(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT IP FROM SERVERIP")
+    return max((n for n in (server_number(row[0]) for row in cursor.fetchall()) if n is not None), default=0) + 1
+
+def custserver_numbers(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT GlobalServerIP, MAX([Number]) FROM CUSTSERVER WHERE GlobalServerIP IS NOT NULL GROUP BY GlobalServerIP")
+    return {ip: number or 0 for ip, number in cursor.fetchall()}
+
+def populate(conn, seed=42, customers=0, servers=0, custservers=0, skew=1.1, batch_size=5000, progress=None):
+    counts = {}
+    if customers:
+        counts["Customers"] = bulk_insert(conn, "Customers", generate_customers(seed, customers, next_customer_seq(conn)), batch_size, progress)
+    if servers:
+        server_start = next_server_number(conn)
+        counts["SERVERIP"] = bulk_insert(conn, "SERVERIP", generate_servers(seed, servers, server_start), batch_size, progress)
+    if custservers:
+        ips = server_ips(seed, servers, server_start) if servers else [row[0] for row in conn.cursor().execute("SELECT IP FROM SERVERIP").fetchall()]
+        if not ips:
+            raise ValueError("CUSTSERVER rows need SERVERIP entries (use --servers)")
+        rows = generate_custservers(seed, custservers, ips, skew, custserver_numbers(conn))
+        counts["CUSTSERVER"] = bulk_insert(conn, "CUSTSERVER", rows, batch_size, progress)
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate synthetic Customers/SERVERIP/CUSTSERVER rows")
+    parser.add_argument("--backend", choices=("sqlite", "sqlserver"), default="sqlite")
+    parser.add_argument("--sqlite-path", default="scale.db")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--customers", type=int, default=10000)
+    parser.add_argument("--servers", type=int, default=200)
+    parser.add_argument("--custservers", type=int, default=20000)
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent for GlobalServerIP distribution")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    conn = open_sqlite(args.sqlite_path) if args.backend == "sqlite" else open_sqlserver()
+    start = time.perf_counter()
+
+    def progress(table, done):
+        print(f"\r{table}: {done:,} rows ({time.perf_counter() - start:.1f}s)", end="", flush=True)
+
+    try:
+        counts = populate(conn, args.seed, args.customers, args.servers, args.custservers, args.skew, args.batch_size, progress)
+    finally:
+        conn.close()
+    print()
+    for table, count in counts.items():
+        print(f"{table}: {count:,}")
+    print(f"done in {time.perf_counter() - start:.1f}s")
+
+if __name__ == "__main__":
+    main()
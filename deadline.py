@@ -0,0 +1,114 @@
+import math
+import time
+import asyncio
+import contextvars
+from fastapi import HTTPException
+from starlette.requests import Request
+from config import REQUEST_TIMEOUT_SECONDS, ROUTE_TIMEOUTS, DISCONNECT_POLL_SECONDS
+from breaker import sqlstate
+from metrics import metrics
+
+class QueryTimeout(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=504, detail="انتهت مهلة الاستعلام، حاول تضييق البحث")
+
+# nginx's "client closed request": nobody reads it, but the log shows why the request ended
+class ClientDisconnected(HTTPException):
+    def __init__(self):
+        super().__init__(status_code=499, detail="أغلق العميل الاتصال")
+
+class Deadline:
+    __slots__ = ("expires", "request")
+
+    def __init__(self, expires, request):
+        self.expires = expires
+        self.request = request
+
+    def remaining(self):
+        return self.expires - time.monotonic()
+
+    @property
+    def route(self):
+        return getattr(self.request.scope.get("route"), "path", self.request.scope["path"])
+
+_current = contextvars.ContextVar("deadline", default=None)
+
+def current():
+    return _current.get()
+
+def route_timeout(path):
+    best = None
+    for prefix in ROUTE_TIMEOUTS:
+        if path.startswith(prefix) and (best is None or len(prefix) > len(best)):
+            best = prefix
+    return ROUTE_TIMEOUTS[best] if best is not None else REQUEST_TIMEOUT_SECONDS
+
+def _timed_out(deadline):
+    metrics.inc("db_statement_timeouts_total", route=deadline.route)
+    return QueryTimeout()
+
+# Query timeout (whole seconds, as ODBC wants) for the next statement; 0 = none (background threads)
+def statement_timeout():
+    deadline = _current.get()
+    if deadline is None:
+        return 0
+    remaining = deadline.remaining()
+    if remaining <= 0:
+        raise _timed_out(deadline)
+    return max(1, math.ceil(remaining))
+
+# HYT00 on a request with a deadline is our own timeout, not the server being down
+def as_query_timeout(error):
+    deadline = _current.get()
+    if deadline is None or sqlstate(error) != "HYT00":
+        return None
+    return _timed_out(deadline)
+
+def _execute_fetchall(cursor, sql, params):
+    cursor.execute(sql, params)
+    return cursor.fetchall()
+
+# Run a read in a worker thread while watching the client; if it disconnects the statement
+# is cancelled on the server (cursor.cancel() is safe from another thread)
+async def fetch_all(cursor, sql, params=()):
+    deadline = _current.get()
+    if deadline is None:
+        return _execute_fetchall(cursor, sql, params)
+    task = asyncio.ensure_future(asyncio.to_thread(_execute_fetchall, cursor, sql, params))
+    try:
+        while True:
+            done, _ = await asyncio.wait((task,), timeout=DISCONNECT_POLL_SECONDS)
+            if done:
+                return task.result()
+            if await deadline.request.is_disconnected():
+                cursor.cancel()
+                metrics.inc("db_statements_cancelled_total", route=deadline.route)
+                await asyncio.wait((task,))
+                task.exception()  # "operation canceled", expected
+                raise ClientDisconnected()
+    except asyncio.CancelledError:
+        # Let the worker thread leave execute/fetchall before get_db rolls back and closes the connection
+        cursor.cancel()
+        while not task.done():
+            try:
+                await asyncio.wait((task,))
+            except asyncio.CancelledError:
+                pass
+        task.exception()
+        raise
+
+# Sets the request's deadline (arrival + route budget) for the DB layer; placed outside admission
+# control so time spent queued counts against it
+class DeadlineMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith("/static"):
+            await self.app(scope, receive, send)
+            return
+        token = _current.set(Deadline(time.monotonic() + route_timeout(scope["path"]), Request(scope, receive)))
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _current.reset(token)
@@ -0,0 +1,271 @@
+import re
+import logging
+import threading
+from difflib import SequenceMatcher
+from config import DEDUPE_ENABLED, DEDUPE_THRESHOLD, DEDUPE_MAX_RESULTS, DEDUPE_MAX_BLOCK
+from database import get_db_connection_fastapi
+from cache import bus
+
+logger = logging.getLogger("dedupe")
+
+# ==== تطبيع الأسماء العربية ====
+_DIACRITICS = re.compile("[\u0610-\u061A\u064B-\u065F\u0670\u06D6-\u06ED\u0640]")  # tashkeel + tatweel
+_LETTERS = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ى": "ي", "ئ": "ي",
+    "ؤ": "و",
+    "ة": "ه",
+    "٠": "0", "١": "1", "٢": "2", "٣": "3", "٤": "4", "٥": "5", "٦": "6", "٧": "7", "٨": "8", "٩": "9",
+})
+_NON_WORD = re.compile(r"[^\w]+")
+_NON_DIGIT = re.compile(r"\D+")
+# Words that say nothing about which customer it is (already normalized)
+STOP_WORDS = {"شركه", "مؤسسه", "موسسه", "مكتب", "مجموعه", "company", "co", "est", "ltd", "llc"}
+
+def normalize_name(name):
+    text = _DIACRITICS.sub("", name or "").translate(_LETTERS).lower()
+    tokens = [t for t in _NON_WORD.sub(" ", text).split() if t not in STOP_WORDS]
+    # "عبد الله" and "عبدالله" are the same name
+    joined = []
+    for token in tokens:
+        if joined and joined[-1] in ("عبد", "ابو", "بو"):
+            joined[-1] += token
+        else:
+            joined.append(token)
+    return " ".join(joined)
+
+# 05xxxxxxxx, +9665xxxxxxxx and 009665xxxxxxxx all end with the same 9 digits
+def normalize_phone(phone):
+    digits = _NON_DIGIT.sub("", (phone or "").translate(_LETTERS))
+    return digits[-9:] if len(digits) >= 7 else None
+
+def normalize_tax(tax_number):
+    digits = _NON_DIGIT.sub("", (tax_number or "").translate(_LETTERS))
+    return digits or None
+
+def name_similarity(a, b):
+    if not a or not b:
+        return 0.0
+    ta, tb = set(a.split()), set(b.split())
+    jaccard = len(ta & tb) / len(ta | tb)
+    ratio = SequenceMatcher(None, a.replace(" ", ""), b.replace(" ", "")).ratio()
+    return max(jaccard, ratio)
+
+class _Record:
+    __slots__ = ("id", "number", "name", "phone", "tax", "norm_name", "norm_phone", "norm_tax", "keys")
+
+    def __init__(self, id, number, name, phone, tax):
+        self.id = id
+        self.number = number
+        self.name = name
+        self.phone = phone
+        self.tax = tax
+        self.norm_name = normalize_name(name)
+        self.norm_phone = normalize_phone(phone)
+        self.norm_tax = normalize_tax(tax)
+        # Blocking keys: only records sharing at least one key are ever compared
+        keys = {("t", token) for token in self.norm_name.split() if len(token) > 1}
+        if self.norm_name:
+            keys.add(("n", self.norm_name.replace(" ", "")))
+        if self.norm_phone:
+            keys.add(("p", self.norm_phone))
+        if self.norm_tax:
+            keys.add(("x", self.norm_tax))
+        self.keys = keys
+
+def score(a, b):
+    reasons = []
+    best = 0.0
+    if a.norm_tax and a.norm_tax == b.norm_tax:
+        reasons.append("tax")
+        best = 1.0
+    if a.norm_phone and a.norm_phone == b.norm_phone:
+        reasons.append("phone")
+        best = max(best, 0.9)
+    similarity = name_similarity(a.norm_name, b.norm_name)
+    if similarity >= DEDUPE_THRESHOLD:
+        reasons.append("name")
+    return max(best, similarity), reasons
+
+# In-memory blocking-key index over Customers, updated on every committed insert/update/delete
+class DuplicateIndex:
+    def __init__(self, enabled=DEDUPE_ENABLED, threshold=DEDUPE_THRESHOLD, max_block=DEDUPE_MAX_BLOCK):
+        self.enabled = enabled
+        self.threshold = threshold
+        self.max_block = max_block
+        self._lock = threading.Lock()
+        self._records = {}
+        self._blocks = {}
+        self._mark = None
+        self.loaded = False
+
+    def _add(self, record):
+        self._records[record.id] = record
+        for key in record.keys:
+            self._blocks.setdefault(key, set()).add(record.id)
+
+    def _remove(self, id):
+        record = self._records.pop(id, None)
+        if record is None:
+            return
+        for key in record.keys:
+            block = self._blocks.get(key)
+            if block is not None:
+                block.discard(id)
+                if not block:
+                    del self._blocks[key]
+
+    def load_rows(self, rows):
+        with self._lock:
+            for id, number, name, phone, tax in rows:
+                self._remove(id)
+                self._add(_Record(id, number, name, phone, tax))
+
+    # Full rebuild from the table (startup)
+    def reload(self):
+        if not self.enabled:
+            return
+        conn = get_db_connection_fastapi()
+        try:
+            cursor = conn.cursor()
+            mark = self._active_rowversion(cursor)
+            cursor.execute("SELECT ID, CustomerNumber, Name, Phone, TaxNumber FROM Customers")
+            records = [_Record(*row) for row in cursor.fetchall()]
+        finally:
+            conn.close()
+        with self._lock:
+            self._records, self._blocks = {}, {}
+            for record in records:
+                self._add(record)
+            self._mark = mark
+            self.loaded = True
+        logger.info("duplicate index loaded: %d customers, %d blocks", len(records), len(self._blocks))
+
+    # Rows of transactions still in flight get a RowVer at or above this, so reading below it never
+    # skips a change that commits later
+    def _active_rowversion(self, cursor):
+        cursor.execute("SELECT MIN_ACTIVE_ROWVERSION()")
+        return cursor.fetchone()[0]
+
+    # Catch up after another worker (or a bulk import) changed Customers: only rows whose RowVer moved
+    # since the last load/sync are read; deletions are looked for only when the row count no longer matches
+    def sync(self):
+        if not self.enabled:
+            return
+        if not self.loaded:
+            self.reload()
+            return
+        conn = get_db_connection_fastapi()
+        try:
+            cursor = conn.cursor()
+            mark = self._active_rowversion(cursor)
+            cursor.execute("SELECT ID, CustomerNumber, Name, Phone, TaxNumber FROM Customers WHERE RowVer >= ? AND RowVer < ?",
+                           (self._mark, mark))
+            changed = cursor.fetchall()
+            cursor.execute("SELECT COUNT(*) FROM Customers")
+            count = cursor.fetchone()[0]
+            ids = None
+            if count != len(self._records) + sum(1 for row in changed if row[0] not in self._records):
+                cursor.execute("SELECT ID FROM Customers")
+                ids = {row[0] for row in cursor.fetchall()}
+        finally:
+            conn.close()
+        with self._lock:
+            for id, number, name, phone, tax in changed:
+                self._remove(id)
+                self._add(_Record(id, number, name, phone, tax))
+            if ids is not None:
+                for id in set(self._records) - ids:
+                    self._remove(id)
+            self._mark = mark
+
+    def upsert(self, id, number, name, phone, tax):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._remove(id)
+            self._add(_Record(id, number, name, phone, tax))
+
+    def remove(self, id):
+        with self._lock:
+            self._remove(id)
+
+    def _candidates(self, record):
+        ids = set()
+        for key in record.keys:
+            block = self._blocks.get(key)
+            # Phone/tax blocks are always small; huge name blocks carry no signal
+            if block and (key[0] in ("p", "x") or len(block) <= self.max_block):
+                ids |= block
+        return ids
+
+    # Likely duplicates of a (new or edited) customer, best first
+    def find(self, name, phone=None, tax=None, exclude_id=None, limit=DEDUPE_MAX_RESULTS):
+        if not self.enabled or not self.loaded:
+            return []
+        probe = _Record(exclude_id, None, name, phone, tax)
+        matches = []
+        with self._lock:
+            for id in self._candidates(probe):
+                if id == exclude_id:
+                    continue
+                other = self._records[id]
+                value, reasons = score(probe, other)
+                if value >= self.threshold:
+                    matches.append({"ID": other.id, "CustomerNumber": other.number, "Name": other.name,
+                                    "Phone": other.phone, "TaxNumber": other.tax, "Score": round(value, 3), "Reasons": reasons})
+        matches.sort(key=lambda m: m["Score"], reverse=True)
+        return matches[:limit]
+
+    # The one customer whose normalized name equals this one, or None when there is none or several
+    def match_name(self, name):
+        if not self.enabled or not self.loaded:
+            return None
+        norm_name = normalize_name(name)
+        if not norm_name:
+            return None
+        with self._lock:
+            ids = [id for id in self._blocks.get(("n", norm_name.replace(" ", "")), ())
+                   if self._records[id].norm_name == norm_name]
+        return ids[0] if len(ids) == 1 else None
+
+    # Groups of likely duplicates across the whole table (union-find over scored pairs inside each block)
+    def clusters(self, progress=None):
+        with self._lock:
+            records = dict(self._records)
+            blocks = [sorted(ids) for key, ids in self._blocks.items()
+                      if len(ids) > 1 and (key[0] in ("p", "x") or len(ids) <= self.max_block)]
+        parent = {}
+
+        def find_root(id):
+            while parent.get(id, id) != id:
+                parent[id] = parent.get(parent[id], parent[id])
+                id = parent[id]
+            return id
+
+        best = {}
+        seen = set()
+        for done, ids in enumerate(blocks, start=1):
+            for i, a in enumerate(ids):
+                for b in ids[i + 1:]:
+                    if (a, b) in seen:
+                        continue
+                    seen.add((a, b))
+                    value, _ = score(records[a], records[b])
+                    if value >= self.threshold:
+                        ra, rb = find_root(a), find_root(b)
+                        if ra != rb:
+                            parent[max(ra, rb)] = min(ra, rb)
+                        best[a] = max(best.get(a, 0), value)
+                        best[b] = max(best.get(b, 0), value)
+            if progress:
+                progress(done, len(blocks))
+        groups = {}
+        for id in best:
+            groups.setdefault(find_root(id), []).append(id)
+        return [[(records[id], best[id]) for id in sorted(members)] for _, members in sorted(groups.items())]
+
+dedupe_index = DuplicateIndex()
+
+# The writing worker updates its index after commit; the others catch up when the bus says Customers changed
+bus.register("customers", dedupe_index.sync, remote_only=True)
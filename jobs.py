@@ -0,0 +1,399 @@
+import os
+import asyncio
+import csv
+import json
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pyodbc
+from config import (
+    JOB_WORKERS, JOB_MAX_PENDING, JOB_SPOOL_DIR, JOB_RESULT_TTL_SECONDS, JOB_BATCH_SIZE, JOB_CLEANUP_INTERVAL_SECONDS,
+)
+from database import get_db_connection_fastapi
+from utils import is_valid_email, is_valid_numeric
+from cache import bus
+from dedupe import DuplicateIndex, dedupe_index, normalize_name
+from readmodel import read_model
+
+logger = logging.getLogger("jobs")
+
+class JobQueueFull(Exception):
+    pass
+
+class Job:
+    def __init__(self, kind, owner, params=None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.owner = owner
+        self.params = params or {}
+        self.status = "queued"
+        self.done = 0
+        self.total = None
+        self.result_path = None
+        self.result_name = None
+        self.media_type = None
+        self.summary = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    # Persisted next to the result so any worker process can answer status/result requests
+    STATE_FIELDS = ("id", "kind", "owner", "status", "done", "total", "result_path", "result_name", "media_type",
+                    "summary", "error", "created_at", "started_at", "finished_at")
+
+    def state(self):
+        return {name: getattr(self, name) for name in self.STATE_FIELDS}
+
+    @classmethod
+    def from_state(cls, state):
+        job = cls(state["kind"], state["owner"])
+        for name in cls.STATE_FIELDS:
+            setattr(job, name, state.get(name))
+        return job
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "done": self.done,
+            "total": self.total,
+            "progress": round(self.done / self.total, 4) if self.total else None,
+            "summary": self.summary,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "has_result": self.result_path is not None,
+            "expires_at": self.finished_at + JOB_RESULT_TTL_SECONDS if self.finished_at else None,
+        }
+
+# ==== تصدير CSV ====
+EXPORTS = {
+    "customers": (
+        "SELECT COUNT(*) FROM Customers",
+        "SELECT ID, CustomerNumber, Name, Phone, Email, Address, TaxNumber, NationalAddress FROM Customers ORDER BY ID",
+        ["ID", "CustomerNumber", "Name", "Phone", "Email", "Address", "TaxNumber", "NationalAddress"],
+    ),
+    "custserver": (
+        "SELECT COUNT(*) FROM CUSTSERVER",
+        "SELECT ID, CustomerName, LinkOrNot, [Number], GlobalServerIP, ServerName, DatabaseName, ConnectionType, ConnectedDevices, Notes, CustomerID FROM CUSTSERVER ORDER BY ID",
+        ["ID", "CustomerName", "LinkOrNot", "Number", "GlobalServerIP", "ServerName", "DatabaseName", "ConnectionType", "ConnectedDevices", "Notes", "CustomerID"],
+    ),
+}
+
+def run_export(job, runner):
+    count_sql, select_sql, header = EXPORTS[job.params["table"]]
+    path = runner.spool_path(job, ".csv")
+    conn = get_db_connection_fastapi()
+    try:
+        cursor = conn.cursor()
+        cursor.execute(count_sql)
+        job.total = cursor.fetchone()[0]
+        cursor.execute(select_sql)
+        # utf-8-sig so Excel shows Arabic correctly
+        with open(path + ".part", "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            while True:
+                rows = cursor.fetchmany(JOB_BATCH_SIZE)
+                if not rows:
+                    break
+                writer.writerows(rows)
+                job.done += len(rows)
+                runner.save(job)
+        os.replace(path + ".part", path)
+    finally:
+        conn.close()
+    job.result_path = path
+    job.result_name = f"{job.params['table']}.csv"
+    job.media_type = "text/csv"
+    job.summary = {"rows": job.done}
+
+# ==== استيراد العملاء من CSV ====
+CUSTOMER_IMPORT_COLUMNS = ["CustomerNumber", "Name", "Phone", "Email", "Address", "TaxNumber", "NationalAddress"]
+CUSTOMER_INSERT = """
+    INSERT INTO Customers (CustomerNumber, Name, Phone, Email, Address, TaxNumber, NationalAddress)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Column sizes in Customers: longer values would fail the insert with a DataError
+CUSTOMER_COLUMN_LENGTHS = {"CustomerNumber": 20, "Name": 100, "Phone": 20, "Email": 100, "Address": 255,
+                           "TaxNumber": 20, "NationalAddress": 255}
+
+def _customer_row_error(row):
+    if not row["Name"]:
+        return "الاسم مطلوب!"
+    if row["Phone"] and not is_valid_numeric(row["Phone"]):
+        return "رقم الهاتف يجب أن يكون أرقام فقط!"
+    if row["Email"] and not is_valid_email(row["Email"]):
+        return "البريد الإلكتروني غير صحيح!"
+    if row["TaxNumber"] and not is_valid_numeric(row["TaxNumber"]):
+        return "الرقم الضريبي يجب أن يكون أرقام فقط!"
+    for col, length in CUSTOMER_COLUMN_LENGTHS.items():
+        if row[col] and len(row[col]) > length:
+            return f"قيمة {col} أطول من {length} حرف!"
+    return None
+
+def _read_import_rows(source):
+    with open(source, newline="", encoding="utf-8-sig") as f:
+        for line, raw in enumerate(csv.DictReader(f), start=2):
+            yield line, {col: (raw.get(col) or "").strip() or None for col in CUSTOMER_IMPORT_COLUMNS}
+
+# Each batch is its own short transaction, so the lock on the next customer number is held
+# for one batch at a time and interactive adds are not blocked for the whole import.
+def run_import_customers(job, runner):
+    source = job.params["source"]
+    # First pass: row count, and the numbers the file sets itself (generated numbers skip them)
+    explicit = set()
+    job.total = 0
+    for _, row in _read_import_rows(source):
+        job.total += 1
+        if row["CustomerNumber"]:
+            explicit.add(row["CustomerNumber"])
+    inserted, errors = 0, []
+    conn = get_db_connection_fastapi(autocommit=False)
+    try:
+        cursor = conn.cursor()
+        cursor.fast_executemany = True
+        batch = []
+        for line, row in _read_import_rows(source):
+            error = _customer_row_error(row)
+            job.done += 1
+            if error:
+                errors.append({"line": line, "error": error})
+                continue
+            batch.append((line, row))
+            if len(batch) >= JOB_BATCH_SIZE:
+                inserted += _insert_batch(conn, cursor, batch, explicit, errors)
+                batch = []
+                runner.save(job)
+        if batch:
+            inserted += _insert_batch(conn, cursor, batch, explicit, errors)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+        os.remove(source)
+    job.summary = {"inserted": inserted, "rejected": len(errors), "errors": errors[:100]}
+    if inserted:
+        dedupe_index.sync()
+        bus.publish("customers")
+
+def _insert_batch(conn, cursor, batch, explicit, errors):
+    cursor.execute("SELECT MAX(CustomerSeq) FROM Customers WITH (UPDLOCK, HOLDLOCK)")
+    next_seq = (cursor.fetchone()[0] or 0) + 1
+    rows = []
+    for line, row in batch:
+        number = row["CustomerNumber"]
+        while not number:
+            candidate = f"CUST{next_seq:04d}"
+            next_seq += 1
+            if candidate not in explicit:
+                number = candidate
+        rows.append((line, (number,) + tuple(row[col] for col in CUSTOMER_IMPORT_COLUMNS[1:])))
+    cursor.execute("SAVE TRANSACTION import_batch")
+    try:
+        cursor.executemany(CUSTOMER_INSERT, [values for _, values in rows])
+        inserted = len(rows)
+    except (pyodbc.IntegrityError, pyodbc.DataError):
+        # One bad row fails the whole array, and the rows before it are already in:
+        # undo the batch, then insert row by row to keep the good ones
+        cursor.execute("ROLLBACK TRANSACTION import_batch")
+        inserted = 0
+        for line, values in rows:
+            try:
+                cursor.execute(CUSTOMER_INSERT, values)
+                inserted += 1
+            except pyodbc.IntegrityError:
+                errors.append({"line": line, "error": "رقم العميل موجود مسبقًا!"})
+            except pyodbc.DataError:
+                errors.append({"line": line, "error": "قيمة أطول من المسموح!"})
+    conn.commit()
+    return inserted
+
+# ==== البحث عن العملاء المكررين ====
+def run_duplicate_scan(job, runner):
+    # A private index, so the scan sees one consistent snapshot of the table
+    index = DuplicateIndex(enabled=True)
+    conn = get_db_connection_fastapi()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM Customers")
+        job.total = cursor.fetchone()[0]
+        cursor.execute("SELECT ID, CustomerNumber, Name, Phone, TaxNumber FROM Customers")
+        while True:
+            rows = cursor.fetchmany(JOB_BATCH_SIZE)
+            if not rows:
+                break
+            index.load_rows(rows)
+            job.done += len(rows)
+            runner.save(job)
+    finally:
+        conn.close()
+
+    # Second phase: progress counts scanned blocks
+    def progress(done, total):
+        job.done, job.total = done, total
+        if done % 1000 == 0:
+            runner.save(job)
+
+    clusters = index.clusters(progress)
+    path = runner.spool_path(job, ".csv")
+    with open(path + ".part", "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f)
+        writer.writerow(["ClusterID", "ID", "CustomerNumber", "Name", "Phone", "TaxNumber", "Score"])
+        for cluster_id, members in enumerate(clusters, start=1):
+            for record, value in members:
+                writer.writerow([cluster_id, record.id, record.number, record.name, record.phone, record.tax, round(value, 3)])
+    os.replace(path + ".part", path)
+    job.result_path = path
+    job.result_name = "duplicate_customers.csv"
+    job.media_type = "text/csv"
+    job.summary = {"clusters": len(clusters), "customers": sum(len(members) for members in clusters)}
+
+# ==== ربط CUSTSERVER بالعملاء ====
+# Second backfill pass (the first, exact-name one runs at startup): link rows whose
+# CustomerName matches exactly one customer once both names are normalized.
+def run_link_customers(job, runner):
+    conn = get_db_connection_fastapi(autocommit=False)
+    try:
+        cursor = conn.cursor()
+        cursor.fast_executemany = True
+        cursor.execute("SELECT ID, Name FROM Customers")
+        by_name = {}
+        for id, name in cursor.fetchall():
+            by_name.setdefault(normalize_name(name), []).append(id)
+        cursor.execute("SELECT ID, CustomerName FROM CUSTSERVER WHERE CustomerID IS NULL")
+        unlinked = cursor.fetchall()
+        job.total = len(unlinked)
+        links, ambiguous = [], 0
+        for id, customer_name in unlinked:
+            ids = by_name.get(normalize_name(customer_name), [])
+            if len(ids) == 1:
+                links.append((ids[0], id))
+            elif ids:
+                ambiguous += 1
+            job.done += 1
+        for start in range(0, len(links), JOB_BATCH_SIZE):
+            cursor.executemany("UPDATE CUSTSERVER SET CustomerID = ? WHERE ID = ? AND CustomerID IS NULL",
+                               links[start:start + JOB_BATCH_SIZE])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    runner.save(job)
+    job.summary = {"linked": len(links), "ambiguous": ambiguous, "unmatched": len(unlinked) - len(links) - ambiguous}
+    if links:
+        if read_model.enabled:
+            read_model.custservers.sync()
+        bus.publish("custserver")
+
+JOB_KINDS = {
+    "export": run_export,
+    "import_customers": run_import_customers,
+    "duplicates": run_duplicate_scan,
+    "link_customers": run_link_customers,
+}
+
+# In-process job queue: bounded worker pool, bounded backlog, results spooled to disk
+class JobRunner:
+    def __init__(self, workers=JOB_WORKERS, max_pending=JOB_MAX_PENDING, spool_dir=JOB_SPOOL_DIR, ttl=JOB_RESULT_TTL_SECONDS):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.spool_dir = spool_dir
+        self.ttl = ttl
+        self.jobs = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def start(self):
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.cleanup()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def spool_path(self, job, suffix):
+        return os.path.join(self.spool_dir, job.id + suffix)
+
+    def submit(self, job):
+        if job.kind not in JOB_KINDS:
+            raise ValueError(job.kind)
+        with self._lock:
+            pending = sum(1 for j in self.jobs.values() if j.status in ("queued", "running"))
+            if pending >= self.max_pending:
+                raise JobQueueFull()
+            self.jobs[job.id] = job
+        self.save(job)
+        self._executor.submit(self._run, job)
+        return job
+
+    def save(self, job):
+        path = self.spool_path(job, ".json")
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(job.state(), f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+
+    def _run(self, job):
+        job.status = "running"
+        job.started_at = time.time()
+        self.save(job)
+        try:
+            JOB_KINDS[job.kind](job, self)
+            job.status = "done"
+        except Exception as e:
+            logger.exception("job %s (%s) failed", job.id, job.kind)
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            self.save(job)
+
+    # Jobs started by another worker are read from their state file
+    def get(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is not None:
+            return job
+        if not job_id.isalnum():
+            return None
+        try:
+            with open(os.path.join(self.spool_dir, job_id + ".json"), encoding="utf-8") as f:
+                return Job.from_state(json.load(f))
+        except (OSError, ValueError):
+            return None
+
+    # Drop finished jobs older than the TTL, plus any spool file (from any worker) past the TTL
+    def cleanup(self, now=None):
+        now = now or time.time()
+        with self._lock:
+            for job in [j for j in self.jobs.values() if j.finished_at and j.finished_at + self.ttl < now]:
+                del self.jobs[job.id]
+        removed = 0
+        for name in os.listdir(self.spool_dir):
+            path = os.path.join(self.spool_dir, name)
+            try:
+                if os.path.getmtime(path) + self.ttl < now:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+
+    async def cleanup_forever(self, interval=JOB_CLEANUP_INTERVAL_SECONDS):
+        while True:
+            await asyncio.sleep(interval)
+            removed = self.cleanup()
+            if removed:
+                logger.info("removed %d expired job results", removed)
+
+job_runner = JobRunner()
@@ -1,27 +1,136 @@
 
-from fastapi import FastAPI, HTTPException, Depends, Form
+from fastapi import FastAPI, HTTPException, Depends, Form, Query, File, UploadFile, Response
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
-from fastapi.responses import HTMLResponse, StreamingResponse, RedirectResponse
-from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, StreamingResponse, RedirectResponse, FileResponse, JSONResponse, PlainTextResponse
 from pydantic import BaseModel
 from io import StringIO
 import csv
+import json
 import pyodbc
+import os
 import hashlib
-from database import get_db_connection_fastapi, create_database_and_table_fastapi
+import asyncio
+import shutil
+from database import get_db_connection_fastapi, create_database_and_table_fastapi, index_cost_report, get_db, UnitOfWork
 from models import Customer, ServerIP, CustServer, User
-from utils import is_valid_email, is_valid_numeric, generate_customer_number_fastapi
+from utils import is_valid_email, is_valid_numeric
+from querylog import query_stats
+from admission import AdmissionMiddleware, admission_controller
+from compression import CompressionMiddleware
+from static_assets import PrecompressedStaticFiles, build_static_assets, rewrite_asset_urls
+from config import STATIC_BUILD_DIR, WEB_CONCURRENCY, PROBE_ENABLED, LIST_PAGE_MAX, PROFILER_DEFAULT_INTERVAL_MS, READ_MODEL_SCAN_MAX_ROWS, READ_MODEL_INLINE_ROWS
+from cache import auth_cache, page_cache, list_cache, bus
+from querydsl import compile_query, compile_filters, query_rows, search_sql, CUSTOMERS_FIELDS, SERVERIP_FIELDS, CUSTSERVER_FIELDS, AUDIT_FIELDS
+from prober import prober
+from jobs import job_runner, Job, JobQueueFull, EXPORTS
+from audit import audit_log
+from dedupe import dedupe_index
+from readmodel import read_model, CustServerRow
+from breaker import db_breaker
+from metrics import metrics
+from tracing import TimingMiddleware, span, trace_writer
+from profiler import profiler, ProfiledRoute, ProfilerBusy
+from deadline import DeadlineMiddleware
 
 async def lifespan(app: FastAPI):
     create_database_and_table_fastapi()
     create_users_table()
+    bus.start()
+    audit_log.start()
+    try:
+        dedupe_index.reload()
+    except Exception as e:
+        print(f"Duplicate index not loaded: {e}")
+    read_model.start()
+    if PROBE_ENABLED:
+        prober.start()
+    job_runner.start()
+    cleanup_task = asyncio.get_running_loop().create_task(job_runner.cleanup_forever())
     yield
+    cleanup_task.cancel()
+    profiler.stop()
+    job_runner.stop()
+    await prober.stop()
+    read_model.stop()
+    # Flush queued audit events before exiting
+    audit_log.stop()
+    bus.stop()
+    trace_writer.stop()
     print("Application is shutting down...")
 
 app = FastAPI(lifespan=lifespan)
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Every route records its handler time for Server-Timing (build = handler minus auth/db spans)
+# and can be the target of a route-mode profiling session
+app.router.route_class = ProfiledRoute
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(AdmissionMiddleware, controller=admission_controller)
+# Outside admission control: time spent queued counts against the request deadline
+app.add_middleware(DeadlineMiddleware)
+app.add_middleware(TimingMiddleware)
+# Fingerprint + precompress static assets once at startup (also run as a build step in the Dockerfile)
+static_manifest = build_static_assets()
+app.mount("/static", PrecompressedStaticFiles(directory=STATIC_BUILD_DIR), name="static")
 security = HTTPBasic()
 
+# ==== Metrics ====
+CIRCUIT_STATES = {"closed": 0, "half_open": 1, "open": 2}
+metrics.describe("db_circuit_state", "gauge", "Database circuit breaker state (0=closed, 1=half_open, 2=open)")
+metrics.describe("db_circuit_calls_total", "counter", "Database calls let through by the circuit breaker")
+metrics.describe("db_circuit_failures_total", "counter", "Database outage errors (connection failures, timeouts)")
+metrics.describe("db_circuit_rejected_total", "counter", "Database calls failed fast while the circuit was open")
+metrics.describe("db_circuit_opened_total", "counter", "Times the database circuit opened")
+metrics.describe("db_read_retries_total", "counter", "Idempotent reads retried after a transient error")
+metrics.describe("admission_in_flight", "gauge", "Requests running per admission class")
+metrics.describe("admission_queued", "gauge", "Requests waiting per admission class")
+metrics.describe("admission_rejected_total", "counter", "Requests rejected with 503 per admission class")
+metrics.describe("audit_queue_depth", "gauge", "Audit events waiting to be written")
+metrics.describe("audit_written_total", "counter", "Audit events written")
+metrics.describe("audit_dropped_total", "counter", "Audit events dropped because the queue was full")
+metrics.describe("db_statement_timeouts_total", "counter", "Requests answered 504 because a statement ran past the request deadline")
+metrics.describe("db_statements_cancelled_total", "counter", "Running reads cancelled because the client disconnected")
+metrics.describe("read_model_rows", "gauge", "Rows held in the in-memory read model per table")
+metrics.describe("read_model_reloads_total", "counter", "Full reloads of the read model per table")
+metrics.describe("read_model_drift_total", "counter", "Rows found out of date when reconciling the read model")
+metrics.describe("read_model_syncs_total", "counter", "Incremental catch-ups of the read model after another worker's write")
+metrics.describe("read_model_sql_fallbacks_total", "counter", "List queries sent to SQL because the read model table is too large to scan")
+
+def collect_component_metrics():
+    breaker = db_breaker.snapshot()
+    samples = [
+        ("db_circuit_state", {}, CIRCUIT_STATES[breaker["state"]]),
+        ("db_circuit_calls_total", {}, breaker["calls"]),
+        ("db_circuit_failures_total", {}, breaker["failures"]),
+        ("db_circuit_rejected_total", {}, breaker["rejected"]),
+        ("db_circuit_opened_total", {}, breaker["opened"]),
+        ("db_read_retries_total", {}, breaker["retries"]),
+    ]
+    for name, state in admission_controller.snapshot().items():
+        samples.append(("admission_in_flight", {"class": name}, state["in_flight"]))
+        samples.append(("admission_queued", {"class": name}, state["queued"]))
+        samples.append(("admission_rejected_total", {"class": name}, state["rejected"]))
+    audit = audit_log.snapshot()
+    samples.append(("audit_queue_depth", {}, audit["queued"]))
+    samples.append(("audit_written_total", {}, audit["written"]))
+    samples.append(("audit_dropped_total", {}, audit["dropped"]))
+    for name, state in read_model.snapshot().items():
+        samples.append(("read_model_rows", {"table": name}, state["rows"]))
+        samples.append(("read_model_reloads_total", {"table": name}, state["reloads"]))
+        samples.append(("read_model_drift_total", {"table": name}, state["drift"]))
+        samples.append(("read_model_syncs_total", {"table": name}, state["syncs"]))
+    return samples
+
+metrics.register(collect_component_metrics)
+
+# Read an HTML page with its /static references pointing at fingerprinted assets
+def read_page(filename):
+    html = page_cache.get(filename)
+    if html is None:
+        with open(filename, "r", encoding="utf-8") as f:
+            html = rewrite_asset_urls(f.read(), static_manifest)
+        page_cache.set(filename, html)
+    return html
+
 # Create Users Table and Add Default Users
 def create_users_table():
     conn = get_db_connection_fastapi()
@@ -49,174 +158,324 @@ def create_users_table():
     conn.close()
 
 # Validate User for Authentication
-def validate_user(username: str, password: str, required_role: str = None):
+def validate_user(username: str, password: str, required_role: str = None, db: UnitOfWork = None):
+    with span("auth"):
+        return _validate_user(username, password, required_role, db)
+
+def _validate_user(username, password, required_role, db):
     hashed_pass = hashlib.sha256(password.encode()).hexdigest()
-    conn = get_db_connection_fastapi()
-    cursor = conn.cursor()
-    cursor.execute("SELECT Role FROM Users WHERE Username = ? AND Password = ?", (username, hashed_pass))
-    result = cursor.fetchone()
-    conn.close()
-    if result and (required_role is None or result[0] == required_role):
+    role = auth_cache.get((username, hashed_pass))
+    if role is None:
+        cursor = db.cursor()
+        cursor.execute("SELECT Role FROM Users WHERE Username = ? AND Password = ?", (username, hashed_pass))
+        result = cursor.fetchone()
+        if not result:
+            return False
+        role = result[0]
+        auth_cache.set((username, hashed_pass), role)
+    if required_role is None or role == required_role:
         return True
     return False
 
 # Login Page
 @app.get("/login", response_class=HTMLResponse)
-async def login_page():
-    conn = get_db_connection_fastapi()
-    cursor = conn.cursor()
-    cursor.execute("SELECT Username FROM Users")
-    users = [row[0] for row in cursor.fetchall()]
-    conn.close()
+async def login_page(db: UnitOfWork = Depends(get_db)):
+    html = page_cache.get("login:rendered")
+    if html is None:
+        users = [row[0] for row in await db.read("SELECT Username FROM Users")]
 
-    with open("login.html", "r", encoding="utf-8") as f:
-        html = f.read()
-    # Insert usernames into the <select> element
-    options = "".join(f'<option value="{user}">{user}</option>\n' for user in users)
-    html = html.replace("<!-- Filled dynamically by server -->", options)
+        html = read_page("login.html")
+        # Insert usernames into the <select> element
+        options = "".join(f'<option value="{user}">{user}</option>\n' for user in users)
+        html = html.replace("<!-- Filled dynamically by server -->", options)
+        page_cache.set("login:rendered", html)
     return HTMLResponse(content=html)
 # Login Post
 @app.post("/login")
-async def login(username: str = Form(...), password: str = Form(...)):
-    if validate_user(username, password):
+async def login(username: str = Form(...), password: str = Form(...), db: UnitOfWork = Depends(get_db)):
+    if validate_user(username, password, db=db):
         return RedirectResponse(url="/", status_code=303)
     else:
         raise HTTPException(status_code=401, detail="اسم المستخدم أو كلمة المرور غير صحيحة")
 
 # Users Management Page (Admin Only)
 @app.get("/users", response_class=HTMLResponse)
-async def manage_users(credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password, 'admin'):
+async def manage_users(credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, 'admin', db):
         raise HTTPException(status_code=401, detail="غير مصرح")
-    with open("users.html", "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+    return HTMLResponse(content=read_page("users.html"))
 
 # Users Data
 @app.get("/users/data")
-async def get_users(credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password, 'admin'):
+async def get_users(credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, 'admin', db):
         raise HTTPException(status_code=401, detail="غير مصرح")
-    conn = get_db_connection_fastapi()
-    cursor = conn.cursor()
-    cursor.execute("SELECT ID, Username, Role FROM Users")
-    users = [{"ID": row[0], "Username": row[1], "Role": row[2]} for row in cursor.fetchall()]
-    conn.close()
+    users = [{"ID": row[0], "Username": row[1], "Role": row[2]} for row in await db.read("SELECT ID, Username, Role FROM Users")]
     return users
 
 # Add User
 @app.post("/users")
-async def add_user(user: User, credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password, 'admin'):
+async def add_user(user: User, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, 'admin', db):
         raise HTTPException(status_code=401, detail="غير مصرح")
     hashed_pass = hashlib.sha256(user.Password.encode()).hexdigest()
     try:
-        conn = get_db_connection_fastapi()
-        cursor = conn.cursor()
+        cursor = db.cursor()
         cursor.execute("INSERT INTO Users (Username, Password, Role) VALUES (?, ?, ?)", (user.Username, hashed_pass, user.Role))
-        conn.commit()
+        bus.publish("auth", db)
+        audit_log.record(credentials.username, "create", "user", user.Username, user, db)
         return {"message": "تم إضافة المستخدم!"}
     except pyodbc.IntegrityError:
         raise HTTPException(status_code=400, detail="اسم المستخدم موجود مسبقًا!")
     except pyodbc.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 # Update User
 @app.put("/users/{id}")
-async def update_user(id: int, user: User, credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password, 'admin'):
+async def update_user(id: int, user: User, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, 'admin', db):
         raise HTTPException(status_code=401, detail="غير مصرح")
     hashed_pass = hashlib.sha256(user.Password.encode()).hexdigest() if user.Password else None
     try:
-        conn = get_db_connection_fastapi()
-        cursor = conn.cursor()
+        cursor = db.cursor()
         if hashed_pass:
             cursor.execute("UPDATE Users SET Username = ?, Password = ?, Role = ? WHERE ID = ?", (user.Username, hashed_pass, user.Role, id))
         else:
             cursor.execute("UPDATE Users SET Username = ?, Role = ? WHERE ID = ?", (user.Username, user.Role, id))
         if cursor.rowcount == 0:
             raise HTTPException(status_code=404, detail="المستخدم غير موجود!")
-        conn.commit()
+        bus.publish("auth", db)
+        audit_log.record(credentials.username, "update", "user", id, {"Username": user.Username, "Role": user.Role, "PasswordChanged": bool(hashed_pass)}, db)
         return {"message": "تم تعديل المستخدم!"}
     except pyodbc.IntegrityError:
         raise HTTPException(status_code=400, detail="اسم المستخدم موجود مسبقًا!")
     except pyodbc.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 # Delete User
 @app.delete("/users/{id}")
-async def delete_user(id: int, credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password, 'admin'):
+async def delete_user(id: int, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, 'admin', db):
         raise HTTPException(status_code=401, detail="غير مصرح")
     try:
-        conn = get_db_connection_fastapi()
-        cursor = conn.cursor()
+        cursor = db.cursor()
         cursor.execute("DELETE FROM Users WHERE ID = ?", (id,))
         if cursor.rowcount == 0:
             raise HTTPException(status_code=404, detail="المستخدم غير موجود!")
-        conn.commit()
+        bus.publish("auth", db)
+        audit_log.record(credentials.username, "delete", "user", id, db=db)
         return {"message": "تم حذف المستخدم!"}
     except pyodbc.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
+
+# Query Statistics (Admin Only)
+@app.get("/debug/queries")
+async def debug_queries(limit: int = 20, order: str = "total_ms", reset: bool = False, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, 'admin', db):
+        raise HTTPException(status_code=401, detail="غير مصرح")
+    if order not in ("total_ms", "max_ms", "avg_ms", "count", "rows"):
+        raise HTTPException(status_code=400, detail="ترتيب غير صالح!")
+    result = {"queries": query_stats.top(limit, order), "dropped": query_stats.dropped}
+    if reset:
+        query_stats.reset()
+    return result
+
+# Estimated Query Costs Before/After Managed Indexes (Admin Only)
+@app.get("/debug/indexes")
+async def debug_indexes(credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, 'admin', db):
+        raise HTTPException(status_code=401, detail="غير مصرح")
+    try:
+        return index_cost_report()
+    except pyodbc.Error as e:
+        raise HTTPException(status_code=500, detail=f"Failed to build index report: {str(e)}")
+
+# Admission Control State (Admin Only)
+@app.get("/debug/admission")
+async def debug_admission(credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, 'admin', db):
+        raise HTTPException(status_code=401, detail="غير مصرح")
+    return admission_controller.snapshot()
+
+# Audit Writer State (Admin Only)
+@app.get("/debug/audit")
+async def debug_audit(credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, 'admin', db):
+        raise HTTPException(status_code=401, detail="غير مصرح")
+    return audit_log.snapshot()
+
+# Sampling Profiler (Admin Only): ?seconds=30 for a time window, or ?route=/customers&requests=50
+# for the next N requests of one route. A session samples the worker that received the POST (in route
+# mode: that worker's requests); status/result/stop work from any worker with the returned id, which
+# defaults to the latest session. Download the result as collapsed stacks for a flamegraph.
+@app.post("/debug/profile")
+async def start_profile(seconds: float | None = Query(None, gt=0), route: str | None = None, requests: int | None = Query(None, ge=1), interval_ms: int = Query(PROFILER_DEFAULT_INTERVAL_MS, ge=1), credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, 'admin', db):
+        raise HTTPException(status_code=401, detail="غير مصرح")
+    if route is not None and route not in {r.path for r in app.routes}:
+        raise HTTPException(status_code=400, detail="مسار غير معروف!")
+    try:
+        session = profiler.start(seconds, route, requests, interval_ms)
+    except ProfilerBusy:
+        raise HTTPException(status_code=409, detail="يوجد تحليل أداء قيد التشغيل!")
+    return session.to_dict()
+
+@app.get("/debug/profile")
+async def get_profile_status(id: str | None = None, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, 'admin', db):
+        raise HTTPException(status_code=401, detail="غير مصرح")
+    return profiler.status(id or profiler.last_id()) or {"running": False}
+
+@app.delete("/debug/profile")
+async def stop_profile(id: str | None = None, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, 'admin', db):
+        raise HTTPException(status_code=401, detail="غير مصرح")
+    session_id = id or profiler.last_id()
+    await asyncio.to_thread(profiler.stop, session_id)
+    return profiler.status(session_id) or {"running": False}
+
+@app.get("/debug/profile/result")
+async def get_profile_result(id: str | None = None, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, 'admin', db):
+        raise HTTPException(status_code=401, detail="غير مصرح")
+    session_id = id or profiler.last_id()
+    collapsed = profiler.collapsed(session_id)
+    if collapsed is None:
+        raise HTTPException(status_code=404, detail="لا يوجد تحليل أداء!")
+    return PlainTextResponse(collapsed, headers={"Content-Disposition": f'attachment; filename="profile-{session_id}.collapsed"'})
+
+# Audit Log Query (Admin Only), e.g. ?filter=Entity:eq:customer&filter=EntityKey:eq:15
+@app.get("/audit")
+async def get_audit_log(response: Response, filters: list[str] = Query([], alias="filter"), sort: str = "", offset: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=LIST_PAGE_MAX), credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, 'admin', db):
+        raise HTTPException(status_code=401, detail="غير مصرح")
+    where, params = compile_query(filters, sort, AUDIT_FIELDS, "ID DESC", offset=offset, limit=limit)
+    try:
+        rows = await db.read(f"SELECT ID, At, Username, Action, Entity, EntityKey, Details FROM AuditLog {where}", params)
+        if offset == 0:
+            await set_total_count(response, db, "AuditLog", AUDIT_FIELDS, filters, [], [])
+        return [{"ID": row[0], "At": row[1].isoformat(), "Username": row[2], "Action": row[3], "Entity": row[4], "EntityKey": row[5], "Details": json.loads(row[6]) if row[6] else None} for row in rows]
+    except pyodbc.Error as e:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch audit log: {str(e)}")
+
+# Health Check (no auth, not throttled): answered from memory unless ?deep=1 asks for a round trip
+@app.get("/health")
+async def health(deep: bool = False):
+    breaker = db_breaker.snapshot()
+    status = {"closed": "ok", "half_open": "degraded", "open": "unavailable"}[breaker["state"]]
+    result = {"status": status, "database": breaker}
+    if deep and status != "unavailable":
+        db = UnitOfWork()
+        try:
+            await db.read("SELECT 1", retries=0)
+            result["database"]["reachable"] = True
+        except (HTTPException, pyodbc.Error) as e:
+            result["status"] = "unavailable"
+            result["database"]["reachable"] = False
+            result["database"]["error"] = str(getattr(e, "detail", e))
+        finally:
+            db.close()
+    return JSONResponse(result, status_code=503 if result["status"] == "unavailable" else 200)
+
+# Prometheus Metrics (Admin Only)
+@app.get("/metrics")
+async def get_metrics(credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, 'admin', db):
+        raise HTTPException(status_code=401, detail="غير مصرح")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
 
 # Protect Existing Routes
 @app.get("/", response_class=HTMLResponse)
-async def read_root(credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password):
+async def read_root(credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
         raise HTTPException(status_code=401, detail="غير مصرح")
-    with open("index.html", "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+    return HTMLResponse(content=read_page("index.html"))
 
 @app.get("/manage", response_class=HTMLResponse)
-async def manage_customers(credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password):
+async def manage_customers(credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
         raise HTTPException(status_code=401, detail="غير مصرح")
-    with open("manage.html", "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+    return HTMLResponse(content=read_page("manage.html"))
 
 @app.get("/serverip", response_class=HTMLResponse)
-async def manage_serverip(credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password):
+async def manage_serverip(credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
         raise HTTPException(status_code=401, detail="غير مصرح")
-    with open("serverip.html", "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+    return HTMLResponse(content=read_page("serverip.html"))
 
 @app.get("/custserver", response_class=HTMLResponse)
-async def manage_custserver(credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password):
+async def manage_custserver(credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
         raise HTTPException(status_code=401, detail="غير مصرح")
-    with open("custserver.html", "r", encoding="utf-8") as f:
-        return HTMLResponse(content=f.read())
+    return HTMLResponse(content=read_page("custserver.html"))
+
+# Paged list endpoints: the total is sent once, with the first page, for the table's scrollbar
+async def set_total_count(response, db, table, fields, filters, search_clauses, search_params):
+    where, params = compile_filters(filters, fields, search_clauses, search_params)
+    rows = await db.read(f"SELECT COUNT(*) FROM {table} {where}", params)
+    response.headers["X-Total-Count"] = str(rows[0][0])
+
+# Same list contract (DSL, search, paging, X-Total-Count) served from the in-memory read model.
+# Plain pages are slices of the key-ordered snapshot; queries that scan every row run in the
+# threadpool, and on large tables return None so the caller uses SQL and its indexes.
+async def list_from_memory(response, table, fields, search, search_fields, filters, sort, offset, limit):
+    rows = table.rows()
+    count = limit is not None and offset == 0
+    scan = bool(filters or search or sort)
+    if scan and len(rows) > READ_MODEL_SCAN_MAX_ROWS:
+        metrics.inc("read_model_sql_fallbacks_total", table=table.name)
+        return None
+
+    def run():
+        page, total = query_rows(rows, filters, sort, fields, search, search_fields, offset, limit, count)
+        return [row.to_dict() for row in page], total
+    if (scan or limit is None) and len(rows) > READ_MODEL_INLINE_ROWS:
+        result, total = await run_in_threadpool(run)
+    else:
+        result, total = run()
+    if count:
+        response.headers["X-Total-Count"] = str(total)
+    return result
+
+# ==== كتابة بجملة واحدة تعيد الصف ====
+# Writes return the affected row (OUTPUT INSERTED...) so pages patch one table row instead of reloading the list
+CUSTOMER_COLUMNS = ("ID", "CustomerNumber", "Name", "Phone", "Email", "Address", "TaxNumber", "NationalAddress")
+SERVERIP_COLUMNS = ("IP", "[USER]", "[PASS]", "SERVER_EMAIL", "EMAIL_PASS")
+
+def inserted(columns):
+    return ", ".join(f"INSERTED.{column}" for column in columns)
+
+def customer_dict(row):
+    return dict(zip(CUSTOMER_COLUMNS, row))
+
+def serverip_dict(row):
+    return {"IP": row[0], "USER": row[1], "PASS": row[2], "SERVER_EMAIL": row[3], "EMAIL_PASS": row[4]}
+
+# Next CUSTnnnn number, computed inside the INSERT/UPDATE that uses it (locked until commit)
+NEXT_CUSTOMER_NUMBER = "(SELECT 'CUST' + FORMAT(ISNULL(MAX(CustomerSeq), 0) + 1, '0000') FROM Customers WITH (UPDLOCK, HOLDLOCK))"
 
 @app.get("/customers")
-async def get_customers(search: str = "", credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password):
+async def get_customers(response: Response, search: str = "", filters: list[str] = Query([], alias="filter"), sort: str = "", offset: int = Query(0, ge=0), limit: int | None = Query(None, ge=1, le=LIST_PAGE_MAX), credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
         raise HTTPException(status_code=401, detail="غير مصرح")
-    conn = get_db_connection_fastapi()
-    cursor = conn.cursor()
-    query = """
+    search_clauses, search_params = search_sql(search, ("Name", "CustomerNumber"))
+    where, params = compile_query(filters, sort, CUSTOMERS_FIELDS, "ID", search_clauses, search_params, offset, limit)
+    query = f"""
         SELECT ID, CustomerNumber, Name, Phone, Email, Address, TaxNumber, NationalAddress 
         FROM Customers 
-        WHERE Name LIKE ? OR CustomerNumber LIKE ?
+        {where}
     """
-    params = (f'%{search}%', f'%{search}%') if search else ('%', '%')
     try:
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        return [{"ID": row[0], "CustomerNumber": row[1], "Name": row[2], "Phone": row[3], "Email": row[4], "Address": row[5], "TaxNumber": row[6], "NationalAddress": row[7]} for row in rows]
+        rows = await db.read(query, params)
+        if limit is not None and offset == 0:
+            await set_total_count(response, db, "Customers", CUSTOMERS_FIELDS, filters, search_clauses, search_params)
+        return [customer_dict(row) for row in rows]
     except pyodbc.Error as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch customers: {str(e)}")
-    finally:
-        conn.close()
 
 @app.post("/customers")
-async def add_customer(customer: Customer, credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password):
+async def add_customer(customer: Customer, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
         raise HTTPException(status_code=401, detail="غير مصرح")
     if not customer.Name:
         raise HTTPException(status_code=400, detail="الاسم مطلوب!")
@@ -227,26 +486,36 @@ async def add_customer(customer: Customer, credentials: HTTPBasicCredentials = D
     if customer.TaxNumber and not is_valid_numeric(customer.TaxNumber):
         raise HTTPException(status_code=400, detail="الرقم الضريبي يجب أن يكون أرقام فقط!")
     
-    customer_number = customer.CustomerNumber or generate_customer_number_fastapi()
+    duplicates = dedupe_index.find(customer.Name, customer.Phone, customer.TaxNumber)
     try:
-        conn = get_db_connection_fastapi()
-        cursor = conn.cursor()
-        cursor.execute("""
+        cursor = db.cursor()
+        number_sql = "?" if customer.CustomerNumber else NEXT_CUSTOMER_NUMBER
+        number_params = (customer.CustomerNumber,) if customer.CustomerNumber else ()
+        cursor.execute(f"""
             INSERT INTO Customers (CustomerNumber, Name, Phone, Email, Address, TaxNumber, NationalAddress) 
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (customer_number, customer.Name, customer.Phone, customer.Email, customer.Address, customer.TaxNumber, customer.NationalAddress))
-        conn.commit()
-        return {"message": "تم إضافة العميل!"}
+            OUTPUT {inserted(CUSTOMER_COLUMNS)}
+            SELECT {number_sql}, ?, ?, ?, ?, ?, ?
+        """, (*number_params, customer.Name, customer.Phone, customer.Email, customer.Address, customer.TaxNumber, customer.NationalAddress))
+        row = customer_dict(cursor.fetchone())
+        bus.publish("customers", db)
+        db.on_commit(lambda: dedupe_index.upsert(row["ID"], row["CustomerNumber"], row["Name"], row["Phone"], row["TaxNumber"]))
+        audit_log.record(credentials.username, "create", "customer", row["ID"], row, db)
+        return {"message": "تم إضافة العميل!", "ID": row["ID"], "row": row, "duplicates": duplicates}
     except pyodbc.IntegrityError:
         raise HTTPException(status_code=400, detail="رقم العميل موجود مسبقًا!")
     except pyodbc.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
+
+# Likely duplicates of a customer being typed in (same matching as POST/PUT /customers)
+@app.get("/customers/duplicates")
+async def find_duplicate_customers(name: str, phone: str | None = None, tax_number: str | None = None, exclude_id: int | None = None, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
+        raise HTTPException(status_code=401, detail="غير مصرح")
+    return dedupe_index.find(name, phone, tax_number, exclude_id)
 
 @app.put("/customers/{id}")
-async def update_customer(id: int, customer: Customer, credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password):
+async def update_customer(id: int, customer: Customer, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
         raise HTTPException(status_code=401, detail="غير مصرح")
     if not customer.Name:
         raise HTTPException(status_code=400, detail="الاسم مطلوب!")
@@ -257,50 +526,96 @@ async def update_customer(id: int, customer: Customer, credentials: HTTPBasicCre
     if customer.TaxNumber and not is_valid_numeric(customer.TaxNumber):
         raise HTTPException(status_code=400, detail="الرقم الضريبي يجب أن يكون أرقام فقط!")
     
+    duplicates = dedupe_index.find(customer.Name, customer.Phone, customer.TaxNumber, exclude_id=id)
     try:
-        conn = get_db_connection_fastapi()
-        cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE Customers SET CustomerNumber = ?, Name = ?, Phone = ?, Email = ?, Address = ?, TaxNumber = ?, NationalAddress = ? 
+        cursor = db.cursor()
+        number_sql = "?" if customer.CustomerNumber else NEXT_CUSTOMER_NUMBER
+        number_params = (customer.CustomerNumber,) if customer.CustomerNumber else ()
+        cursor.execute(f"""
+            UPDATE Customers SET CustomerNumber = {number_sql}, Name = ?, Phone = ?, Email = ?, Address = ?, TaxNumber = ?, NationalAddress = ? 
+            OUTPUT {inserted(CUSTOMER_COLUMNS)}
             WHERE ID = ?
-        """, (customer.CustomerNumber or generate_customer_number_fastapi(), customer.Name, customer.Phone, customer.Email, customer.Address, customer.TaxNumber, customer.NationalAddress, id))
-        if cursor.rowcount == 0:
+        """, (*number_params, customer.Name, customer.Phone, customer.Email, customer.Address, customer.TaxNumber, customer.NationalAddress, id))
+        updated = cursor.fetchone()
+        if updated is None:
             raise HTTPException(status_code=404, detail="العميل غير موجود!")
-        conn.commit()
-        return {"message": "تم تعديل العميل!"}
+        row = customer_dict(updated)
+        bus.publish("customers", db)
+        db.on_commit(lambda: dedupe_index.upsert(id, row["CustomerNumber"], row["Name"], row["Phone"], row["TaxNumber"]))
+        audit_log.record(credentials.username, "update", "customer", id, row, db)
+        return {"message": "تم تعديل العميل!", "row": row, "duplicates": duplicates}
     except pyodbc.IntegrityError:
         raise HTTPException(status_code=400, detail="رقم العميل موجود مسبقًا!")
     except pyodbc.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.delete("/customers/{id}")
-async def delete_customer(id: int, credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password):
+async def delete_customer(id: int, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
         raise HTTPException(status_code=401, detail="غير مصرح")
     try:
-        conn = get_db_connection_fastapi()
-        cursor = conn.cursor()
+        cursor = db.cursor()
         cursor.execute("DELETE FROM Customers WHERE ID = ?", (id,))
         if cursor.rowcount == 0:
             raise HTTPException(status_code=404, detail="العميل غير موجود!")
-        conn.commit()
+        bus.publish("customers", db)
+        db.on_commit(lambda: dedupe_index.remove(id))
+        # FK_CUSTSERVER_Customers is ON DELETE SET NULL
+        bus.publish("custserver", db)
+        db.on_commit(lambda: read_model.custservers.update_where(lambda row: row.CustomerID == id, CustomerID=None))
+        audit_log.record(credentials.username, "delete", "customer", id, db=db)
         return {"message": "تم حذف العميل!"}
     except pyodbc.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
+
+# Customer-360: the customer, its CUSTSERVER rows and their global servers in one query
+# (IX_CUSTSERVER_CustomerID seek + SERVERIP primary key lookups). Passwords are never included.
+CUSTOMER_OVERVIEW_QUERY = """
+    SELECT c.ID, c.CustomerNumber, c.Name, c.Phone, c.Email, c.Address, c.TaxNumber, c.NationalAddress,
+           cs.ID, cs.CustomerName, cs.LinkOrNot, cs.[Number], cs.GlobalServerIP, cs.ServerName, cs.DatabaseName,
+           cs.ConnectionType, cs.ConnectedDevices, cs.Notes,
+           s.IP, s.[USER], s.SERVER_EMAIL
+    FROM Customers c
+    LEFT JOIN CUSTSERVER cs ON cs.CustomerID = c.ID
+    LEFT JOIN SERVERIP s ON s.IP = cs.GlobalServerIP
+    WHERE c.ID = ?
+    ORDER BY cs.GlobalServerIP, cs.[Number]
+"""
+
+@app.get("/customers/{id}/overview")
+async def get_customer_overview(id: int, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
+        raise HTTPException(status_code=401, detail="غير مصرح")
+    try:
+        rows = await db.read(CUSTOMER_OVERVIEW_QUERY, (id,))
+    except pyodbc.Error as e:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch customer overview: {str(e)}")
+    if not rows:
+        raise HTTPException(status_code=404, detail="العميل غير موجود!")
+    first = rows[0]
+    customer = {"ID": first[0], "CustomerNumber": first[1], "Name": first[2], "Phone": first[3], "Email": first[4], "Address": first[5], "TaxNumber": first[6], "NationalAddress": first[7]}
+    custservers, servers = [], {}
+    for row in rows:
+        if row[8] is None:
+            continue  # customer without CUSTSERVER rows (LEFT JOIN)
+        custservers.append({"ID": row[8], "CustomerName": row[9], "LinkOrNot": bool(row[10]), "Number": row[11], "GlobalServerIP": row[12], "ServerName": row[13], "DatabaseName": row[14], "ConnectionType": row[15], "ConnectedDevices": row[16], "Notes": row[17]})
+        if row[18] is None:
+            continue
+        server = servers.get(row[18])
+        if server is None:
+            status = prober.status.get(row[18])
+            server = servers[row[18]] = {"IP": row[18], "USER": row[19], "SERVER_EMAIL": row[20], "Rows": 0, "ConnectedDevices": 0,
+                                         "Reachable": status["Reachable"] if status else None, "CheckedAt": status["CheckedAt"] if status else None}
+        server["Rows"] += 1
+        server["ConnectedDevices"] += row[16] or 0
+    return {"customer": customer, "custservers": custservers, "servers": list(servers.values())}
 
 @app.get("/export")
-async def export_to_csv(credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password):
+async def export_to_csv(credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
         raise HTTPException(status_code=401, detail="غير مصرح")
-    conn = get_db_connection_fastapi()
-    cursor = conn.cursor()
     try:
-        cursor.execute("SELECT ID, CustomerNumber, Name, Phone, Email, Address, TaxNumber, NationalAddress FROM Customers")
-        rows = cursor.fetchall()
+        rows = await db.read("SELECT ID, CustomerNumber, Name, Phone, Email, Address, TaxNumber, NationalAddress FROM Customers")
         output = StringIO()
         writer = csv.writer(output)
         writer.writerow(["ID", "CustomerNumber", "Name", "Phone", "Email", "Address", "TaxNumber", "NationalAddress"])
@@ -313,208 +628,314 @@ async def export_to_csv(credentials: HTTPBasicCredentials = Depends(security)):
         )
     except pyodbc.Error as e:
         raise HTTPException(status_code=500, detail=f"Failed to export data: {str(e)}")
-    finally:
-        conn.close()
+
+# Background Jobs (large exports/imports)
+@app.post("/jobs", status_code=202)
+async def create_job(kind: str = Form(...), table: str = Form("customers"), file: UploadFile | None = File(None), credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
+        raise HTTPException(status_code=401, detail="غير مصرح")
+    job = Job(kind, credentials.username)
+    if kind == "export":
+        if table not in EXPORTS:
+            raise HTTPException(status_code=400, detail="جدول غير معروف!")
+        job.params["table"] = table
+    elif kind == "import_customers":
+        if file is None:
+            raise HTTPException(status_code=400, detail="ملف CSV مطلوب!")
+        source = job_runner.spool_path(job, ".upload.csv")
+        with open(source, "wb") as out:
+            shutil.copyfileobj(file.file, out)
+        job.params["source"] = source
+    elif kind not in ("duplicates", "link_customers"):
+        raise HTTPException(status_code=400, detail="نوع مهمة غير معروف!")
+    try:
+        job_runner.submit(job)
+        if kind == "import_customers":
+            audit_log.record(credentials.username, "import", "customer", job.id, {"File": file.filename}, db)
+    except JobQueueFull:
+        if "source" in job.params:
+            os.remove(job.params["source"])
+        raise HTTPException(status_code=503, detail="قائمة المهام ممتلئة، حاول لاحقًا", headers={"Retry-After": "30"})
+    return job.to_dict()
+
+def get_own_job(job_id, username):
+    job = job_runner.get(job_id)
+    if job is None or job.owner != username:
+        raise HTTPException(status_code=404, detail="المهمة غير موجودة!")
+    return job
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
+        raise HTTPException(status_code=401, detail="غير مصرح")
+    return get_own_job(job_id, credentials.username).to_dict()
+
+# FileResponse handles Range requests, so large downloads can resume
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
+        raise HTTPException(status_code=401, detail="غير مصرح")
+    job = get_own_job(job_id, credentials.username)
+    if job.status != "done" or job.result_path is None:
+        raise HTTPException(status_code=409, detail="النتيجة غير جاهزة!")
+    if not os.path.exists(job.result_path):
+        raise HTTPException(status_code=410, detail="انتهت صلاحية النتيجة!")
+    return FileResponse(job.result_path, media_type=job.media_type, filename=job.result_name)
 
 # Routes for SERVERIP
 @app.get("/serverip/data")
-async def get_serverip(search: str = "", credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password):
+async def get_serverip(response: Response, search: str = "", filters: list[str] = Query([], alias="filter"), sort: str = "", offset: int = Query(0, ge=0), limit: int | None = Query(None, ge=1, le=LIST_PAGE_MAX), credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
         raise HTTPException(status_code=401, detail="غير مصرح")
-    conn = get_db_connection_fastapi()
-    cursor = conn.cursor()
-    query = """
+    if read_model.servers.loaded:
+        result = await list_from_memory(response, read_model.servers, SERVERIP_FIELDS, search, ("IP", "USER"), filters, sort, offset, limit)
+        if result is not None:
+            return result
+    search_clauses, search_params = search_sql(search, ("IP", "[USER]"))
+    where, params = compile_query(filters, sort, SERVERIP_FIELDS, "IP", search_clauses, search_params, offset, limit)
+    query = f"""
         SELECT IP, [USER], [PASS], SERVER_EMAIL, EMAIL_PASS 
         FROM SERVERIP 
-        WHERE IP LIKE ? OR [USER] LIKE ?
+        {where}
     """
-    params = (f'%{search}%', f'%{search}%') if search else ('%', '%')
     try:
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        return [{"IP": row[0], "USER": row[1], "PASS": row[2], "SERVER_EMAIL": row[3], "EMAIL_PASS": row[4]} for row in rows]
+        rows = await db.read(query, params)
+        if limit is not None and offset == 0:
+            await set_total_count(response, db, "SERVERIP", SERVERIP_FIELDS, filters, search_clauses, search_params)
+        return [serverip_dict(row) for row in rows]
     except pyodbc.Error as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch SERVERIP: {str(e)}")
-    finally:
-        conn.close()
+
+@app.get("/serverip/status")
+async def get_serverip_status(history: bool = False, refresh: bool = False, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
+        raise HTTPException(status_code=401, detail="غير مصرح")
+    if refresh:
+        await prober.sweep()
+    return {"LastSweep": prober.last_sweep, "Servers": prober.snapshot(history)}
 
 @app.post("/serverip")
-async def add_serverip(serverip: ServerIP, credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password):
+async def add_serverip(serverip: ServerIP, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
         raise HTTPException(status_code=401, detail="غير مصرح")
     if not serverip.IP:
         raise HTTPException(status_code=400, detail="IP مطلوب!")
     
     try:
-        conn = get_db_connection_fastapi()
-        cursor = conn.cursor()
-        cursor.execute("""
+        cursor = db.cursor()
+        cursor.execute(f"""
             INSERT INTO SERVERIP (IP, [USER], [PASS], SERVER_EMAIL, EMAIL_PASS) 
+            OUTPUT {inserted(SERVERIP_COLUMNS)}
             VALUES (?, ?, ?, ?, ?)
         """, (serverip.IP, serverip.USER, serverip.PASS, serverip.SERVER_EMAIL, serverip.EMAIL_PASS))
-        conn.commit()
-        return {"message": "تم إضافة SERVERIP!"}
+        values = tuple(cursor.fetchone())
+        bus.publish("lists", db)
+        db.on_commit(lambda: read_model.servers.upsert(*values))
+        audit_log.record(credentials.username, "create", "serverip", serverip.IP, serverip, db)
+        return {"message": "تم إضافة SERVERIP!", "row": serverip_dict(values)}
     except pyodbc.IntegrityError:
         raise HTTPException(status_code=400, detail="IP موجود مسبقًا!")
     except pyodbc.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.put("/serverip/{ip}")
-async def update_serverip(ip: str, serverip: ServerIP, credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password):
+async def update_serverip(ip: str, serverip: ServerIP, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
         raise HTTPException(status_code=401, detail="غير مصرح")
     try:
-        conn = get_db_connection_fastapi()
-        cursor = conn.cursor()
-        cursor.execute("""
+        cursor = db.cursor()
+        cursor.execute(f"""
             UPDATE SERVERIP SET [USER] = ?, [PASS] = ?, SERVER_EMAIL = ?, EMAIL_PASS = ? 
+            OUTPUT {inserted(SERVERIP_COLUMNS)}
             WHERE IP = ?
         """, (serverip.USER, serverip.PASS, serverip.SERVER_EMAIL, serverip.EMAIL_PASS, ip))
-        if cursor.rowcount == 0:
+        updated = cursor.fetchone()
+        if updated is None:
             raise HTTPException(status_code=404, detail="SERVERIP غير موجود!")
-        conn.commit()
-        return {"message": "تم تعديل SERVERIP!"}
+        values = tuple(updated)
+        bus.publish("lists", db)
+        db.on_commit(lambda: read_model.servers.upsert(*values))
+        audit_log.record(credentials.username, "update", "serverip", ip, serverip, db)
+        return {"message": "تم تعديل SERVERIP!", "row": serverip_dict(values)}
     except pyodbc.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.delete("/serverip/{ip}")
-async def delete_serverip(ip: str, credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password):
+async def delete_serverip(ip: str, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
         raise HTTPException(status_code=401, detail="غير مصرح")
     try:
-        conn = get_db_connection_fastapi()
-        cursor = conn.cursor()
+        cursor = db.cursor()
         cursor.execute("DELETE FROM SERVERIP WHERE IP = ?", (ip,))
         if cursor.rowcount == 0:
             raise HTTPException(status_code=404, detail="SERVERIP غير موجود!")
-        conn.commit()
+        bus.publish("lists", db)
+        db.on_commit(lambda: read_model.servers.remove(ip))
+        audit_log.record(credentials.username, "delete", "serverip", ip, db=db)
         return {"message": "تم حذف SERVERIP!"}
     except pyodbc.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 # Routes for CUSTSERVER
+# Join the last reachability result of each row's global server
+def add_server_status(result):
+    for item in result:
+        status = prober.status.get(item["GlobalServerIP"])
+        item["ServerReachable"] = status["Reachable"] if status else None
+        item["ServerCheckedAt"] = status["CheckedAt"] if status else None
+
 @app.get("/custserver/data")
-async def get_custserver(search: str = "", credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password):
+async def get_custserver(response: Response, search: str = "", filters: list[str] = Query([], alias="filter"), sort: str = "", offset: int = Query(0, ge=0), limit: int | None = Query(None, ge=1, le=LIST_PAGE_MAX), include_status: bool = False, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
         raise HTTPException(status_code=401, detail="غير مصرح")
-    conn = get_db_connection_fastapi()
-    cursor = conn.cursor()
-    query = """
-        SELECT ID, CustomerName, LinkOrNot, [Number], GlobalServerIP, ServerName, DatabaseName, ConnectionType, ConnectedDevices, Notes 
+    if read_model.custservers.loaded:
+        result = await list_from_memory(response, read_model.custservers, CUSTSERVER_FIELDS, search, ("CustomerName", "ServerName"), filters, sort, offset, limit)
+        if result is not None:
+            if include_status:
+                add_server_status(result)
+            return result
+    search_clauses, search_params = search_sql(search, ("CustomerName", "ServerName"))
+    where, params = compile_query(filters, sort, CUSTSERVER_FIELDS, "ID", search_clauses, search_params, offset, limit)
+    query = f"""
+        SELECT ID, CustomerName, LinkOrNot, [Number], GlobalServerIP, ServerName, DatabaseName, ConnectionType, ConnectedDevices, Notes, CustomerID 
         FROM CUSTSERVER 
-        WHERE CustomerName LIKE ? OR ServerName LIKE ?
+        {where}
     """
-    params = (f'%{search}%', f'%{search}%') if search else ('%', '%')
     try:
-        cursor.execute(query, params)
-        rows = cursor.fetchall()
-        return [{"ID": row[0], "CustomerName": row[1], "LinkOrNot": bool(row[2]), "Number": row[3], "GlobalServerIP": row[4], "ServerName": row[5], "DatabaseName": row[6], "ConnectionType": row[7], "ConnectedDevices": row[8], "Notes": row[9]} for row in rows]
+        rows = await db.read(query, params)
+        if limit is not None and offset == 0:
+            await set_total_count(response, db, "CUSTSERVER", CUSTSERVER_FIELDS, filters, search_clauses, search_params)
+        result = [CustServerRow(*row).to_dict() for row in rows]
+        if include_status:
+            add_server_status(result)
+        return result
     except pyodbc.Error as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch CUSTSERVER: {str(e)}")
-    finally:
-        conn.close()
+
+@app.get("/custserver/stats")
+async def get_custserver_stats(credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
+        raise HTTPException(status_code=401, detail="غير مصرح")
+    query = """
+        SELECT s.IP, v.ConnectionType, v.RowCnt, v.LinkedCount, v.DevicesSum
+        FROM SERVERIP s
+        LEFT JOIN CUSTSERVER_STATS v WITH (NOEXPAND) ON v.GlobalServerIP = s.IP
+        ORDER BY s.IP
+    """
+    try:
+        stats = {}
+        for ip, connection_type, rows, linked, devices in await db.read(query):
+            entry = stats.setdefault(ip, {"GlobalServerIP": ip, "Rows": 0, "Linked": 0, "ConnectedDevices": 0, "ByConnectionType": {}})
+            if rows is None:
+                continue
+            entry["Rows"] += rows
+            entry["Linked"] += linked
+            entry["ConnectedDevices"] += devices
+            entry["ByConnectionType"][connection_type or ""] = {"Rows": rows, "Linked": linked, "ConnectedDevices": devices}
+        return list(stats.values())
+    except pyodbc.Error as e:
+        raise HTTPException(status_code=500, detail=f"Failed to fetch CUSTSERVER stats: {str(e)}")
 
 @app.get("/global_ips")
-async def get_global_ips(credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password):
+async def get_global_ips(credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
         raise HTTPException(status_code=401, detail="غير مصرح")
-    conn = get_db_connection_fastapi()
-    cursor = conn.cursor()
+    if read_model.servers.loaded:
+        return [{"IP": ip} for ip in sorted(row.IP for row in read_model.servers.rows())]
+    cached = list_cache.get("global_ips")
+    if cached is not None:
+        return cached
     try:
-        cursor.execute("SELECT IP FROM SERVERIP")
-        rows = cursor.fetchall()
-        return [{"IP": row[0]} for row in rows]
+        rows = await db.read("SELECT IP FROM SERVERIP")
+        result = [{"IP": row[0]} for row in rows]
+        list_cache.set("global_ips", result)
+        return result
     except pyodbc.Error as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch global IPs: {str(e)}")
-    finally:
-        conn.close()
+
+# CustomerID for a CUSTSERVER write: the given/normalized-name match, else the one customer with exactly this name
+CUSTOMER_ID_BY_NAME = "COALESCE(?, (SELECT MIN(ID) FROM Customers WHERE Name = LTRIM(RTRIM(?)) HAVING COUNT(*) = 1))"
+CUSTSERVER_COLUMNS = ("ID", "CustomerName", "LinkOrNot", "[Number]", "GlobalServerIP", "ServerName", "DatabaseName", "ConnectionType", "ConnectedDevices", "Notes", "CustomerID")
 
 @app.post("/custserver")
-async def add_custserver(custserver: CustServer, credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password):
+async def add_custserver(custserver: CustServer, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
         raise HTTPException(status_code=401, detail="غير مصرح")
     if not custserver.CustomerName or not custserver.GlobalServerIP:
         raise HTTPException(status_code=400, detail="اسم العميل وايبي السيرفر العالمي مطلوبان!")
     
     try:
-        conn = get_db_connection_fastapi()
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM CUSTSERVER WHERE GlobalServerIP = ?", (custserver.GlobalServerIP,))
-        count = cursor.fetchone()[0]
-        number = count + 1
-        
-        cursor.execute("""
-            INSERT INTO CUSTSERVER (CustomerName, LinkOrNot, [Number], GlobalServerIP, ServerName, DatabaseName, ConnectionType, ConnectedDevices, Notes) 
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (custserver.CustomerName, custserver.LinkOrNot, number, custserver.GlobalServerIP, custserver.ServerName, custserver.DatabaseName, custserver.ConnectionType, custserver.ConnectedDevices, custserver.Notes))
-        conn.commit()
-        return {"message": "تم إضافة CUSTSERVER!"}
+        cursor = db.cursor()
+        customer_id = custserver.CustomerID or dedupe_index.match_name(custserver.CustomerName)
+        cursor.execute(f"""
+            INSERT INTO CUSTSERVER (CustomerName, LinkOrNot, [Number], GlobalServerIP, ServerName, DatabaseName, ConnectionType, ConnectedDevices, Notes, CustomerID) 
+            OUTPUT {inserted(CUSTSERVER_COLUMNS)}
+            SELECT ?, ?, n.NextNumber, ?, ?, ?, ?, ?, ?, {CUSTOMER_ID_BY_NAME}
+            FROM (SELECT COUNT(*) + 1 AS NextNumber FROM CUSTSERVER WITH (UPDLOCK, HOLDLOCK) WHERE GlobalServerIP = ?) n
+        """, (custserver.CustomerName, custserver.LinkOrNot, custserver.GlobalServerIP, custserver.ServerName, custserver.DatabaseName, custserver.ConnectionType, custserver.ConnectedDevices, custserver.Notes, customer_id, custserver.CustomerName, custserver.GlobalServerIP))
+        row = CustServerRow(*cursor.fetchone())
+        bus.publish("custserver", db)
+        db.on_commit(lambda: read_model.custservers.upsert(*row.values()))
+        audit_log.record(credentials.username, "create", "custserver", row.ID, row.to_dict(), db)
+        return {"message": "تم إضافة CUSTSERVER!", "row": row.to_dict()}
+    except pyodbc.IntegrityError:
+        raise HTTPException(status_code=400, detail="العميل أو ايبي السيرفر العالمي غير موجود!")
     except pyodbc.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.put("/custserver/{id}")
-async def update_custserver(id: int, custserver: CustServer, credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password):
+async def update_custserver(id: int, custserver: CustServer, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
         raise HTTPException(status_code=401, detail="غير مصرح")
     try:
-        conn = get_db_connection_fastapi()
-        cursor = conn.cursor()
-        cursor.execute("SELECT GlobalServerIP FROM CUSTSERVER WHERE ID = ?", (id,))
-        result = cursor.fetchone()
-        if not result:
-            raise HTTPException(status_code=404, detail="CUSTSERVER غير موجود!")
-        old_ip = result[0]
-        if custserver.GlobalServerIP != old_ip:
-            cursor.execute("SELECT COUNT(*) FROM CUSTSERVER WHERE GlobalServerIP = ?", (custserver.GlobalServerIP,))
-            count = cursor.fetchone()[0]
-            number = count + 1
-        else:
-            cursor.execute("SELECT [Number] FROM CUSTSERVER WHERE ID = ?", (id,))
-            number = cursor.fetchone()[0]
-        
-        cursor.execute("""
-            UPDATE CUSTSERVER SET CustomerName = ?, LinkOrNot = ?, [Number] = ?, GlobalServerIP = ?, ServerName = ?, DatabaseName = ?, ConnectionType = ?, ConnectedDevices = ?, Notes = ? 
+        cursor = db.cursor()
+        customer_id = custserver.CustomerID or dedupe_index.match_name(custserver.CustomerName)
+        # A row moved to another global server gets the next number there; otherwise it keeps its own
+        cursor.execute(f"""
+            UPDATE CUSTSERVER SET CustomerName = ?, LinkOrNot = ?,
+                [Number] = CASE WHEN GlobalServerIP = ? THEN [Number]
+                                ELSE (SELECT COUNT(*) + 1 FROM CUSTSERVER n WITH (UPDLOCK, HOLDLOCK) WHERE n.GlobalServerIP = ?) END,
+                GlobalServerIP = ?, ServerName = ?, DatabaseName = ?, ConnectionType = ?, ConnectedDevices = ?, Notes = ?, CustomerID = {CUSTOMER_ID_BY_NAME} 
+            OUTPUT {inserted(CUSTSERVER_COLUMNS)}
             WHERE ID = ?
-        """, (custserver.CustomerName, custserver.LinkOrNot, number, custserver.GlobalServerIP, custserver.ServerName, custserver.DatabaseName, custserver.ConnectionType, custserver.ConnectedDevices, custserver.Notes, id))
-        if cursor.rowcount == 0:
+        """, (custserver.CustomerName, custserver.LinkOrNot, custserver.GlobalServerIP, custserver.GlobalServerIP, custserver.GlobalServerIP, custserver.ServerName, custserver.DatabaseName, custserver.ConnectionType, custserver.ConnectedDevices, custserver.Notes, customer_id, custserver.CustomerName, id))
+        updated = cursor.fetchone()
+        if updated is None:
             raise HTTPException(status_code=404, detail="CUSTSERVER غير موجود!")
-        conn.commit()
-        return {"message": "تم تعديل CUSTSERVER!"}
+        row = CustServerRow(*updated)
+        bus.publish("custserver", db)
+        db.on_commit(lambda: read_model.custservers.upsert(*row.values()))
+        audit_log.record(credentials.username, "update", "custserver", id, row.to_dict(), db)
+        return {"message": "تم تعديل CUSTSERVER!", "row": row.to_dict()}
+    except pyodbc.IntegrityError:
+        raise HTTPException(status_code=400, detail="العميل أو ايبي السيرفر العالمي غير موجود!")
     except pyodbc.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 @app.delete("/custserver/{id}")
-async def delete_custserver(id: int, credentials: HTTPBasicCredentials = Depends(security)):
-    if not validate_user(credentials.username, credentials.password):
+async def delete_custserver(id: int, credentials: HTTPBasicCredentials = Depends(security), db: UnitOfWork = Depends(get_db)):
+    if not validate_user(credentials.username, credentials.password, db=db):
         raise HTTPException(status_code=401, detail="غير مصرح")
     try:
-        conn = get_db_connection_fastapi()
-        cursor = conn.cursor()
+        cursor = db.cursor()
         cursor.execute("DELETE FROM CUSTSERVER WHERE ID = ?", (id,))
         if cursor.rowcount == 0:
             raise HTTPException(status_code=404, detail="CUSTSERVER غير موجود!")
-        conn.commit()
+        bus.publish("custserver", db)
+        db.on_commit(lambda: read_model.custservers.remove(id))
+        audit_log.record(credentials.username, "delete", "custserver", id, db=db)
         return {"message": "تم حذف CUSTSERVER!"}
     except pyodbc.Error as e:
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        conn.close()
 
 if __name__ == "__main__":
     import uvicorn
-    import os
     if os.environ.get("NGROK_AUTHTOKEN"):
         from pyngrok import ngrok
         public_url = ngrok.connect(8000).public_url
         print(f" * ngrok tunnel \"{public_url}\" -> \"http://127.0.0.1:8000\"")
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    if WEB_CONCURRENCY > 1:
+        # Each worker process gets its own ODBC connection pool and caches; the bus keeps caches coherent
+        uvicorn.run("main:app", host="127.0.0.1", port=8000, workers=WEB_CONCURRENCY)
+    else:
+        uvicorn.run(app, host="127.0.0.1", port=8000)
@@ -0,0 +1,46 @@
+import threading
+
+# Minimal Prometheus text exposition: counters incremented in code plus collectors that
+# report the current state of other components (circuit breaker, admission, audit, ...)
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._descriptions = {}
+        self._collectors = []
+
+    def describe(self, name, kind, help_text):
+        self._descriptions[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    # collector() returns [(name, {labels}, value), ...]
+    def register(self, collector):
+        self._collectors.append(collector)
+
+    def samples(self):
+        with self._lock:
+            samples = [(name, dict(labels), value) for (name, labels), value in self._counters.items()]
+        for collector in self._collectors:
+            samples.extend(collector())
+        return samples
+
+    def render(self):
+        by_name = {}
+        for name, labels, value in self.samples():
+            by_name.setdefault(name, []).append((labels, value))
+        lines = []
+        for name in sorted(by_name):
+            if name in self._descriptions:
+                kind, help_text = self._descriptions[name]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+            for labels, value in by_name[name]:
+                label_text = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+                lines.append(f"{name}{{{label_text}}} {float(value)}" if label_text else f"{name} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
@@ -25,6 +25,7 @@ class CustServer(BaseModel):
     ConnectionType: str | None = None
     ConnectedDevices: int = 0
     Notes: str | None = None
+    CustomerID: int | None = None  # resolved from CustomerName when not given
 
 class User(BaseModel):
     Username: str
@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import logging
+from collections import deque
+from config import (
+    PROBE_PORTS, PROBE_TIMEOUT_SECONDS, PROBE_CONCURRENCY, PROBE_INTERVAL_SECONDS, PROBE_HISTORY, PROBE_LEASE_SECONDS,
+)
+from database import get_db_connection_fastapi, acquire_lease
+
+logger = logging.getLogger("prober")
+
+def load_server_ips():
+    conn = get_db_connection_fastapi()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT IP FROM SERVERIP")
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+# ==== الحالة المشتركة بين الـ workers ====
+LEASE_NAME = "prober"
+
+# Replace the stored sweep with this one (the table lock makes concurrent saves queue up, not deadlock)
+def save_status(status, history, last_sweep):
+    conn = get_db_connection_fastapi(autocommit=False)
+    try:
+        cursor = conn.cursor()
+        cursor.fast_executemany = True
+        cursor.execute("DELETE FROM ServerStatus WITH (TABLOCKX)")
+        rows = [(ip, item["Reachable"], json.dumps(item["OpenPorts"]), item["LatencyMs"], item["Error"],
+                 item["CheckedAt"], json.dumps(list(history.get(ip, ())))) for ip, item in status.items()]
+        if rows:
+            cursor.executemany("""
+                INSERT INTO ServerStatus (IP, Reachable, OpenPorts, LatencyMs, Error, CheckedAt, History)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, rows)
+        cursor.execute("UPDATE Leases SET Info = ? WHERE Name = ?", (json.dumps(last_sweep), LEASE_NAME))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+def load_status():
+    conn = get_db_connection_fastapi()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT IP, Reachable, OpenPorts, LatencyMs, Error, CheckedAt, History FROM ServerStatus")
+        status, history = {}, {}
+        for ip, reachable, open_ports, latency_ms, error, checked_at, entries in cursor.fetchall():
+            status[ip] = {
+                "IP": ip,
+                "Reachable": bool(reachable),
+                "OpenPorts": {int(port): value for port, value in json.loads(open_ports or "{}").items()},
+                "LatencyMs": latency_ms,
+                "Error": error,
+                "CheckedAt": checked_at,
+            }
+            history[ip] = json.loads(entries or "[]")
+        cursor.execute("SELECT Info FROM Leases WHERE Name = ?", (LEASE_NAME,))
+        row = cursor.fetchone()
+        return status, history, json.loads(row[0]) if row and row[0] else None
+    finally:
+        conn.close()
+
+# "host" -> default ports, "host:port" -> that port only (IPv6 literals keep the default ports)
+def probe_targets(ip, ports=PROBE_PORTS):
+    ip = ip.strip()
+    if ip.count(":") == 1:
+        host, _, port = ip.partition(":")
+        if port.isdigit():
+            if not 1 <= int(port) <= 65535:
+                raise ValueError(f"invalid port {port}")
+            return host, (int(port),)
+    return ip, ports
+
+# Periodic TCP-connect sweep over every SERVERIP entry, with a global concurrency cap.
+# Only the worker holding the lease sweeps; every sweep is saved to ServerStatus and the
+# other workers load it from there, so all of them answer with the same status.
+class ReachabilityProber:
+    def __init__(self, ports=PROBE_PORTS, timeout=PROBE_TIMEOUT_SECONDS, concurrency=PROBE_CONCURRENCY,
+                 interval=PROBE_INTERVAL_SECONDS, history=PROBE_HISTORY, load_ips=load_server_ips,
+                 lease_seconds=PROBE_LEASE_SECONDS):
+        self.ports = ports
+        self.timeout = timeout
+        self.interval = interval
+        self.history_size = history
+        self.load_ips = load_ips
+        self.lease_seconds = lease_seconds
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.leader = False
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.status = {}
+        self.history = {}
+        self.last_sweep = None
+        self._task = None
+        self._sweep_lock = asyncio.Lock()
+
+    async def _connect(self, host, port):
+        async with self._semaphore:
+            start = time.perf_counter()
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), self.timeout)
+            except asyncio.TimeoutError as e:
+                return port, None, type(e).__name__
+            except Exception as e:
+                # OSError, but also e.g. UnicodeError from idna for a malformed host name
+                return port, None, str(e) or type(e).__name__
+            latency_ms = (time.perf_counter() - start) * 1000
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+            return port, latency_ms, None
+
+    async def probe(self, ip):
+        try:
+            host, ports = probe_targets(ip, self.ports)
+        except ValueError as e:
+            return self._record(ip, {}, str(e))
+        attempts = await asyncio.gather(*(self._connect(host, port) for port in ports))
+        open_ports = {port: round(latency, 2) for port, latency, _ in attempts if latency is not None}
+        return self._record(ip, open_ports, None if open_ports else "; ".join(f"{port}: {error}" for port, _, error in attempts))
+
+    def _record(self, ip, open_ports, error):
+        result = {
+            "IP": ip,
+            "Reachable": bool(open_ports),
+            "OpenPorts": open_ports,
+            "LatencyMs": min(open_ports.values()) if open_ports else None,
+            "Error": error,
+            "CheckedAt": time.time(),
+        }
+        self.status[ip] = result
+        self.history.setdefault(ip, deque(maxlen=self.history_size)).append(
+            {"Reachable": result["Reachable"], "LatencyMs": result["LatencyMs"], "CheckedAt": result["CheckedAt"]}
+        )
+        return result
+
+    async def sweep(self):
+        async with self._sweep_lock:
+            ips = await asyncio.to_thread(self.load_ips)
+            start = time.perf_counter()
+            # One broken entry must not cost every other host its status
+            results = await asyncio.gather(*(self.probe(ip) for ip in ips), return_exceptions=True)
+            for ip, result in zip(ips, results):
+                if isinstance(result, Exception):
+                    logger.warning("probe of %s failed: %s", ip, result)
+                    self._record(ip, {}, f"error: {result}")
+            # Forget servers that were deleted from SERVERIP
+            for ip in set(self.status) - set(ips):
+                self.status.pop(ip, None)
+                self.history.pop(ip, None)
+            self.last_sweep = {"Hosts": len(ips), "DurationMs": round((time.perf_counter() - start) * 1000, 1), "At": time.time()}
+            await asyncio.to_thread(save_status, self.status, self.history, self.last_sweep)
+            return self.last_sweep
+
+    # Results of the leader's latest sweep
+    async def load(self):
+        status, history, last_sweep = await asyncio.to_thread(load_status)
+        self.status = status
+        self.history = {ip: deque(entries, maxlen=self.history_size) for ip, entries in history.items()}
+        self.last_sweep = last_sweep
+
+    async def _run(self):
+        while True:
+            try:
+                leader = await asyncio.to_thread(acquire_lease, LEASE_NAME, self.holder, self.lease_seconds)
+                if leader and not self.leader:
+                    # Taking over: continue the previous holder's history
+                    await self.load()
+                self.leader = leader
+                if leader:
+                    await self.sweep()
+                else:
+                    await self.load()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("reachability sweep failed: %s", e)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def snapshot(self, include_history=False):
+        items = []
+        for ip, status in sorted(self.status.items()):
+            item = dict(status)
+            if include_history:
+                item["History"] = list(self.history.get(ip, ()))
+            items.append(item)
+        return items
+
+prober = ReachabilityProber()
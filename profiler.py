@@ -0,0 +1,355 @@
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+from tracing import TimedRoute
+from config import (
+    PROFILER_DEFAULT_INTERVAL_MS, PROFILER_MIN_INTERVAL_MS, PROFILER_MAX_SECONDS, PROFILER_MAX_REQUESTS,
+    PROFILER_MAX_OVERHEAD, PROFILER_MAX_STACKS, PROFILER_MAX_DEPTH, JOB_SPOOL_DIR,
+)
+
+logger = logging.getLogger("profiler")
+
+class ProfilerBusy(Exception):
+    pass
+
+# Threads parked here are idle, not slow: counted but left out of the stacks
+IDLE_FRAMES = {
+    ("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"),
+    ("selectors.py", "select"), ("queue.py", "get"), ("thread.py", "_worker"),
+}
+
+def _short_path(filename):
+    parts = filename.replace("\\", "/").split("/")
+    return "/".join(parts[-2:])
+
+# One profiling run: a time window, or the next N requests of one route (both bounded by max_seconds)
+class ProfileSession:
+    def __init__(self, seconds, route, requests, interval_ms):
+        self.id = uuid.uuid4().hex
+        self.pid = os.getpid()
+        self.route = route
+        self.target_requests = requests
+        self.seconds = seconds
+        self.interval = interval_ms / 1000
+        self.started_at = time.time()
+        self.deadline = time.monotonic() + seconds
+        self.finished_at = None
+        self.stop_reason = None
+        self.counts = {}
+        self.samples = 0
+        self.idle_samples = 0
+        self.dropped_stacks = 0
+        self.sampling_seconds = 0.0
+        self.requests_done = 0
+        self.active = 0
+
+    @property
+    def running(self):
+        return self.finished_at is None
+
+    def to_dict(self):
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "id": self.id,
+            "pid": self.pid,
+            "running": self.running,
+            "route": self.route,
+            "requests": self.target_requests,
+            "requests_done": self.requests_done,
+            "seconds": self.seconds,
+            "interval_ms": self.interval * 1000,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "stop_reason": self.stop_reason,
+            "samples": self.samples,
+            "idle_samples": self.idle_samples,
+            "stacks": len(self.counts),
+            "dropped_stacks": self.dropped_stacks,
+            "overhead": round(self.sampling_seconds / elapsed, 4) if elapsed > 0 else 0.0,
+        }
+
+# Statistical profiler over sys._current_frames(): a background thread walks every thread's
+# stack at a fixed interval and counts identical stacks. Nothing is installed in the
+# interpreter (no sys.setprofile), so requests that are not being sampled pay nothing.
+# A session samples the worker process it was started in; its status and result are written
+# to the job spool under its id, so any worker can answer for it (and stop it).
+class SamplingProfiler:
+    def __init__(self, max_seconds=PROFILER_MAX_SECONDS, max_requests=PROFILER_MAX_REQUESTS,
+                 max_overhead=PROFILER_MAX_OVERHEAD, max_stacks=PROFILER_MAX_STACKS, max_depth=PROFILER_MAX_DEPTH,
+                 spool_dir=JOB_SPOOL_DIR):
+        self.spool_dir = spool_dir
+        self.max_seconds = max_seconds
+        self.max_requests = max_requests
+        self.max_overhead = max_overhead
+        self.max_stacks = max_stacks
+        self.max_depth = max_depth
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._labels = {}
+        self._thread_names = {}
+        self.session = None
+
+    def _path(self, name):
+        return os.path.join(self.spool_dir, name)
+
+    # One session at a time across all workers: the lock file names the running session. Its state
+    # file is written first and the lock appears atomically (hard link of a complete file), so a
+    # holder id read from the lock always has a state to check. The lock is taken over once that
+    # session has finished or is past its time limit; a lock whose holder cannot be read counts as
+    # busy until the file itself is older than max_seconds (crashed worker).
+    def _claim(self, session):
+        lock = self._path("profile.lock")
+        claim = self._path(f"profile-{session.id}.claim")
+        with open(claim, "w", encoding="utf-8") as f:
+            f.write(session.id)
+        try:
+            for _ in range(2):
+                try:
+                    os.link(claim, lock)
+                    return
+                except FileExistsError:
+                    pass
+                holder_id = self._read_text(lock)
+                if not self._is_stale(lock, holder_id):
+                    raise ProfilerBusy()
+                # Move the stale lock aside; only one worker can move a given file
+                aside = self._path(f"profile-{session.id}.stale")
+                try:
+                    os.rename(lock, aside)
+                except OSError:
+                    continue
+                if self._read_text(aside) != holder_id:
+                    # Another worker replaced the stale lock in between: give its lock back
+                    try:
+                        os.link(aside, lock)
+                    except OSError:
+                        pass
+                    os.remove(aside)
+                    raise ProfilerBusy()
+                os.remove(aside)
+            raise ProfilerBusy()
+        finally:
+            os.remove(claim)
+
+    def _is_stale(self, lock, holder_id):
+        holder = self._read_state(holder_id)
+        if holder is None:
+            try:
+                return os.path.getmtime(lock) + self.max_seconds < time.time()
+            except OSError:
+                return False
+        return not holder["running"] or holder["started_at"] + holder["seconds"] + 5 < time.time()
+
+    def _release(self, session):
+        lock = self._path("profile.lock")
+        if self._read_text(lock) == session.id:
+            try:
+                os.remove(lock)
+            except OSError:
+                pass
+
+    def _read_text(self, path):
+        try:
+            with open(path, encoding="utf-8") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write(self, name, text):
+        path = self._path(name)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(path + ".tmp", path)
+
+    def _read_state(self, session_id):
+        if not session_id or not session_id.isalnum():
+            return None
+        text = self._read_text(self._path(f"profile-{session_id}.json"))
+        try:
+            return json.loads(text) if text else None
+        except ValueError:
+            return None
+
+    def _save(self, session):
+        self._write(f"profile-{session.id}.json", json.dumps(session.to_dict()))
+
+    def start(self, seconds=None, route=None, requests=None, interval_ms=PROFILER_DEFAULT_INTERVAL_MS):
+        with self._lock:
+            if self.session is not None and self.session.running:
+                raise ProfilerBusy()
+            seconds = min(seconds or self.max_seconds, self.max_seconds)
+            if route is not None:
+                requests = min(requests or self.max_requests, self.max_requests)
+            interval_ms = max(interval_ms, PROFILER_MIN_INTERVAL_MS)
+            session = ProfileSession(seconds, route, requests, interval_ms)
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self._save(session)
+            try:
+                self._claim(session)
+            except ProfilerBusy:
+                os.remove(self._path(f"profile-{session.id}.json"))
+                raise
+            self._write("profile.last", session.id)
+            self.session = session
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, args=(session,), name="profiler", daemon=True)
+            self._thread.start()
+            return session
+
+    # The latest session started by any worker
+    def last_id(self):
+        return self._read_text(self._path("profile.last"))
+
+    # Stop a session here, or ask the worker running it to stop (it polls for the marker file)
+    def stop(self, session_id=None, reason="stopped"):
+        session = self.session
+        if session is not None and session.id == (session_id or session.id) and session.running:
+            session.stop_reason = session.stop_reason or reason
+            self._stop.set()
+            thread = self._thread
+            if thread is not None and thread is not threading.current_thread():
+                thread.join(timeout=2)
+            return
+        state = self._read_state(session_id)
+        if state is not None and state["running"]:
+            self._write(f"profile-{session_id}.stop", reason)
+
+    # Route mode: samples are only taken while a request of that route is in flight
+    @contextmanager
+    def request(self, route):
+        session = self.session
+        if session is None or not session.running or session.route != route:
+            yield
+            return
+        with self._lock:
+            session.active += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                session.active -= 1
+                session.requests_done += 1
+                done = session.requests_done >= session.target_requests
+            if done:
+                session.stop_reason = session.stop_reason or "requests"
+                self._stop.set()
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            # ";" separates frames in the collapsed format
+            label = f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})".replace(";", ":")
+            self._labels[code] = label
+        return label
+
+    def _thread_name(self, ident):
+        name = self._thread_names.get(ident)
+        if name is None:
+            self._thread_names = {thread.ident: thread.name.replace(";", ":") for thread in threading.enumerate()}
+            name = self._thread_names.get(ident, f"thread-{ident}")
+        return name
+
+    def _sample(self, session, own_ident):
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            code = frame.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                session.idle_samples += 1
+                continue
+            labels = []
+            while frame is not None and len(labels) < self.max_depth:
+                labels.append(self._label(frame.f_code))
+                frame = frame.f_back
+            labels.append(self._thread_name(ident))
+            stack = ";".join(reversed(labels))
+            if stack in session.counts:
+                session.counts[stack] += 1
+            elif len(session.counts) < self.max_stacks:
+                session.counts[stack] = 1
+            else:
+                session.dropped_stacks += 1
+            session.samples += 1
+
+    def _run(self, session):
+        own_ident = threading.get_ident()
+        stop_marker = self._path(f"profile-{session.id}.stop")
+        next_save = time.monotonic() + 1
+        try:
+            while not self._stop.is_set():
+                now = time.monotonic()
+                if now >= session.deadline:
+                    session.stop_reason = session.stop_reason or "time"
+                    break
+                if now >= next_save:
+                    # Progress for the other workers, and the stop request from one of them
+                    next_save = now + 1
+                    if os.path.exists(stop_marker):
+                        session.stop_reason = session.stop_reason or "stopped"
+                        break
+                    self._save(session)
+                if session.route is not None and session.active == 0:
+                    self._stop.wait(session.interval)
+                    continue
+                started = time.perf_counter()
+                self._sample(session, own_ident)
+                cost = time.perf_counter() - started
+                session.sampling_seconds += cost
+                # Overhead cap: never spend more than max_overhead of wall time walking stacks
+                self._stop.wait(max(session.interval, cost * (1 - self.max_overhead) / self.max_overhead))
+        except Exception as e:
+            session.stop_reason = f"error: {e}"
+            logger.exception("profiler failed")
+        finally:
+            self._labels.clear()
+            try:
+                self._write(f"profile-{session.id}.collapsed", self._collapse(session))
+                session.finished_at = time.time()
+                self._save(session)
+                if os.path.exists(stop_marker):
+                    os.remove(stop_marker)
+            except OSError as e:
+                logger.warning("profile %s not saved: %s", session.id, e)
+            finally:
+                session.finished_at = session.finished_at or time.time()
+                self._release(session)
+
+    # Collapsed stacks ("thread;outer;...;inner count" per line) for flamegraph.pl / speedscope
+    def _collapse(self, session):
+        counts = dict(session.counts)
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items(), key=lambda item: -item[1]))
+
+    # Live for a session running here, otherwise what its worker saved (None: no such session/result)
+    def collapsed(self, session_id):
+        session = self.session
+        if session is not None and session.id == session_id:
+            return self._collapse(session)
+        if not session_id or not session_id.isalnum():
+            return None
+        return self._read_text(self._path(f"profile-{session_id}.collapsed"))
+
+    def status(self, session_id):
+        session = self.session
+        if session is not None and session.id == session_id:
+            return session.to_dict()
+        return self._read_state(session_id)
+
+profiler = SamplingProfiler()
+
+# Tracks requests for route-mode sessions around the whole route handler, so body parsing,
+# dependencies and response serialization (Pydantic) are sampled too
+class ProfiledRoute(TimedRoute):
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        path = self.path
+
+        async def profiled_handler(request):
+            with profiler.request(path):
+                return await handler(request)
+        return profiled_handler
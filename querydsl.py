@@ -0,0 +1,298 @@
+import heapq
+import operator
+from itertools import islice
+from datetime import datetime
+from fastapi import HTTPException
+
+# Filter/sort syntax for the list endpoints:
+#   ?filter=LinkOrNot:eq:1&filter=ConnectedDevices:gt:10&filter=ConnectionType:in:VPN|LAN&sort=-Number,CustomerName
+# Every field is checked against the table's whitelist and compiled into parameterized SQL.
+
+# field name -> (SQL column, type)
+CUSTOMERS_FIELDS = {
+    "ID": ("ID", int),
+    "CustomerNumber": ("CustomerNumber", str),
+    "CustomerSeq": ("CustomerSeq", int),
+    "Name": ("Name", str),
+    "Phone": ("Phone", str),
+    "Email": ("Email", str),
+    "Address": ("Address", str),
+    "TaxNumber": ("TaxNumber", str),
+    "NationalAddress": ("NationalAddress", str),
+}
+
+# Passwords are never filterable
+SERVERIP_FIELDS = {
+    "IP": ("IP", str),
+    "USER": ("[USER]", str),
+    "SERVER_EMAIL": ("SERVER_EMAIL", str),
+}
+
+CUSTSERVER_FIELDS = {
+    "ID": ("ID", int),
+    "CustomerName": ("CustomerName", str),
+    "LinkOrNot": ("LinkOrNot", bool),
+    "Number": ("[Number]", int),
+    "GlobalServerIP": ("GlobalServerIP", str),
+    "ServerName": ("ServerName", str),
+    "DatabaseName": ("DatabaseName", str),
+    "ConnectionType": ("ConnectionType", str),
+    "ConnectedDevices": ("ConnectedDevices", int),
+    "CustomerID": ("CustomerID", int),
+}
+
+# Admin audit log query (/audit)
+AUDIT_FIELDS = {
+    "ID": ("ID", int),
+    "At": ("At", datetime),
+    "Username": ("Username", str),
+    "Action": ("Action", str),
+    "Entity": ("Entity", str),
+    "EntityKey": ("EntityKey", str),
+}
+
+COMPARISONS = {"eq": "=", "ne": "<>", "gt": ">", "gte": ">=", "lt": "<", "lte": "<="}
+MAX_FILTERS = 10
+MAX_IN_VALUES = 50
+
+def _bad(message):
+    return HTTPException(status_code=400, detail=message)
+
+# SQL Server INT range: anything outside it would fail in the database instead of here
+INT_MIN, INT_MAX = -2**31, 2**31 - 1
+
+def _convert(value, kind, field):
+    if kind is bool:
+        if value.lower() in ("1", "true"):
+            return True
+        if value.lower() in ("0", "false"):
+            return False
+        raise _bad(f"قيمة غير صالحة للحقل {field}")
+    try:
+        if kind is int:
+            number = int(value)
+            if not INT_MIN <= number <= INT_MAX:
+                raise ValueError(value)
+            return number
+        if kind is datetime:
+            # "2025-01-31" or "2025-01-31T08:30[:00]"
+            return datetime.fromisoformat(value)
+    except ValueError:
+        raise _bad(f"قيمة غير صالحة للحقل {field}")
+    return value
+
+# Parse "field:op[:value]" expressions into validated (field, op, value) tuples
+def parse_filters(expressions, fields):
+    if len(expressions) > MAX_FILTERS:
+        raise _bad("عدد الفلاتر كبير جدًا")
+    filters = []
+    for expression in expressions:
+        parts = expression.split(":", 2)
+        if len(parts) < 2:
+            raise _bad(f"فلتر غير صالح: {expression}")
+        field, op = parts[0], parts[1].lower()
+        if field not in fields:
+            raise _bad(f"حقل غير مسموح: {field}")
+        kind = fields[field][1]
+        if op in ("null", "notnull"):
+            filters.append((field, op, None))
+            continue
+        if len(parts) != 3:
+            raise _bad(f"فلتر غير صالح: {expression}")
+        raw = parts[2]
+        if op in COMPARISONS:
+            if kind is bool and op not in ("eq", "ne"):
+                raise _bad(f"عملية غير مسموحة للحقل {field}")
+            filters.append((field, op, _convert(raw, kind, field)))
+        elif op in ("like", "prefix"):
+            if kind is not str:
+                raise _bad(f"عملية غير مسموحة للحقل {field}")
+            filters.append((field, op, raw))
+        elif op == "in":
+            values = [v for v in raw.split("|") if v != ""]
+            if not values or len(values) > MAX_IN_VALUES:
+                raise _bad(f"قائمة قيم غير صالحة للحقل {field}")
+            filters.append((field, op, [_convert(v, kind, field) for v in values]))
+        else:
+            raise _bad(f"عملية غير معروفة: {op}")
+    return filters
+
+# "-Number,CustomerName" -> [("Number", True), ("CustomerName", False)]
+def parse_sort(sort, fields):
+    order = []
+    for item in (sort or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        descending = item.startswith("-")
+        field = item.lstrip("+-")
+        if field not in fields:
+            raise _bad(f"لا يمكن الترتيب حسب: {field}")
+        order.append((field, descending))
+    return order
+
+# LIKE with a backslash escape, so %, _ and [ in user input match literally (as in the read model)
+LIKE = "LIKE ? ESCAPE '\\'"
+
+def escape_like(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_").replace("[", "\\[")
+
+# The search box: "%search%" on any of the columns
+def search_sql(search, columns):
+    if not search:
+        return [], []
+    pattern = f"%{escape_like(search)}%"
+    return [" OR ".join(f"{column} {LIKE}" for column in columns)], [pattern] * len(columns)
+
+def filters_to_sql(filters, fields):
+    clauses, params = [], []
+    for field, op, value in filters:
+        column = fields[field][0]
+        if op == "null":
+            clauses.append(f"{column} IS NULL")
+        elif op == "notnull":
+            clauses.append(f"{column} IS NOT NULL")
+        elif op in COMPARISONS:
+            clauses.append(f"{column} {COMPARISONS[op]} ?")
+            params.append(value)
+        elif op == "like":
+            clauses.append(f"{column} {LIKE}")
+            params.append(f"%{escape_like(value)}%")
+        elif op == "prefix":
+            # Sargable: can seek on the column's index
+            clauses.append(f"{column} {LIKE}")
+            params.append(f"{escape_like(value)}%")
+        elif op == "in":
+            clauses.append(f"{column} IN ({', '.join('?' for _ in value)})")
+            params.extend(value)
+    return clauses, params
+
+def sort_to_sql(order, fields, default):
+    if not order:
+        return f"ORDER BY {default}"
+    return "ORDER BY " + ", ".join(f"{fields[field][0]} {'DESC' if desc else 'ASC'}" for field, desc in order)
+
+# Build "WHERE ..." for a list query, combined with any extra clauses (e.g. the search box)
+def compile_filters(filter_expressions, fields, extra_clauses=(), extra_params=()):
+    filters = parse_filters(filter_expressions, fields)
+    clauses, params = filters_to_sql(filters, fields)
+    clauses = list(extra_clauses) + clauses
+    where = ("WHERE " + " AND ".join(f"({c})" for c in clauses)) if clauses else ""
+    return where, list(extra_params) + params
+
+# Build "WHERE ... ORDER BY ... [OFFSET/FETCH]" for a list query
+def compile_query(filter_expressions, sort, fields, default_order, extra_clauses=(), extra_params=(), offset=0, limit=None):
+    where, params = compile_filters(filter_expressions, fields, extra_clauses, extra_params)
+    order = parse_sort(sort, fields)
+    sql = f"{where} {sort_to_sql(order, fields, default_order)}"
+    if limit is not None:
+        # Pages must not overlap: break ties on the (unique) default order column
+        if order and all(fields[field][0] != default_order.split()[0] for field, _ in order):
+            sql += f", {default_order}"
+        sql += " OFFSET ? ROWS FETCH NEXT ? ROWS ONLY"
+        params += [offset, limit]
+    return sql, params
+
+# ==== Evaluation over in-memory rows (read model) ====
+# Same meaning as the SQL above under the tables' case-insensitive collation:
+# row attributes are named after the fields, and NULL never satisfies a comparison.
+COMPARISON_FUNCTIONS = {"eq": operator.eq, "ne": operator.ne, "gt": operator.gt, "gte": operator.ge, "lt": operator.lt, "lte": operator.le}
+
+def _fold(value):
+    return value.casefold() if isinstance(value, str) else value
+
+def _value_test(op, value):
+    if op == "null":
+        return lambda v: v is None
+    if op == "notnull":
+        return lambda v: v is not None
+    if op in COMPARISONS:
+        compare, target = COMPARISON_FUNCTIONS[op], _fold(value)
+        return lambda v: v is not None and compare(_fold(v), target)
+    if op == "like":
+        needle = value.casefold()
+        return lambda v: v is not None and needle in v.casefold()
+    if op == "prefix":
+        needle = value.casefold()
+        return lambda v: v is not None and v.casefold().startswith(needle)
+    values = {_fold(v) for v in value}
+    return lambda v: v is not None and _fold(v) in values
+
+def filters_to_predicate(filters, search="", search_fields=()):
+    tests = [(operator.attrgetter(field), _value_test(op, value)) for field, op, value in filters]
+    if search:
+        # The search box: LIKE '%search%' on any of the search fields
+        getters = [operator.attrgetter(field) for field in search_fields]
+        needle = search.casefold()
+        tests.append((lambda row: row, lambda row: any(needle in (get(row) or "").casefold() for get in getters)))
+    if len(tests) == 1:
+        (get, test), = tests
+        return lambda row: test(get(row))
+
+    def predicate(row):
+        for get, test in tests:
+            if not test(get(row)):
+                return False
+        return True
+    return predicate
+
+def _sort_key(value):
+    # NULLs first ascending, last descending (as in SQL Server)
+    return (value is not None, _fold(value))
+
+# Sort key over several fields with a direction each; equal keys compare equal, so stable
+# selection keeps the rows' incoming (default key) order as the tie-break
+class _OrderKey:
+    __slots__ = ("values", "descending")
+
+    def __init__(self, values, descending):
+        self.values = values
+        self.descending = descending
+
+    def __eq__(self, other):
+        return self.values == other.values
+
+    def __lt__(self, other):
+        for a, b, descending in zip(self.values, other.values, self.descending):
+            if a != b:
+                return a > b if descending else a < b
+        return False
+
+# Filter, sort and page rows that are already in default key order (ReadTable.rows()).
+# Returns (page, total matching rows); total is None when count=False and it was not needed to find the page.
+# Only a page is ever sorted: the first offset+limit rows are picked with a bounded heap.
+def query_rows(rows, filter_expressions, sort, fields, search="", search_fields=(), offset=0, limit=None, count=True):
+    filters = parse_filters(filter_expressions, fields)
+    order = parse_sort(sort, fields)
+    end = None if limit is None else offset + limit
+    if not filters and not search:
+        matched = rows
+    elif order or count or end is None:
+        predicate = filters_to_predicate(filters, search, search_fields)
+        matched = [row for row in rows if predicate(row)]
+    else:
+        # Unsorted page without a count: stop at the last row of the page
+        predicate = filters_to_predicate(filters, search, search_fields)
+        page = list(islice((row for row in rows if predicate(row)), offset, end))
+        return page, None
+    total = len(matched)
+    if not order:
+        return list(matched[offset:end]), total
+    getters = [operator.attrgetter(field) for field, _ in order]
+    descending = tuple(desc for _, desc in order)
+    reverse = False
+    if len(getters) == 1:
+        get = getters[0]
+        key = lambda row: _sort_key(get(row))
+        reverse = descending[0]
+    elif len(set(descending)) == 1:
+        key = lambda row: tuple([_sort_key(get(row)) for get in getters])
+        reverse = descending[0]
+    else:
+        key = lambda row: _OrderKey(tuple([_sort_key(get(row)) for get in getters]), descending)
+    # All of these are stable, like the SQL tie-break on the default key
+    if end is None:
+        ordered = sorted(matched, key=key, reverse=reverse)
+    else:
+        ordered = (heapq.nlargest if reverse else heapq.nsmallest)(end, matched, key=key)
+    return ordered[offset:end], total
@@ -0,0 +1,179 @@
+import re
+import time
+import logging
+import threading
+from config import SLOW_QUERY_MS, QUERY_STATS_MAX_FINGERPRINTS
+from breaker import db_breaker
+from tracing import record as trace_record
+from deadline import as_query_timeout
+
+logger = logging.getLogger("querylog")
+
+_STRING_LITERAL = re.compile(r"N?'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_WHITESPACE = re.compile(r"\s+")
+_PARAM_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+# Normalize a statement so that calls differing only in literals/whitespace share one entry
+def fingerprint(sql):
+    sql = _STRING_LITERAL.sub("?", sql)
+    sql = _NUMBER_LITERAL.sub("?", sql)
+    sql = _WHITESPACE.sub(" ", sql).strip()
+    sql = _PARAM_LIST.sub("(?+)", sql)
+    return sql
+
+# Parameters may hold password hashes and personal data: only show shape, never values
+def redact_params(params):
+    redacted = []
+    for value in params:
+        if value is None or isinstance(value, (bool, int, float)):
+            redacted.append(value)
+        elif isinstance(value, (str, bytes)):
+            redacted.append(f"<{type(value).__name__}:{len(value)}>")
+        else:
+            redacted.append(f"<{type(value).__name__}>")
+    return redacted
+
+def _flatten_params(params):
+    # pyodbc accepts both execute(sql, a, b) and execute(sql, (a, b))
+    if len(params) == 1 and isinstance(params[0], (list, tuple)):
+        return list(params[0])
+    return list(params)
+
+class QueryStats:
+    def __init__(self, max_fingerprints=QUERY_STATS_MAX_FINGERPRINTS):
+        self.max_fingerprints = max_fingerprints
+        self._lock = threading.Lock()
+        self._stats = {}
+        self.dropped = 0
+
+    def record(self, fp, elapsed_ms, rows=0):
+        with self._lock:
+            entry = self._stats.get(fp)
+            if entry is None:
+                if len(self._stats) >= self.max_fingerprints:
+                    self.dropped += 1
+                    return
+                entry = self._stats[fp] = {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0}
+            entry["count"] += 1
+            entry["total_ms"] += elapsed_ms
+            entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+            entry["rows"] += rows
+
+    def add_rows(self, fp, rows):
+        with self._lock:
+            entry = self._stats.get(fp)
+            if entry is not None:
+                entry["rows"] += rows
+
+    def top(self, limit=20, order="total_ms"):
+        with self._lock:
+            items = [dict(entry, fingerprint=fp) for fp, entry in self._stats.items()]
+        for item in items:
+            item["avg_ms"] = item["total_ms"] / item["count"] if item["count"] else 0.0
+        items.sort(key=lambda item: item.get(order, 0), reverse=True)
+        return items[:limit]
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self.dropped = 0
+
+query_stats = QueryStats()
+
+class TrackedCursor:
+    def __init__(self, cursor, stats=query_stats):
+        self._cursor = cursor
+        self._stats = stats
+        self._fp = None
+
+    def _timed(self, method, sql, params, many=False):
+        fp = fingerprint(sql)
+        db_breaker.before_call()
+        start = time.perf_counter()
+        try:
+            result = method(sql, *params)
+            db_breaker.record_success()
+            return result
+        except Exception as e:
+            timeout = as_query_timeout(e)
+            if timeout is not None:
+                raise timeout from e
+            db_breaker.record_failure(e)
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            trace_record("exec", start, elapsed)
+            elapsed_ms = elapsed * 1000
+            # rowcount is -1 for SELECT; rows read are added by the fetch methods
+            affected = self._cursor.rowcount if self._cursor.rowcount and self._cursor.rowcount > 0 else 0
+            self._fp = fp
+            self._stats.record(fp, elapsed_ms, affected)
+            if elapsed_ms >= SLOW_QUERY_MS:
+                shown = [redact_params(p) for p in params[0]][:5] if many and params else redact_params(_flatten_params(params))
+                logger.warning("slow query (%.1f ms): %s params=%s", elapsed_ms, fp, shown)
+
+    def execute(self, sql, *params):
+        self._timed(self._cursor.execute, sql, params)
+        return self
+
+    def executemany(self, sql, *params):
+        self._timed(self._cursor.executemany, sql, params, many=True)
+        return self
+
+    def _count(self, rows):
+        if self._fp is not None and rows:
+            self._stats.add_rows(self._fp, rows)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = self._cursor.fetchone()
+        trace_record("fetch", start, time.perf_counter() - start)
+        self._count(1 if row is not None else 0)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = self._cursor.fetchmany(size) if size is not None else self._cursor.fetchmany()
+        trace_record("fetch", start, time.perf_counter() - start)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = self._cursor.fetchall()
+        trace_record("fetch", start, time.perf_counter() - start)
+        self._count(len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._count(1)
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    # e.g. cursor.fast_executemany = True must reach the pyodbc cursor
+    def __setattr__(self, name, value):
+        if name in ("_cursor", "_stats", "_fp"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._cursor, name, value)
+
+class TrackedConnection:
+    def __init__(self, conn, stats=query_stats):
+        self._conn = conn
+        self._stats = stats
+
+    def cursor(self):
+        return TrackedCursor(self._conn.cursor(), self._stats)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        if name in ("_conn", "_stats"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._conn, name, value)
@@ -0,0 +1,266 @@
+import time
+import bisect
+import operator
+import logging
+import threading
+from config import READ_MODEL_ENABLED, READ_MODEL_RECONCILE_SECONDS
+from database import get_db_connection_fastapi
+from cache import bus
+
+logger = logging.getLogger("readmodel")
+
+# Rows are plain __slots__ objects whose attributes are the querydsl field names,
+# so the list DSL can filter and sort them directly (querydsl.query_rows)
+class _Row:
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+class ServerRow(_Row):
+    __slots__ = ("IP", "USER", "PASS", "SERVER_EMAIL", "EMAIL_PASS")
+
+class CustServerRow(_Row):
+    __slots__ = ("ID", "CustomerName", "LinkOrNot", "Number", "GlobalServerIP", "ServerName", "DatabaseName",
+                 "ConnectionType", "ConnectedDevices", "Notes", "CustomerID")
+
+    def __init__(self, *values):
+        super().__init__(*values)
+        self.LinkOrNot = bool(self.LinkOrNot)
+
+def _order(value):
+    return value.casefold() if isinstance(value, str) else value
+
+# One table held in memory. Readers get an immutable tuple snapshot ordered by the key (no lock
+# on the read path, and pages in key order are plain slices); writers replace whole rows and
+# publish a patched copy of the snapshot.
+class ReadTable:
+    def __init__(self, name, row_class, key, select_sql):
+        self.name = name
+        self.row_class = row_class
+        self.key = key
+        self.select_sql = select_sql
+        self._lock = threading.Lock()
+        # One reload/sync at a time (reconcile thread vs cache bus thread)
+        self._load_lock = threading.Lock()
+        self._rows = {}
+        self._snapshot = ()
+        # Order keys of the snapshot's rows, so single-row changes patch it instead of re-sorting
+        self._keys = []
+        # Write-through changes made while a reload/sync is reading the table, re-applied on top of it
+        self._replay = None
+        self._mark = None
+        self.loaded = False
+        self.loaded_at = None
+        self.reloads = 0
+        self.syncs = 0
+        self.drift = 0
+
+    def rows(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._rebuild()
+                snapshot = self._snapshot
+        return snapshot
+
+    # Caller holds _lock
+    def _rebuild(self):
+        key = operator.attrgetter(self.key)
+        rows = sorted(self._rows.values(), key=lambda row: _order(key(row)))
+        self._keys = [_order(key(row)) for row in rows]
+        self._snapshot = tuple(rows)
+
+    # Caller holds _lock: apply one change to the ordered snapshot (a pointer copy, no sort)
+    def _patch(self, op, item):
+        key = getattr(item, self.key) if op == "upsert" else item
+        order = _order(key)
+        i = bisect.bisect_left(self._keys, order)
+        found = i < len(self._keys) and self._keys[i] == order
+        if found and getattr(self._snapshot[i], self.key) != key:
+            # Two keys that only differ in case: let the next reader rebuild
+            self._snapshot = None
+            return
+        rows = list(self._snapshot)
+        if op == "upsert":
+            if found:
+                rows[i] = item
+            else:
+                rows.insert(i, item)
+                self._keys.insert(i, order)
+        elif found:
+            del rows[i]
+            del self._keys[i]
+        self._snapshot = tuple(rows)
+
+    def get(self, key):
+        return self._rows.get(key)
+
+    def _apply(self, rows, op, item):
+        if op == "upsert":
+            rows[getattr(item, self.key)] = item
+        else:
+            rows.pop(item, None)
+
+    def _change(self, op, item):
+        with self._lock:
+            self._apply(self._rows, op, item)
+            if self._snapshot is not None:
+                self._patch(op, item)
+            if self._replay is not None:
+                self._replay.append((op, item))
+
+    def upsert(self, *values):
+        self._change("upsert", self.row_class(*values))
+
+    def remove(self, key):
+        self._change("remove", key)
+
+    # Rewrite the rows matching predicate, e.g. when a delete elsewhere cascades into this table
+    def update_where(self, predicate, **changes):
+        for row in [row for row in self.rows() if predicate(row)]:
+            self.upsert(*dict(row.to_dict(), **changes).values())
+
+    # Reads from the database while recording write-through changes, which are replayed over the result
+    def _read(self, read):
+        with self._lock:
+            self._replay = []
+        try:
+            conn = get_db_connection_fastapi()
+            try:
+                return read(conn.cursor())
+            finally:
+                conn.close()
+        except Exception:
+            with self._lock:
+                self._replay = None
+            raise
+
+    # Rows of transactions still in flight get a RowVer at or above this, so reading below it never
+    # skips a change that commits later
+    def _active_rowversion(self, cursor):
+        cursor.execute("SELECT MIN_ACTIVE_ROWVERSION()")
+        return cursor.fetchone()[0]
+
+    # Full load from the table (startup, periodic reconcile)
+    def reload(self):
+        with self._load_lock:
+            def read(cursor):
+                mark = self._active_rowversion(cursor)
+                cursor.execute(self.select_sql)
+                return mark, {getattr(row, self.key): row for row in (self.row_class(*values) for values in cursor.fetchall())}
+            mark, rows = self._read(read)
+            with self._lock:
+                for op, item in self._replay:
+                    self._apply(rows, op, item)
+                self._replay = None
+                if self.loaded:
+                    drift = len(rows.keys() ^ self._rows.keys()) + sum(
+                        1 for key, row in rows.items() if key in self._rows and self._rows[key].values() != row.values())
+                    if drift:
+                        self.drift += drift
+                        logger.warning("%s read model was %d rows out of date", self.name, drift)
+                self._rows = rows
+                # Sorted here, on the loader's thread, not by the first request that reads it
+                self._rebuild()
+                self._mark = mark
+                self.loaded = True
+                self.loaded_at = time.time()
+                self.reloads += 1
+
+    # Catch up after another worker published a change: only rows whose RowVer moved since the last
+    # load/sync are read; deleted keys are looked for only when the row count no longer matches
+    def sync(self):
+        if not self.loaded:
+            self.reload()
+            return
+        with self._load_lock:
+            known = len(self._rows)
+
+            def read(cursor):
+                mark = self._active_rowversion(cursor)
+                cursor.execute(f"{self.select_sql} WHERE RowVer >= ? AND RowVer < ?", (self._mark, mark))
+                changed = [self.row_class(*values) for values in cursor.fetchall()]
+                cursor.execute(f"SELECT COUNT(*) FROM {self.name}")
+                count = cursor.fetchone()[0]
+                keys = None
+                if count != known + sum(1 for row in changed if getattr(row, self.key) not in self._rows):
+                    cursor.execute(f"SELECT {self.key} FROM {self.name}")
+                    keys = {values[0] for values in cursor.fetchall()}
+                return mark, changed, keys
+            mark, changed, keys = self._read(read)
+            with self._lock:
+                for row in changed:
+                    self._apply(self._rows, "upsert", row)
+                if keys is not None:
+                    for key in self._rows.keys() - keys:
+                        del self._rows[key]
+                # Local write-throughs that happened meanwhile are newer than what was read
+                for op, item in self._replay:
+                    self._apply(self._rows, op, item)
+                self._replay = None
+                self._rebuild()
+                self._mark = mark
+                self.syncs += 1
+
+    def snapshot(self):
+        return {"rows": len(self._rows), "loaded": self.loaded, "loaded_at": self.loaded_at,
+                "reloads": self.reloads, "syncs": self.syncs, "drift": self.drift}
+
+class ReadModel:
+    def __init__(self, enabled=READ_MODEL_ENABLED, reconcile_seconds=READ_MODEL_RECONCILE_SECONDS):
+        self.enabled = enabled
+        self.reconcile_seconds = reconcile_seconds
+        self.servers = ReadTable("SERVERIP", ServerRow, "IP",
+                                 "SELECT IP, [USER], [PASS], SERVER_EMAIL, EMAIL_PASS FROM SERVERIP")
+        self.custservers = ReadTable("CUSTSERVER", CustServerRow, "ID",
+                                     "SELECT ID, CustomerName, LinkOrNot, [Number], GlobalServerIP, ServerName, DatabaseName, "
+                                     "ConnectionType, ConnectedDevices, Notes, CustomerID FROM CUSTSERVER")
+        self.tables = (self.servers, self.custservers)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def reconcile(self):
+        for table in self.tables:
+            try:
+                table.reload()
+            except Exception as e:
+                logger.warning("%s read model reload failed: %s", table.name, e)
+
+    def _run(self):
+        while not self._stop.wait(self.reconcile_seconds):
+            self.reconcile()
+
+    # A table that fails to load stays unloaded (endpoints fall back to SQL) until the next reconcile
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        self.reconcile()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="read-model", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def snapshot(self):
+        return {table.name: table.snapshot() for table in self.tables}
+
+read_model = ReadModel()
+
+# The writing worker updates its copy write-through; the others catch up on the changed rows when
+# the bus says the table changed
+if read_model.enabled:
+    bus.register("lists", read_model.servers.sync, remote_only=True)
+    bus.register("custserver", read_model.custservers.sync, remote_only=True)
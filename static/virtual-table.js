@@ -0,0 +1,258 @@
+// Virtualized <tbody> rendering over a paged data source.
+// Only the rows inside the scroll viewport (plus a small overscan) exist in the DOM, and
+// pages are fetched on demand, so scrolling/searching cost stays flat as tables grow.
+//
+//   const table = new VirtualTable({
+//       scroller: document.getElementById('customerScroller'),   // element with overflow-y: auto
+//       tbody: document.getElementById('customerBody'),
+//       columnCount: 8,
+//       fetchPage: (offset, limit) => ... Promise<{ rows, total }>,
+//       renderCells: row => [row.ID, row.Name, ...],               // plain text, never HTML
+//       onRowClick: row => fillForm(row),
+//   });
+//   table.reload();
+
+(function (global) {
+    'use strict';
+
+    function debounce(fn, wait) {
+        let timer = null;
+        return function (...args) {
+            clearTimeout(timer);
+            timer = setTimeout(() => fn.apply(this, args), wait);
+        };
+    }
+
+    class VirtualTable {
+        constructor(options) {
+            this.scroller = options.scroller;
+            this.tbody = options.tbody;
+            this.columnCount = options.columnCount;
+            this.fetchPage = options.fetchPage;
+            this.renderCells = options.renderCells;
+            this.onRowClick = options.onRowClick || null;
+            this.onError = options.onError || (error => console.error(error));
+            this.pageSize = options.pageSize || 200;
+            this.overscan = options.overscan || 8;
+            this.rowHeight = options.rowHeight || 0;
+            this.placeholder = options.placeholder || '…';
+
+            this.total = 0;
+            this.pages = new Map();
+            this.pending = new Map();
+            this.generation = 0;
+            this.pool = [];
+            this.selectedIndex = -1;
+
+            this.topSpacer = this._spacer();
+            this.bottomSpacer = this._spacer();
+            this.tbody.innerHTML = '';
+            this.tbody.append(this.topSpacer, this.bottomSpacer);
+
+            this._frame = null;
+            this.scroller.addEventListener('scroll', () => this.scheduleRender(), { passive: true });
+            global.addEventListener('resize', () => this.scheduleRender());
+            this.tbody.addEventListener('click', event => this._handleClick(event));
+        }
+
+        _spacer() {
+            const tr = document.createElement('tr');
+            tr.className = 'virtual-spacer';
+            tr.setAttribute('aria-hidden', 'true');
+            const td = document.createElement('td');
+            td.colSpan = this.columnCount;
+            td.style.padding = '0';
+            td.style.border = '0';
+            tr.appendChild(td);
+            return tr;
+        }
+
+        _setSpacer(spacer, height) {
+            spacer.style.height = height + 'px';
+            spacer.style.display = height > 0 ? '' : 'none';
+        }
+
+        // Drop cached pages and start again from the first page (new search/filter)
+        async reload() {
+            this.generation++;
+            this.pages.clear();
+            this.pending.clear();
+            this.selectedIndex = -1;
+            this.scroller.scrollTop = 0;
+            await this._loadPage(0);
+        }
+
+        // Re-fetch the pages currently cached without jumping back to the top
+        async refresh() {
+            this.generation++;
+            const loaded = [...this.pages.keys()];
+            this.pages.clear();
+            this.pending.clear();
+            await Promise.all((loaded.length ? loaded : [0]).map(index => this._loadPage(index)));
+        }
+
+        _loadPage(index) {
+            if (this.pages.has(index)) return Promise.resolve();
+            if (this.pending.has(index)) return this.pending.get(index);
+            const generation = this.generation;
+            const promise = this.fetchPage(index * this.pageSize, this.pageSize)
+                .then(result => {
+                    if (generation !== this.generation) return;
+                    this.pages.set(index, result.rows);
+                    if (result.total !== null && result.total !== undefined) {
+                        this.total = result.total;
+                    } else if (result.rows.length < this.pageSize) {
+                        this.total = index * this.pageSize + result.rows.length;
+                    } else {
+                        this.total = Math.max(this.total, (index + 1) * this.pageSize + 1);
+                    }
+                    this.scheduleRender();
+                })
+                .catch(error => {
+                    if (generation === this.generation) this.onError(error);
+                })
+                .finally(() => {
+                    if (generation === this.generation) this.pending.delete(index);
+                });
+            this.pending.set(index, promise);
+            return promise;
+        }
+
+        getRow(index) {
+            const page = this.pages.get(Math.floor(index / this.pageSize));
+            return page ? page[index % this.pageSize] : undefined;
+        }
+
+        // Every loaded row, in order (for exports of what the user is looking at)
+        loadedRows() {
+            return [...this.pages.keys()].sort((a, b) => a - b).flatMap(index => this.pages.get(index));
+        }
+
+        // Replace rows in place after a save, without re-downloading anything
+        patchRow(predicate, newRow) {
+            for (const page of this.pages.values()) {
+                const position = page.findIndex(predicate);
+                if (position !== -1) {
+                    page[position] = newRow;
+                    this.scheduleRender();
+                    return true;
+                }
+            }
+            return false;
+        }
+
+        // Add a new row at the end (lists ordered by an increasing ID). If the last page is
+        // not loaded the row is only counted; it is fetched when scrolled into view.
+        appendRow(row) {
+            const index = Math.floor(this.total / this.pageSize);
+            const page = this.pages.get(index) || (this.total % this.pageSize === 0 ? [] : null);
+            if (page) {
+                page.push(row);
+                this.pages.set(index, page);
+            }
+            this.total++;
+            this.scheduleRender();
+        }
+
+        // Remove a deleted row. Later pages shift by one, so they are dropped and re-fetched on demand.
+        removeRow(predicate) {
+            for (const [index, page] of this.pages) {
+                const position = page.findIndex(predicate);
+                if (position === -1) continue;
+                const isLastPage = index * this.pageSize + page.length >= this.total;
+                if (isLastPage) {
+                    page.splice(position, 1);
+                } else {
+                    this.generation++;
+                    this.pending.clear();
+                    for (const other of [...this.pages.keys()]) {
+                        if (other >= index) this.pages.delete(other);
+                    }
+                }
+                this.total--;
+                this.selectedIndex = -1;
+                this.scheduleRender();
+                return true;
+            }
+            return false;
+        }
+
+        scheduleRender() {
+            if (this._frame !== null) return;
+            this._frame = global.requestAnimationFrame(() => {
+                this._frame = null;
+                this.render();
+            });
+        }
+
+        _ensurePool(size) {
+            while (this.pool.length < size) {
+                const tr = document.createElement('tr');
+                for (let i = 0; i < this.columnCount; i++) tr.appendChild(document.createElement('td'));
+                this.pool.push(tr);
+            }
+            while (this.pool.length > size) this.pool.pop().remove();
+        }
+
+        render() {
+            const rowHeight = this.rowHeight || 41;
+            const viewport = this.scroller.clientHeight || 600;
+            const first = Math.max(0, Math.floor(this.scroller.scrollTop / rowHeight) - this.overscan);
+            const last = Math.min(this.total, Math.ceil((this.scroller.scrollTop + viewport) / rowHeight) + this.overscan);
+            const count = Math.max(0, last - first);
+
+            this._ensurePool(count);
+            const fragment = document.createDocumentFragment();
+            for (let i = 0; i < count; i++) {
+                const index = first + i;
+                const tr = this.pool[i];
+                const row = this.getRow(index);
+                tr.dataset.index = index;
+                tr.classList.toggle('selected', index === this.selectedIndex);
+                const cells = row === undefined ? null : this.renderCells(row);
+                for (let c = 0; c < this.columnCount; c++) {
+                    const text = cells ? cells[c] : this.placeholder;
+                    const value = text === null || text === undefined ? '' : String(text);
+                    if (tr.cells[c].textContent !== value) tr.cells[c].textContent = value;
+                }
+                if (row === undefined) this._loadPage(Math.floor(index / this.pageSize));
+                fragment.appendChild(tr);
+            }
+            this.topSpacer.after(fragment);
+            this._setSpacer(this.topSpacer, first * rowHeight);
+            this._setSpacer(this.bottomSpacer, (this.total - last) * rowHeight);
+
+            // Measure the real row height once, then re-render with it
+            if (!this.rowHeight && count > 0 && this.pool[0].offsetHeight > 0) {
+                this.rowHeight = this.pool[0].offsetHeight;
+                this.scheduleRender();
+            }
+        }
+
+        _handleClick(event) {
+            const tr = event.target.closest('tr');
+            if (!tr || tr.dataset.index === undefined) return;
+            const index = Number(tr.dataset.index);
+            const row = this.getRow(index);
+            if (row === undefined) return;
+            this.selectedIndex = index;
+            this.scheduleRender();
+            if (this.onRowClick) this.onRowClick(row);
+        }
+    }
+
+    // fetch() one page of a list endpoint that supports offset/limit and X-Total-Count
+    async function fetchListPage(url, params, offset, limit) {
+        const query = new URLSearchParams(params);
+        query.set('offset', offset);
+        query.set('limit', limit);
+        const response = await fetch(`${url}?${query.toString()}`, { credentials: 'include' });
+        if (!response.ok) throw new Error('فشل تحميل البيانات');
+        const total = response.headers.get('X-Total-Count');
+        return { rows: await response.json(), total: total === null ? null : Number(total) };
+    }
+
+    global.VirtualTable = VirtualTable;
+    global.debounce = debounce;
+    global.fetchListPage = fetchListPage;
+})(window);
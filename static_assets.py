@@ -0,0 +1,92 @@
+import os
+import re
+import hashlib
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse
+from starlette.staticfiles import StaticFiles, NotModifiedResponse
+from compression import brotli, choose_encoding, compress_bytes, is_compressible
+from config import STATIC_SOURCE_DIR, STATIC_BUILD_DIR
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "public, max-age=0, must-revalidate"
+_FINGERPRINT = re.compile(r"\.[0-9a-f]{12}\.[^.]+$")
+
+def fingerprinted_name(name, data):
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{digest}{ext}"
+
+def _write_if_changed(path, data):
+    if os.path.exists(path) and os.path.getsize(path) == len(data):
+        with open(path, "rb") as f:
+            if f.read() == data:
+                return
+    # Several workers may build at once: write aside, then swap in atomically
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+# Copy every static file to the build dir under its original and fingerprinted name,
+# with .gz/.br siblings for compressible types. Returns {original name: fingerprinted name}.
+def build_static_assets(source=STATIC_SOURCE_DIR, target=STATIC_BUILD_DIR):
+    manifest = {}
+    os.makedirs(target, exist_ok=True)
+    for root, _, files in os.walk(source):
+        for filename in files:
+            src_path = os.path.join(root, filename)
+            rel = os.path.relpath(src_path, source).replace(os.sep, "/")
+            with open(src_path, "rb") as f:
+                data = f.read()
+            hashed = fingerprinted_name(rel, data)
+            manifest[rel] = hashed
+            outputs = [rel, hashed]
+            variants = {}
+            content_type = FileResponse(src_path).media_type
+            if is_compressible(content_type):
+                variants[".gz"] = compress_bytes(data, "gzip")
+                if brotli is not None:
+                    variants[".br"] = compress_bytes(data, "br")
+            for out_name in outputs:
+                out_path = os.path.join(target, out_name)
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                _write_if_changed(out_path, data)
+                for suffix, compressed in variants.items():
+                    # Only keep a variant when it actually saves bytes
+                    if len(compressed) < len(data):
+                        _write_if_changed(out_path + suffix, compressed)
+    return manifest
+
+# Rewrite /static/<name> references in a page to their fingerprinted URLs
+def rewrite_asset_urls(html, manifest):
+    def replace(match):
+        return "/static/" + manifest.get(match.group(1), match.group(1))
+    return re.sub(r"/static/([\w./-]+)", replace, html)
+
+# Serves the prebuilt directory: picks the .br/.gz sibling when the client accepts it,
+# never compresses on the fly, and marks fingerprinted files as immutable.
+class PrecompressedStaticFiles(StaticFiles):
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        request_headers = Headers(scope=scope)
+        full_path = str(full_path)
+        media_type = FileResponse(full_path).media_type
+        available = tuple(enc for enc, suffix in (("br", ".br"), ("gzip", ".gz")) if os.path.exists(full_path + suffix))
+        encoding = choose_encoding(request_headers.get("accept-encoding", ""), available) if available else None
+        headers = {
+            "Cache-Control": IMMUTABLE_CACHE if _FINGERPRINT.search(full_path) else REVALIDATE_CACHE,
+            "Vary": "Accept-Encoding",
+        }
+        if encoding:
+            path = full_path + (".br" if encoding == "br" else ".gz")
+            headers["Content-Encoding"] = encoding
+            response = FileResponse(path, status_code=status_code, media_type=media_type, headers=headers)
+        else:
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, media_type=media_type, headers=headers)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+if __name__ == "__main__":
+    # Build step: python static_assets.py
+    for original, hashed in build_static_assets().items():
+        print(f"{original} -> {hashed}")
@@ -0,0 +1,226 @@
+import json
+import asyncio
+import time
+import queue
+import random
+import logging
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from fastapi.routing import APIRoute
+from config import SERVER_TIMING_ENABLED, TRACE_FILE, TRACE_SAMPLE_RATE, TRACE_SLOW_MS, TRACE_MAX_EVENTS, TRACE_MAX_QUEUED
+
+logger = logging.getLogger("tracing")
+
+# Phases reported in Server-Timing, in this order
+PHASES = ("queue", "auth", "connect", "exec", "fetch", "build", "commit", "encode")
+
+_current = contextvars.ContextVar("trace", default=None)
+
+# Spans of one request. Nested spans (e.g. exec inside auth) are kept in a stack so that
+# "build" can be computed as the handler's own time, excluding the spans it contains.
+class Trace:
+    __slots__ = ("start", "totals", "counts", "events", "dropped", "_stack", "handler_end", "handler_children", "after_handler")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.totals = {}
+        self.counts = {}
+        self.events = []
+        self.dropped = 0
+        self._stack = []
+        self.handler_end = None
+        self.handler_children = 0.0
+        self.after_handler = 0.0
+
+    def add(self, name, started, elapsed):
+        self.totals[name] = self.totals.get(name, 0.0) + elapsed
+        self.counts[name] = self.counts.get(name, 0) + 1
+        if self._stack:
+            self._stack[-1][1] += elapsed
+        elif self.handler_end is not None:
+            # e.g. the commit in get_db's exit, which runs after serialization
+            self.after_handler += elapsed
+        if len(self.events) < TRACE_MAX_EVENTS:
+            self.events.append((name, round((started - self.start) * 1000, 3), round(elapsed * 1000, 3)))
+        else:
+            self.dropped += 1
+
+    # Fill in "build" (handler time not spent in nested spans) and "encode" (serialization after the handler)
+    def finish(self, end):
+        phases = {name: [self.totals[name] * 1000, self.counts[name]] for name in self.totals}
+        handler = phases.pop("handler", None)
+        if self.handler_end is not None:
+            encode = (end - self.handler_end - self.after_handler) * 1000
+            phases["encode"] = [max(encode, 0.0), 1]
+        if handler is not None:
+            phases["build"] = [max(handler[0] - self.handler_children * 1000, 0.0), 1]
+        return phases
+
+@contextmanager
+def span(name):
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    entry = [name, 0.0]
+    trace._stack.append(entry)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        trace._stack.pop()
+        trace.add(name, started, elapsed)
+        if name == "handler":
+            trace.handler_children = entry[1]
+            trace.handler_end = started + elapsed
+
+# For code that already measures its own duration (e.g. the tracked cursor)
+def record(name, started, elapsed):
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, started, elapsed)
+
+def server_timing_header(phases, total_ms):
+    parts = []
+    for name in PHASES:
+        if name in phases:
+            ms, count = phases[name]
+            part = f"{name};dur={ms:.1f}"
+            if count > 1:
+                part += f';desc="{count}x"'
+            parts.append(part)
+    parts.append(f"total;dur={total_ms:.1f}")
+    return ", ".join(parts)
+
+# Append-only JSON lines file for offline analysis (sampled and/or slow requests only).
+# Records are queued and written by a background thread, never on the event loop.
+class TraceWriter:
+    def __init__(self, path=TRACE_FILE, sample_rate=TRACE_SAMPLE_RATE, slow_ms=TRACE_SLOW_MS, max_queued=TRACE_MAX_QUEUED):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slow_ms = slow_ms
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._lock = threading.Lock()
+        self._thread = None
+        self.dropped = 0
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0 or self.slow_ms > 0
+
+    def wanted(self, total_ms):
+        return (self.slow_ms > 0 and total_ms >= self.slow_ms) or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    def write(self, record):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            # The disk cannot keep up: lose traces rather than memory
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            lines = [record]
+            # Drain whatever else is queued into the same append
+            while len(lines) < 1000:
+                try:
+                    record = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    self._append(lines)
+                    return
+                lines.append(record)
+            self._append(lines)
+
+    def _append(self, records):
+        text = "".join(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n" for record in records)
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(text)
+        except OSError as e:
+            logger.warning("could not write trace records: %s", e)
+
+    # Flush what is queued (shutdown)
+    def stop(self):
+        thread = self._thread
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout=5)
+            self._thread = None
+
+trace_writer = TraceWriter()
+
+# Wraps every endpoint so the time spent inside the handler itself is a span. A plain def
+# endpoint gets a plain def wrapper, so FastAPI still runs it in the threadpool.
+class TimedRoute(APIRoute):
+    def __init__(self, path, endpoint, **kwargs):
+        if asyncio.iscoroutinefunction(endpoint):
+            @functools.wraps(endpoint)
+            async def timed_endpoint(*args, **kw):
+                with span("handler"):
+                    return await endpoint(*args, **kw)
+        else:
+            @functools.wraps(endpoint)
+            def timed_endpoint(*args, **kw):
+                with span("handler"):
+                    return endpoint(*args, **kw)
+        super().__init__(path, timed_endpoint, **kwargs)
+
+# Outermost middleware: starts the trace, adds Server-Timing when the response starts
+# and writes a trace record once the body has been sent.
+class TimingMiddleware:
+    def __init__(self, app, enabled=SERVER_TIMING_ENABLED, writer=trace_writer):
+        self.app = app
+        self.enabled = enabled
+        self.writer = writer
+
+    async def __call__(self, scope, receive, send):
+        if not self.enabled or scope["type"] != "http" or scope["path"].startswith("/static"):
+            await self.app(scope, receive, send)
+            return
+        trace = Trace()
+        token = _current.set(trace)
+        status = {"code": None, "phases": None, "total_ms": None}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                now = time.perf_counter()
+                phases = trace.finish(now)
+                total_ms = (now - trace.start) * 1000
+                status.update(code=message["status"], phases=phases, total_ms=total_ms)
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing_header(phases, total_ms).encode("latin-1")))
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            if self.writer.enabled and status["total_ms"] is not None:
+                sent_ms = (time.perf_counter() - trace.start) * 1000
+                if self.writer.wanted(sent_ms):
+                    self.writer.write({
+                        "ts": time.time(),
+                        "method": scope["method"],
+                        "path": scope["path"],
+                        "route": getattr(scope.get("route"), "path", None),
+                        "status": status["code"],
+                        "ttfb_ms": round(status["total_ms"], 3),
+                        "total_ms": round(sent_ms, 3),
+                        "phases": {name: {"ms": round(ms, 3), "count": count} for name, (ms, count) in status["phases"].items()},
+                        "events": trace.events,
+                        "events_dropped": trace.dropped,
+                    })